@@ -0,0 +1,83 @@
+"""
+Seconds to ban a raid worth of accounts: one by one like the ban
+command, a DM, the old 0.2s pause and the ban, against a BulkActions
+job. Requests are simulated with a fixed latency, bans of one guild
+share a lock like a discord.py route bucket.
+
+Run from the repository root:
+    python -m benchmarks.bench_bulk_actions [users] [latency ms]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from utils import database_manager as sqlite
+from utils.bulk_actions import BulkActions
+from utils.strikes import BAN
+
+
+class FakeGuild:
+    id = 1
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.bucket = asyncio.Lock()
+        self.banned = 0
+
+    async def dm(self, user: int) -> None:
+        # Every DM channel is its own bucket
+        await asyncio.sleep(self.latency)
+
+    async def ban(self, user, *, reason=None, delete_message_days=1):
+        async with self.bucket:
+            await asyncio.sleep(self.latency)
+        self.banned += 1
+
+
+class FakeBot:
+    def __init__(self, guild: FakeGuild):
+        self.guild = guild
+
+    def get_guild(self, guild_id: int) -> FakeGuild:
+        return self.guild
+
+    def get_channel(self, channel_id: int) -> None:
+        return None
+
+
+async def one_by_one(guild: FakeGuild, users: range) -> None:
+    for user in users:
+        await guild.dm(user)
+        await asyncio.sleep(0.2)
+        await guild.ban(user)
+
+
+async def bulk(guild: FakeGuild, users: range) -> None:
+    actions = BulkActions(FakeBot(guild), workers=4, rate=50)
+    job = await actions.create(guild, None, None, BAN, users)
+    await actions.start(job)
+
+
+async def run(users: int, latency: int):
+    sqlite.db_path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    sqlite.make_sure_tables_exist()
+    await sqlite.open_pool()
+
+    print(f"Banning {users} users, {latency}ms per request")
+    for name, ban_all in (("one by one", one_by_one), ("bulk job", bulk)):
+        guild = FakeGuild(latency / 1000)
+        start = time.perf_counter()
+        await ban_all(guild, range(1, users + 1))
+        elapsed = time.perf_counter() - start
+        print(f"{name:<11} {elapsed:>7.2f}s {guild.banned / elapsed:>7.1f} "
+              f"bans/sec")
+
+    await sqlite.close_pool()
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    asyncio.get_event_loop().run_until_complete(
+        run(*(args + [300, 50][len(args):])))
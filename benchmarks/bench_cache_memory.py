@@ -0,0 +1,94 @@
+"""
+Resident memory of MyBot per [Cache] profile, on a synthetic state of
+many guilds after replaying gateway traffic through it
+
+Every profile runs in a fresh interpreter so the numbers don't mix.
+Needs a config.ini, the token is never used.
+
+Run from the repository root:
+    python -m benchmarks.bench_cache_memory [guilds] [events]
+"""
+import asyncio
+import gc
+import os
+import subprocess
+import sys
+import tempfile
+
+from utils.cache_profile import PROFILES
+
+MIX = {
+    "message": 0.4,
+    "presence": 0.3,
+    "typing": 0.2,
+    "reaction": 0.08,
+    "member_join": 0.02
+}
+
+
+def rss_mb() -> float:
+    with open("/proc/self/statm") as statm:
+        resident = int(statm.read().split()[1])
+    return resident * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+
+async def measure(profile: str, guilds: int, events: int):
+    import bot
+    from benchmarks.fake_gateway import FakeGateway, HandlerTimer
+    from utils import database_manager as sqlite
+
+    bot.config.read_dict({"Cache": {"profile": profile}})
+    sqlite.db_path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    sqlite.make_sure_tables_exist()
+    await sqlite.open_pool()
+
+    baseline = rss_mb()
+    mybot = bot.MyBot(
+        description="benchmark", prefix=bot.Prefixer(), enckey=b"0" * 16)
+    while not mybot.cogs:
+        await asyncio.sleep(0.01)
+
+    gateway = FakeGateway(mybot, guilds=guilds, channels=3, members=50)
+    timer = HandlerTimer(mybot)
+    gateway.connect()
+    await timer.drain()
+    connected = rss_mb()
+
+    batch = list(gateway.events(events, MIX))
+    for i, (event, data) in enumerate(batch, 1):
+        gateway.feed(event, data)
+        if i % 50 == 0:
+            await asyncio.sleep(0)
+    await timer.drain()
+    del batch
+    gc.collect()
+
+    state = mybot._connection
+    print(f"{profile} {connected - baseline:.1f} {rss_mb() - baseline:.1f} "
+          f"{sum(len(g.members) for g in mybot.guilds)} "
+          f"{len(state._messages)}")
+    await sqlite.close_pool()
+
+
+def run(guilds: int, events: int):
+    print(f"{guilds} guilds, {events} events replayed\n")
+    print(f"{'profile':<8} {'after ready MB':>15} {'after events MB':>16} "
+          f"{'members':>9} {'messages':>9}")
+    for profile in PROFILES:
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.bench_cache_memory",
+             "--child", profile, str(guilds), str(events)],
+            stdout=subprocess.PIPE, check=True, universal_newlines=True
+        ).stdout.splitlines()[-1]
+        name, ready, replayed, members, messages = output.split()
+        print(f"{name:<8} {float(ready):>15.1f} {float(replayed):>16.1f} "
+              f"{int(members):>9} {int(messages):>9}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--child"]:
+        asyncio.get_event_loop().run_until_complete(
+            measure(sys.argv[2], int(sys.argv[3]), int(sys.argv[4])))
+    else:
+        args = [int(arg) for arg in sys.argv[1:]]
+        run(*(args + [50000, 200000][len(args):]))
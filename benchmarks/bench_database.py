@@ -0,0 +1,65 @@
+"""
+Queries/sec through utils.database_manager, per-call connections vs the pool
+
+Run from the repository root:
+    python -m benchmarks.bench_database [queries]
+"""
+import asyncio
+import os
+import sqlite3 as sql
+import sys
+import tempfile
+import time
+from threading import Thread
+
+from utils import database_manager as sqlite
+
+
+async def per_call_fetchone(path: str, query: str, args: list):
+    """The old behaviour, a new connection and thread for every query"""
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+
+    def work():
+        db = sql.connect(path, detect_types=sql.PARSE_DECLTYPES)
+        try:
+            row = db.execute(query, args).fetchone()
+        finally:
+            db.close()
+        loop.call_soon_threadsafe(future.set_result, row)
+
+    Thread(target=work).start()
+    return await future
+
+
+async def run(queries: int):
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    sqlite.db_path = path
+    sqlite.make_sure_tables_exist()
+    sqlite.sync_execute(
+        "INSERT INTO prefixes(guildid, prefix) VALUES (?, ?)", [1, "!"]
+    )
+    query = "SELECT prefix FROM prefixes WHERE guildid = ?"
+
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        per_call_fetchone(path, query, [1]) for _ in range(queries)
+    ))
+    before = queries / (time.perf_counter() - start)
+
+    await sqlite.open_pool()
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        sqlite.fetchone(query, [1]) for _ in range(queries)
+    ))
+    after = queries / (time.perf_counter() - start)
+    await sqlite.close_pool()
+
+    print(f"{'per-call connect':<18} {before:>10.0f} queries/sec")
+    print(f"{'connection pool':<18} {after:>10.0f} queries/sec")
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(
+        run(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
+    )
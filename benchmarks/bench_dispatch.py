@@ -0,0 +1,88 @@
+"""
+Dispatch overhead per gateway event with the empty listeners of the
+Events cog registered, as before, and skipped by MyBot.add_listener
+
+Needs a config.ini, the token is never used.
+
+Run from the repository root:
+    python -m benchmarks.bench_dispatch [events]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from discord.ext import commands
+
+import bot
+from benchmarks.fake_gateway import FakeGateway, HandlerTimer
+from utils import database_manager as sqlite
+
+KINDS = ["typing", "presence", "reaction", "member_join", "message"]
+
+
+async def per_event(
+    gateway: FakeGateway, timer: HandlerTimer, kind: str, count: int
+) -> float:
+    """Microseconds from feeding an event until its handlers finished"""
+    events = list(gateway.events(count, {kind: 1.0}))
+    start = time.perf_counter()
+    for i, (event, data) in enumerate(events, 1):
+        gateway.feed(event, data)
+        if i % 50 == 0:
+            await asyncio.sleep(0)
+    await timer.drain()
+    return (time.perf_counter() - start) / count * 1e6
+
+
+async def measure(gateway: FakeGateway, timer: HandlerTimer, count: int):
+    results = {}
+    for kind in KINDS:
+        timer.durations.clear()
+        results[kind] = (
+            await per_event(gateway, timer, kind, count),
+            sum(len(d) for d in timer.durations.values()) / count
+        )
+    return results
+
+
+async def run(count: int):
+    sqlite.db_path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    sqlite.make_sure_tables_exist()
+    await sqlite.open_pool()
+
+    prefixer = bot.Prefixer()
+    mybot = bot.MyBot(
+        description="benchmark", prefix=prefixer, enckey=b"0" * 16)
+    while not mybot.cogs:
+        await asyncio.sleep(0.01)
+
+    gateway = FakeGateway(mybot, guilds=20, members=100)
+    timer = HandlerTimer(mybot)
+    gateway.connect()
+    await prefixer.load_guilds(list(gateway.guilds))
+    await timer.drain()
+
+    after = await measure(gateway, timer, count)
+
+    # Registers the skipped listeners the way discord.py would
+    for name, func in mybot.skipped_listeners:
+        commands.AutoShardedBot.add_listener(mybot, func, name)
+    before = await measure(gateway, timer, count)
+
+    print(f"{len(mybot.skipped_listeners)} empty listeners skipped\n")
+    print(f"{'event':<12} {'before us':>10} {'tasks':>6} "
+          f"{'after us':>10} {'tasks':>6}")
+    for kind in KINDS:
+        print(f"{kind:<12} {before[kind][0]:>10.1f} {before[kind][1]:>6.1f} "
+              f"{after[kind][0]:>10.1f} {after[kind][1]:>6.1f}")
+
+    await mybot.close()
+    await sqlite.close_pool()
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    asyncio.get_event_loop().run_until_complete(
+        run(*(args + [20000][len(args):])))
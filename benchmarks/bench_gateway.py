@@ -0,0 +1,131 @@
+"""
+End to end throughput of MyBot with every cog loaded,
+replaying synthetic gateway traffic through benchmarks.fake_gateway
+
+Reports events/sec, p50/p99 handler latency and peak RSS per scenario.
+Needs a config.ini, the token is never used.
+
+Run from the repository root:
+    python -m benchmarks.bench_gateway [events] [guilds] [members]
+"""
+import asyncio
+import os
+import resource
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Dict, List
+
+from discord.ext import commands
+
+import bot
+from benchmarks.fake_gateway import FakeGateway, HandlerTimer
+from utils import database_manager as sqlite
+
+SCENARIOS = {
+    "chat": {"message": 1.0},
+    "commands": {"command": 1.0},
+    "mixed": {
+        "message": 0.45,
+        "command": 0.05,
+        "typing": 0.2,
+        "presence": 0.2,
+        "reaction": 0.08,
+        "member_join": 0.02
+    }
+}
+
+# Events fed before yielding to the loop, roughly one gateway read
+BATCH = 50
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[int(fraction * (len(ordered) - 1))]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def replay(
+    gateway: FakeGateway, timer: HandlerTimer, mix: Dict[str, float],
+    count: int
+) -> float:
+    """Feeds count events and returns the events/sec until all handled"""
+    events = list(gateway.events(count, mix))
+    start = time.perf_counter()
+    for i, (event, data) in enumerate(events, 1):
+        gateway.feed(event, data)
+        if i % BATCH == 0:
+            await asyncio.sleep(0)
+    await timer.drain()
+    return count / (time.perf_counter() - start)
+
+
+class CommandErrors:
+    """Counts the errors of commands that exist, a benchmark of
+    the error path says little about command dispatch
+    """
+
+    def __init__(self, bot):
+        self.errors = Counter()
+        bot.add_listener(self.on_command_error)
+
+    async def on_command_error(self, ctx, error):
+        if not isinstance(error, commands.CommandNotFound):
+            self.errors[f"{ctx.command}: {type(error).__name__}"] += 1
+
+
+async def run(events: int, guilds: int, members: int):
+    sqlite.db_path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    sqlite.make_sure_tables_exist()
+    await sqlite.open_pool()
+
+    prefixer = bot.Prefixer()
+    mybot = bot.MyBot(
+        description="benchmark", prefix=prefixer, enckey=b"0" * 16)
+    while not mybot.cogs:
+        await asyncio.sleep(0.01)
+
+    gateway = FakeGateway(mybot, guilds=guilds, members=members)
+    timer = HandlerTimer(mybot)
+    errors = CommandErrors(mybot)
+    gateway.connect()
+    await prefixer.load_guilds(list(gateway.guilds))
+    await timer.drain()
+
+    print(f"{'scenario':<10} {'events/sec':>12} {'p50 ms':>9} "
+          f"{'p99 ms':>9} {'peak RSS MB':>12}")
+    for name, mix in SCENARIOS.items():
+        timer.durations.clear()
+        rate = await replay(gateway, timer, mix, events)
+        samples = [d for durations in timer.durations.values()
+                   for d in durations]
+        print(f"{name:<10} {rate:>12.0f} "
+              f"{percentile(samples, 0.5) * 1000:>9.3f} "
+              f"{percentile(samples, 0.99) * 1000:>9.3f} "
+              f"{peak_rss_mb():>12.1f}")
+
+    print("\nREST calls answered by the fake API")
+    for route, calls in sorted(gateway.http.calls.items()):
+        print(f"{calls:>8} {route}")
+
+    await mybot.close()
+    await sqlite.close_pool()
+
+    if errors.errors:
+        print("\nCommands failed, the results above aren't valid")
+        for error, count in errors.errors.most_common():
+            print(f"{count:>8} {error}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    asyncio.get_event_loop().run_until_complete(
+        run(*(args + [20000, 100, 200][len(args):])))
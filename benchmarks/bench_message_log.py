@@ -0,0 +1,50 @@
+"""
+Memory held by buffered message log entries, OrderedDict vs LoggedMessage
+
+Run from the repository root:
+    python -m benchmarks.bench_message_log [entries]
+"""
+import datetime
+import sys
+import tracemalloc
+from collections import OrderedDict as odict
+
+from utils.message_buffer import LoggedMessage
+
+
+def as_odict(i: int, now: datetime.datetime, content: str) -> odict:
+    return odict(
+        messageid=i,
+        authorid=i,
+        guildid=i,
+        channelid=i,
+        date=now,
+        content=content
+    )
+
+
+def as_record(i: int, now: datetime.datetime, content: str) -> LoggedMessage:
+    return LoggedMessage(i, i, i, i, now, content)
+
+
+def measure(factory, entries: int) -> int:
+    now = datetime.datetime.utcnow()
+    content = "Hello world"
+    tracemalloc.start()
+    buffer = [factory(i, now, content) for i in range(entries)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del buffer
+    return size
+
+
+def run(entries: int):
+    for name, factory in (("OrderedDict", as_odict),
+                          ("LoggedMessage", as_record)):
+        size = measure(factory, entries)
+        print(f"{name:<14} {size / 1024 / 1024:>8.1f} MiB"
+              f" {size / entries:>6.0f} bytes/entry")
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,78 @@
+"""
+Paged message log queries against a large fixture database,
+with and without the messagelog indexes
+
+Run from the repository root:
+    python -m benchmarks.bench_message_log_query [rows]
+"""
+import asyncio
+import datetime
+import os
+import random
+import sqlite3 as sql
+import sys
+import tempfile
+import time
+
+from utils import database_manager as sqlite
+from utils import message_log
+
+GUILDS = 200
+AUTHORS = 5000
+CHANNELS = 2000
+
+
+def build_fixture(path: str, rows: int):
+    rng = random.Random(0)
+    start = datetime.datetime(2020, 1, 1)
+    conn = sql.connect(path, detect_types=sql.PARSE_DECLTYPES)
+    conn.executemany(
+        "INSERT INTO messagelog VALUES (?, ?, ?, ?, ?, ?)",
+        (
+            (i, rng.randrange(AUTHORS), rng.randrange(GUILDS),
+             rng.randrange(CHANNELS),
+             start + datetime.timedelta(seconds=i), b"x" * 32)
+            for i in range(rows)
+        )
+    )
+    conn.commit()
+    conn.close()
+
+
+async def timed(queries: int) -> float:
+    rng = random.Random(1)
+    start = time.perf_counter()
+    for _ in range(queries):
+        rows, cursor = await message_log.by_author(
+            rng.randrange(GUILDS), rng.randrange(AUTHORS), 10)
+        if cursor is not None:
+            await message_log.by_author(
+                rng.randrange(GUILDS), rng.randrange(AUTHORS), 10, cursor)
+        await message_log.by_channel(rng.randrange(CHANNELS), 10)
+    return (time.perf_counter() - start) / queries * 1000
+
+
+async def run(rows: int):
+    sqlite.db_path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    sqlite.make_sure_tables_exist()
+    for index in ("messagelog_guild_author_date", "messagelog_channel_date"):
+        sqlite.sync_execute(f"DROP INDEX {index}")
+
+    start = time.perf_counter()
+    build_fixture(sqlite.db_path, rows)
+    print(f"Built {rows} rows in {time.perf_counter() - start:.1f}s")
+
+    await sqlite.open_pool()
+    print(f"{'without indexes':<16} {await timed(5):>9.2f} ms/lookup")
+    await sqlite.close_pool()
+
+    sqlite.make_sure_tables_exist()
+    await sqlite.open_pool()
+    print(f"{'with indexes':<16} {await timed(500):>9.2f} ms/lookup")
+    await sqlite.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(
+        run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000000)
+    )
@@ -0,0 +1,74 @@
+"""
+Messages/sec through prefix resolution with many guilds,
+the old per-message list building against the PrefixTrie matchers
+
+Run from the repository root:
+    python -m benchmarks.bench_prefix [guilds] [messages]
+"""
+import random
+import sys
+import time
+
+from utils.prefix_trie import PrefixTrie
+
+BOT_ID = 123456789012345678
+DEFAULT = "!"
+CUSTOM = ["?", "!!", "$", ">>", "bot ", "pls ", "."]
+
+
+def old_resolve(prefixes: dict, guild: int, content: str):
+    """Mirrors commands.when_mentioned_or(*prefixes) and the scan after"""
+    candidates = [f"<@{BOT_ID}> ", f"<@!{BOT_ID}> "]
+    candidates.extend(prefixes.get(guild, [DEFAULT]))
+    for prefix in candidates:
+        if content.startswith(prefix):
+            return prefix
+    return None
+
+
+def new_resolve(base: PrefixTrie, matchers: dict, guild: int, content: str):
+    match = base.longest_match(content)
+    matcher = matchers.get(guild)
+    if matcher is not None:
+        custom = matcher.longest_match(content)
+        if custom is not None and (match is None or len(custom) > len(match)):
+            match = custom
+    return match
+
+
+def run(guilds: int, messages: int):
+    rng = random.Random(0)
+    prefixes = {
+        guild: sorted([DEFAULT] + rng.sample(CUSTOM, rng.randint(1, 3)),
+                      reverse=True)
+        for guild in range(guilds)
+    }
+    matchers = {guild: PrefixTrie(p) for guild, p in prefixes.items()}
+    base = PrefixTrie([DEFAULT, f"<@{BOT_ID}> ", f"<@!{BOT_ID}> "])
+
+    traffic = []
+    for _ in range(messages):
+        guild = rng.randrange(guilds)
+        if rng.random() < 0.1:
+            content = rng.choice(prefixes[guild]) + "help"
+        else:
+            content = "just chatting about something " * rng.randint(1, 4)
+        traffic.append((guild, content))
+
+    start = time.perf_counter()
+    for guild, content in traffic:
+        old_resolve(prefixes, guild, content)
+    old = messages / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for guild, content in traffic:
+        new_resolve(base, matchers, guild, content)
+    new = messages / (time.perf_counter() - start)
+
+    print(f"{'when_mentioned_or':<18} {old:>12.0f} messages/sec")
+    print(f"{'PrefixTrie':<18} {new:>12.0f} messages/sec")
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    run(*(args + [10000, 1000000][len(args):]))
@@ -0,0 +1,66 @@
+"""
+Joins/sec through the raid detector during a join storm, a few guilds
+getting thousands of joins per second among many quiet ones,
+and the memory held per guild
+
+Run from the repository root:
+    python -m benchmarks.bench_raid [joins] [guilds] [rate]
+"""
+import random
+import sys
+import time
+import tracemalloc
+
+from utils.raid_detector import DISCORD_EPOCH, RaidDetector
+
+RAIDED = 5
+
+
+def snowflake(created: float, n: int) -> int:
+    return (int((created - DISCORD_EPOCH) * 1000) << 22) + n % 4096
+
+
+def storm(joins: int, guilds: int, rate: int, start: float, seed: int = 0):
+    """(guild, user, time), nearly all joins are fresh accounts raiding"""
+    rng = random.Random(seed)
+    out = []
+    for i in range(joins):
+        now = start + i / rate
+        if rng.random() < 0.95:
+            out.append((rng.randrange(RAIDED), snowflake(now - 60, i), now))
+        else:
+            created = now - rng.uniform(3600, 5 * 365 * 86400)
+            out.append((rng.randrange(guilds), snowflake(created, i), now))
+    return out
+
+
+def run(joins: int, guilds: int, rate: int):
+    start = time.time()
+    traffic = storm(joins, guilds, rate, start)
+    detector = RaidDetector(max_guilds=guilds)
+
+    began = time.perf_counter()
+    raids = 0
+    for guild, user, now in traffic:
+        if detector.join(guild, user, now):
+            raids += 1
+    elapsed = time.perf_counter() - began
+
+    tracemalloc.start()
+    held = RaidDetector(max_guilds=guilds)
+    for guild, user, now in traffic:
+        held.join(guild, user, now)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(f"{joins} joins at {rate}/sec over {guilds} guilds, "
+          f"{RAIDED} of them raided")
+    print(f"{elapsed / joins * 1e6:.2f}us/join, "
+          f"{joins / elapsed:.0f} joins/sec")
+    print(f"{raids} raids flagged, {len(held.guilds)} guilds tracked, "
+          f"{memory / len(held.guilds) / 1024:.1f}KB per guild")
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    run(*(args + [500000, 2000, 5000][len(args):]))
@@ -0,0 +1,98 @@
+"""
+Cost of the spam filter per message, replaying synthetic traffic
+timestamped as if 100k messages arrived every second, for each preset.
+A share of the members spam: flooding, repeating themselves,
+mass mentioning or posting links.
+
+Run from the repository root:
+    python -m benchmarks.bench_spam_filter [messages] [members] [rate]
+"""
+import random
+import sys
+import time
+import tracemalloc
+from collections import Counter
+
+from utils.spam_filter import PRESETS, SpamFilter
+
+GUILDS = 200
+SPAMMERS = 100
+WORDS = ("hello", "anyone", "around", "what", "is", "the", "best", "way",
+         "to", "do", "this", "lol", "yeah", "thanks", "game", "tonight")
+SPAM = ("flood", "duplicate", "mentions", "links")
+
+
+def traffic(messages: int, members: int, rate: int, seed: int = 0):
+    """
+    (guild, user, time, content, mentions) tuples, 2% of them
+    from a hundred spammers
+    """
+    rng = random.Random(seed)
+    spammers = {
+        user: rng.choice(SPAM)
+        for user in rng.sample(range(members), SPAMMERS)
+    }
+    spammer_ids = list(spammers)
+    out = []
+    for i in range(messages):
+        now = i / rate
+        if rng.random() < 0.02:
+            user = rng.choice(spammer_ids)
+            kind = spammers[user]
+        else:
+            user = rng.randrange(members)
+            kind = None
+        content = " ".join(rng.choices(WORDS, k=rng.randint(2, 12)))
+        mentions = 0
+        if kind == "duplicate":
+            content = f"FREE NITRO click here {rng.randint(0, 99)}!!"
+        elif kind == "mentions":
+            mentions = rng.randint(3, 8)
+        elif kind == "links":
+            content += " https://example.com/x https://example.com/y"
+        out.append((user % GUILDS, user, now, content, mentions))
+    return out
+
+
+def replay(spam_filter: SpamFilter, messages: list) -> Counter:
+    reasons = Counter()
+    check = spam_filter.check
+    for guild, user, now, content, mentions in messages:
+        reasons[check(guild, user, now, content, mentions)] += 1
+    return reasons
+
+
+def run(messages: int, members: int, rate: int):
+    messages_ = traffic(messages, members, rate)
+    print(f"{messages} messages from {members} members, "
+          f"{rate} messages/sec of traffic")
+    print(f"{'preset':<8} {'us/message':>10} {'messages/sec':>13} "
+          f"{'flagged':>8} {'members':>8} {'memory':>9}")
+
+    for name in ["off", *PRESETS]:
+        spam_filter = SpamFilter(name)
+        start = time.perf_counter()
+        reasons = replay(spam_filter, messages_)
+        elapsed = time.perf_counter() - start
+
+        # Memory on a second pass, tracemalloc slows down the first
+        tracemalloc.start()
+        held = SpamFilter(name)
+        replay(held, messages_)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del held
+
+        flagged = messages - reasons[None]
+        print(f"{name:<8} {elapsed / messages * 1e6:>10.2f} "
+              f"{messages / elapsed:>13.0f} {flagged:>8} "
+              f"{len(spam_filter.rings):>8} {memory / 2 ** 20:>7.1f}MB")
+        if flagged:
+            print("         " + ", ".join(
+                f"{reason}: {count}" for reason, count in reasons.items()
+                if reason is not None))
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    run(*(args + [1000000, 1000000, 100000][len(args):]))
@@ -0,0 +1,317 @@
+"""
+A local stand-in for the Discord gateway and HTTP API
+
+FakeGateway builds a synthetic guild state for a MyBot instance and
+feeds raw gateway payloads straight into the connection state parsers,
+the same way the websocket does, so events travel through discord.py
+and into the loaded cogs. FakeHTTP answers the REST calls the cogs make
+with canned payloads, nothing leaves the machine.
+"""
+import asyncio
+import datetime
+import itertools
+import random
+import time
+from collections import defaultdict
+from typing import Dict, Iterator, List, Tuple
+
+BOT_ID = 100000000000000000
+OWNER_ID = 100000000000000001
+MANAGE_ROLES = 0x10000000
+_snowflakes = itertools.count(200000000000000000)
+
+
+def snowflake() -> str:
+    return str(next(_snowflakes))
+
+
+def user_payload(user_id: int, bot: bool = False) -> dict:
+    return {
+        "id": str(user_id),
+        "username": f"user{user_id % 100000}",
+        "discriminator": f"{user_id % 10000:04}",
+        "avatar": None,
+        "bot": bot
+    }
+
+
+def member_payload(
+    user_id: int, roles: List[str] = (), bot: bool = False
+) -> dict:
+    return {
+        "user": user_payload(user_id, bot=bot),
+        "roles": list(roles),
+        "joined_at": "2018-07-01T00:00:00+00:00",
+        "deaf": False,
+        "mute": False,
+        "nick": None
+    }
+
+
+def guild_payload(
+    guild_id: int, channel_ids: List[int], member_ids: List[int]
+) -> dict:
+    """The bot is always a member, with manage_roles like a real setup"""
+    bot_role = snowflake()
+    return {
+        "id": str(guild_id),
+        "name": f"guild{guild_id % 100000}",
+        "owner_id": str(OWNER_ID),
+        "region": "us-east",
+        "afk_timeout": 300,
+        "afk_channel_id": None,
+        "icon": None,
+        "splash": None,
+        "verification_level": 0,
+        "default_message_notifications": 0,
+        "explicit_content_filter": 0,
+        "mfa_level": 0,
+        "features": [],
+        "emojis": [],
+        "roles": [{
+            "id": str(guild_id),
+            "name": "@everyone",
+            "permissions": 104324161,
+            "position": 0,
+            "color": 0,
+            "hoist": False,
+            "managed": False,
+            "mentionable": False
+        }, {
+            "id": bot_role,
+            "name": "bot",
+            "permissions": 104324161 | MANAGE_ROLES,
+            "position": 1,
+            "color": 0,
+            "hoist": False,
+            "managed": True,
+            "mentionable": False
+        }],
+        "channels": [
+            {
+                "id": str(channel_id),
+                "type": 0,
+                "name": f"channel{position}",
+                "position": position,
+                "permission_overwrites": [],
+                "topic": None,
+                "nsfw": False,
+                "parent_id": None
+            }
+            for position, channel_id in enumerate(channel_ids)
+        ],
+        "members": [member_payload(BOT_ID, [bot_role], bot=True)] + [
+            member_payload(user_id) for user_id in member_ids],
+        "presences": [],
+        "voice_states": [],
+        "member_count": len(member_ids) + 1,
+        "large": False,
+        "unavailable": False
+    }
+
+
+def message_payload(
+    guild_id: int, channel_id: int, author_id: int, content: str
+) -> dict:
+    return {
+        "id": snowflake(),
+        "channel_id": str(channel_id),
+        "guild_id": str(guild_id),
+        "author": user_payload(author_id),
+        "member": {"roles": [], "joined_at": "2018-07-01T00:00:00+00:00",
+                   "deaf": False, "mute": False, "nick": None},
+        "content": content,
+        "timestamp": datetime.datetime.utcnow().isoformat() + "+00:00",
+        "edited_timestamp": None,
+        "tts": False,
+        "mention_everyone": False,
+        "mentions": [],
+        "mention_roles": [],
+        "attachments": [],
+        "embeds": [],
+        "pinned": False,
+        "type": 0
+    }
+
+
+class FakeHTTP:
+    """Replaces HTTPClient.request, recording every route it is asked for"""
+
+    def __init__(self):
+        self.calls = defaultdict(int)
+
+    async def __call__(self, route, **kwargs):
+        self.calls[f"{route.method} {route.path}"] += 1
+
+        if route.path == "/oauth2/applications/@me":
+            return {
+                "id": str(BOT_ID),
+                "name": "benchmark",
+                "description": "",
+                "icon": None,
+                "rpc_origins": None,
+                "bot_public": True,
+                "bot_require_code_grant": False,
+                "owner": user_payload(OWNER_ID)
+            }
+
+        if route.path == "/users/@me/channels":
+            return {
+                "id": snowflake(),
+                "type": 1,
+                "last_message_id": None,
+                "recipients": [user_payload(
+                    int(kwargs.get("json", {}).get("recipient_id", 0)))]
+            }
+
+        if route.method == "POST" and route.path.endswith("/messages"):
+            json = kwargs.get("json") or {}
+            data = message_payload(0, route.channel_id, BOT_ID,
+                                   json.get("content") or "")
+            data.pop("guild_id")
+            data["author"]["bot"] = True
+            return data
+
+        return {}
+
+
+class HandlerTimer:
+    """
+    Wraps Client._run_event, timing every listener and command handler
+    the events fan out to, and tracking how many are still running
+    """
+
+    def __init__(self, bot):
+        self.durations = defaultdict(list)
+        self.pending = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        original = bot._run_event
+
+        async def timed(coro, event_name, *args, **kwargs):
+            self.pending += 1
+            self.idle.clear()
+            start = time.perf_counter()
+            try:
+                await original(coro, event_name, *args, **kwargs)
+            finally:
+                self.durations[event_name].append(
+                    time.perf_counter() - start)
+                self.pending -= 1
+                if not self.pending:
+                    self.idle.set()
+
+        bot._run_event = timed
+
+    async def drain(self):
+        """Waits until every scheduled handler has finished"""
+        while True:
+            await self.idle.wait()
+            # Handlers may schedule more handlers as they finish
+            await asyncio.sleep(0)
+            if self.idle.is_set():
+                return
+
+
+class FakeGateway:
+    """Synthetic guilds and a stream of gateway events for a MyBot"""
+
+    def __init__(
+        self,
+        bot,
+        guilds: int = 50,
+        channels: int = 5,
+        members: int = 200,
+        online: float = 0.1,
+        seed: int = 0
+    ):
+        self.bot = bot
+        self.online = online
+        self.state = bot._connection
+        self.rng = random.Random(seed)
+        self.http = FakeHTTP()
+        bot.http.request = self.http
+
+        self.guilds = {}  # type: Dict[int, Tuple[List[int], List[int]]]
+        for _ in range(guilds):
+            guild_id = int(snowflake())
+            self.guilds[guild_id] = (
+                [int(snowflake()) for _ in range(channels)],
+                [OWNER_ID] + [int(snowflake()) for _ in range(members - 1)]
+            )
+
+    def connect(self):
+        """
+        Sets up the bot user and every guild, then dispatches ready
+        Unless the bot chunks members, guilds only get the online ones
+        """
+        from discord.user import ClientUser
+
+        self.state.user = ClientUser(
+            state=self.state, data=user_payload(BOT_ID, bot=True))
+        for guild_id, (channel_ids, member_ids) in self.guilds.items():
+            if not self.state._fetch_offline:
+                member_ids = member_ids[:max(
+                    1, int(len(member_ids) * self.online))]
+            self.state._add_guild_from_data(
+                guild_payload(guild_id, channel_ids, member_ids))
+
+        self.bot._ready.set()
+        self.bot.dispatch("ready")
+
+    def feed(self, event: str, data: dict):
+        """Hands a payload to discord.py like the websocket would"""
+        getattr(self.state, "parse_" + event.lower())(data)
+
+    def events(self, count: int, mix: Dict[str, float]) -> Iterator[tuple]:
+        """Yields count (event, payload) pairs, drawn by the weights in mix"""
+        kinds = list(mix)
+        weights = [mix[kind] for kind in kinds]
+        guild_ids = list(self.guilds)
+        prefix = self.bot.prefixer.default
+
+        for kind in self.rng.choices(kinds, weights, k=count):
+            guild_id = self.rng.choice(guild_ids)
+            channel_ids, member_ids = self.guilds[guild_id]
+            channel_id = self.rng.choice(channel_ids)
+            user_id = self.rng.choice(member_ids)
+
+            if kind == "message":
+                yield "MESSAGE_CREATE", message_payload(
+                    guild_id, channel_id, user_id,
+                    "just chatting " * self.rng.randint(1, 8))
+            elif kind == "command":
+                command = self.rng.choice(
+                    ["prefixes", "role", "nosuchcommand"])
+                yield "MESSAGE_CREATE", message_payload(
+                    guild_id, channel_id, OWNER_ID, prefix + command)
+            elif kind == "reaction":
+                yield "MESSAGE_REACTION_ADD", {
+                    "user_id": str(user_id),
+                    "channel_id": str(channel_id),
+                    "message_id": snowflake(),
+                    "guild_id": str(guild_id),
+                    "emoji": {"id": None, "name": "\N{THUMBS UP SIGN}"}
+                }
+            elif kind == "typing":
+                yield "TYPING_START", {
+                    "user_id": str(user_id),
+                    "channel_id": str(channel_id),
+                    "guild_id": str(guild_id),
+                    "timestamp": int(time.time())
+                }
+            elif kind == "member_join":
+                new_id = int(snowflake())
+                member_ids.append(new_id)
+                data = member_payload(new_id)
+                data["guild_id"] = str(guild_id)
+                yield "GUILD_MEMBER_ADD", data
+            elif kind == "presence":
+                yield "PRESENCE_UPDATE", {
+                    "user": {"id": str(user_id)},
+                    "guild_id": str(guild_id),
+                    "status": self.rng.choice(["online", "idle", "dnd"]),
+                    "game": None,
+                    "roles": [],
+                    "nick": None
+                }
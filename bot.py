@@ -1,16 +1,27 @@
 import asyncio
 import configparser
 import datetime
+import importlib
 import logging
 import os
 import sys
+import time
+from collections import OrderedDict
 from pathlib import Path
-from typing import Any, Callable, List, Union
+from typing import Any, Callable, Dict, List, Union
 
 import discord
 from discord.ext import commands
 
+from utils import cache_profile, cog_loader
+from utils.bulk_actions import BulkActions
 from utils import database_manager as sqlite
+from utils.instrumentation import Instrumentation, MetricsServer
+from utils.listeners import is_noop, subscribed
+from utils.loop_monitor import LoopLagProbe
+from utils.prefix_sync import ADD, REMOVE, InvalidationChannel, make_channel
+from utils.prefix_trie import PrefixTrie
+from utils.scheduler import Scheduler
 
 
 # Read configs
@@ -34,104 +45,211 @@ handler.setFormatter(logging.Formatter(
     "%(asctime)s:%(levelname)s:%(name)s: %(message)s"))
 logger.addHandler(handler)
 
-SYNC = 0
-ASYNC = 1
+# Exit code telling a cluster supervisor not to restart the process
+EXIT_LOGIN_FAILURE = 2
 
 
 class Prefixer:
-    """Class used to fetch guild-based prefixes"""
-
-    def __init__(self):
+    """
+    Class used to fetch guild-based prefixes
+
+    Prefixes are loaded per shard as it becomes ready, or when a guild
+    is joined, and read through from the database on a cache miss.
+    At most cache_size guilds are kept, least recently used go first.
+    Changes are published on channel, so other processes running
+    shards of the bot can update their caches.
+    """
+
+    def __init__(
+        self,
+        cache_size: int = 50000,
+        channel: InvalidationChannel = None
+    ):
         self.default = botconfig.get("default_prefix")
-        self.prefix = self.startup()
-
-    def startup(self) -> dict:
+        self.cache_size = cache_size
+        self.channel = channel or InvalidationChannel()
+        # guild -> prefixes, in least recently used order
+        self.prefix = OrderedDict()
+        # Matchers are rebuilt only when a guild's prefixes change
+        self.matchers = dict()
+        self.loading = dict()
+        self.base = PrefixTrie([self.default])
+        self.base_user = None
+
+    async def load_guilds(self, guilds: List[int]) -> Dict[int, List[str]]:
         """
-        Loads all saved prefixes to memory,
-        including given default prefix from config
+        Loads the saved prefixes of guilds into memory, in chunks
+        Returns them, some may already be evicted again
         """
-        rows = sqlite.sync_fetchall("SELECT * FROM prefixes")
-
-        prefix_dict = dict()
-        for row in rows:
-            guild = row[0]
-            prefix = row[1]
-
-            if guild in prefix_dict:
-                if prefix in prefix_dict[guild]:
-                    continue
-                else:
-                    prefix_dict[guild].append(prefix)
-            else:
-                prefix_dict[guild] = [self.default, prefix]
-
-        for prefixlist in prefix_dict.values():
-            prefixlist.sort(reverse=True)
+        guilds = list(guilds)
+        result = {}
+        for i in range(0, len(guilds), 500):
+            chunk = guilds[i:i + 500]
+            rows = await sqlite.fetchall(f"""
+                SELECT guildid, prefix FROM prefixes
+                    WHERE guildid IN ({", ".join("?" * len(chunk))});
+            """, chunk)
+
+            loaded = {guild: [self.default] for guild in chunk}
+            for guild, prefix in rows:
+                if prefix not in loaded[guild]:
+                    loaded[guild].append(prefix)
+
+            for guild, prefixes in loaded.items():
+                prefixes.sort(reverse=True)
+                self.prefix[guild] = prefixes
+                self.prefix.move_to_end(guild)
+                self.rebuild(guild)
+            result.update(loaded)
+        self.evict()
+        return result
+
+    async def ensure_loaded(self, guild: int) -> List[str]:
+        """
+        Reads a guild through from the database on a cache miss
+        Returns its prefixes, hold on to them rather than looking them up
+        again after an await, the guild may be evicted meanwhile
+        """
+        prefixes = self.prefix.get(guild)
+        if prefixes is not None:
+            self.prefix.move_to_end(guild)
+            return prefixes
+
+        # Concurrent misses for one guild share a single query
+        task = self.loading.get(guild)
+        if task is None:
+            task = asyncio.ensure_future(self.load_guilds([guild]))
+            task.add_done_callback(lambda _: self.loading.pop(guild, None))
+            self.loading[guild] = task
+        loaded = await asyncio.shield(task)
+        return loaded[guild]
+
+    def apply_change(self, guild: int, prefix: str, action: str):
+        """Applies a change published by another process, guilds that
+        are not in memory will be read fresh when needed
+        """
+        prefixes = self.prefix.get(guild)
+        if prefixes is None:
+            return
 
-        return prefix_dict
+        if action == ADD and prefix not in prefixes:
+            prefixes.append(prefix)
+            prefixes.sort(reverse=True)
+        elif action == REMOVE and prefix in prefixes:
+            prefixes.remove(prefix)
+        self.rebuild(guild)
+
+    def forget(self, guild: int):
+        """Drops a guild from memory, like when the bot leaves it"""
+        self.prefix.pop(guild, None)
+        self.matchers.pop(guild, None)
+
+    def evict(self):
+        while len(self.prefix) > self.cache_size:
+            guild, _ = self.prefix.popitem(last=False)
+            self.matchers.pop(guild, None)
+
+    def rebuild(self, guild: int):
+        """Recompiles the matcher of a guild after its prefixes changed"""
+        prefixes = self.prefix.get(guild)
+        if prefixes and prefixes != [self.default]:
+            self.matchers[guild] = PrefixTrie(prefixes)
+        else:
+            self.matchers.pop(guild, None)
 
     async def add_prefix(self, guild: int, prefix: str):
         """Async method to add a prefix to db, and memory"""
+        await self.ensure_loaded(guild)
         await sqlite.execute("""
-        INSERT OR IGNORE INTO prefixes(guild, prefix)
+        INSERT OR IGNORE INTO prefixes(guildid, prefix)
         VALUES (?, ?);""", [guild, prefix])
 
-        if guild in self.prefix:
-            self.prefix[guild].append(prefix)
-        else:
-            self.prefix[guild] = [prefix, self.default]
-
-        # Sorts the prefixes to avoid conflic with sub-string
-        # based prefixes like ! and !!
-        self.prefix[guild].sort(reverse=True)
-
-    def get_prefix(
+        # Loaded again, the guild may have been evicted during the write
+        prefixes = await self.ensure_loaded(guild)
+        if prefix not in prefixes:
+            prefixes.append(prefix)
+
+        # Sorted for display, matching always picks the longest prefix
+        # so ! and !! don't conflict
+        prefixes.sort(reverse=True)
+        self.rebuild(guild)
+        await self.channel.publish(guild, prefix, ADD)
+
+    def base_matcher(self, bot: commands.Bot) -> PrefixTrie:
+        """The default prefix and bot mentions, shared by every guild"""
+        if bot.user is not None and self.base_user != bot.user.id:
+            self.base_user = bot.user.id
+            self.base = PrefixTrie([
+                self.default,
+                f"<@{bot.user.id}> ",
+                f"<@!{bot.user.id}> "
+            ])
+        return self.base
+
+    async def get_prefix(
         self, bot: commands.Bot, message: discord.Message
-    ) -> List[str]:
+    ) -> str:
         """
         Allows for bot mentions and default prefix in dms, else mentions
         and stored prefix to guild id
+
+        Returns the longest prefix the message starts with,
+        or the default prefix when none match, which then fails
+        to match in the command handler as well
         """
-        if message.guild is None:
-            return commands.when_mentioned_or(self.default)(bot, message)
+        content = message.content
+        match = self.base_matcher(bot).longest_match(content)
 
-        prefixes = self.fetch_prefix(message.guild.id)
-        return commands.when_mentioned_or(*prefixes)(bot, message)
+        if message.guild is not None:
+            await self.ensure_loaded(message.guild.id)
+            matcher = self.matchers.get(message.guild.id)
+            if matcher is not None:
+                custom = matcher.longest_match(content)
+                if custom is not None and (
+                        match is None or len(custom) > len(match)):
+                    match = custom
 
-    def fetch_prefix(self, guild: int) -> List[str]:
-        return self.prefix.get(guild, [self.default])
+        return match if match is not None else self.default
+
+    async def fetch_prefix(self, guild: int) -> List[str]:
+        return await self.ensure_loaded(guild)
 
     async def remove_prefix(self, guild: int, prefix: str):
         """Removes prefix from db and memory"""
-        if guild not in self.prefix:
-            return
-
-        if prefix not in self.prefix[guild]:
+        if prefix not in await self.ensure_loaded(guild):
             return
 
         try:
             await sqlite.execute("""
             DELETE FROM prefixes
-                WHERE guild = ? AND prefix = ?
+                WHERE guildid = ? AND prefix = ?
             """, [guild, prefix])
         except Exception as e:
             logger.exception(e)
 
-        if guild in self.prefix:
-            try:
-                self.prefix[guild].remove(prefix)
-            except ValueError:
-                logger.exception("Tried to remove non existing prefix")
+        # Loaded again, the guild may have been evicted during the delete
+        prefixes = await self.ensure_loaded(guild)
+        if prefix in prefixes:
+            prefixes.remove(prefix)
+        self.rebuild(guild)
+        await self.channel.publish(guild, prefix, REMOVE)
 
 
 class MyBot(commands.AutoShardedBot):
     def __init__(self, **kwargs: Union[str, Prefixer]):
+        profile = cache_profile.from_config(config)
         super().__init__(
             description=kwargs.pop("description", ""),
             case_insensitive=kwargs.pop("case", True),
             activity=kwargs.pop("activity", None),
-            command_prefix=kwargs.get("prefix").get_prefix
+            command_prefix=kwargs.get("prefix").get_prefix,
+            shard_ids=kwargs.pop("shard_ids", None),
+            shard_count=kwargs.pop("shard_count", None),
+            max_messages=profile.max_messages,
+            fetch_offline_members=profile.chunk_members
         )
+        self.cache_profile = profile
+        profile.apply(self._connection)
 
         self.sqlite = sqlite
         self.ENCRYPTKEY = kwargs.pop("enckey")
@@ -142,9 +260,43 @@ class MyBot(commands.AutoShardedBot):
         self.logger = logger
         self.blacklisted_channels = dict()
         self.prefixer = kwargs.pop("prefix")
+        self.cluster_id = kwargs.pop("cluster_id", None)
+        self.skipped_listeners = []
+        self.lazy_cogs = dict()
+        self.lazy_events = dict()
+        self.cog_timings = dict()
+        self.scheduler = Scheduler(self.loop)
+        self.scheduler.start()
+        self.bulk_actions = BulkActions(
+            self,
+            workers=config.getint("Moderation", "bulk_workers", fallback=4),
+            rate=config.getfloat("Moderation", "bulk_rate", fallback=20)
+        )
+        self.metrics = Instrumentation()
+        self.lag_probe = LoopLagProbe(
+            config.getfloat("Metrics", "lag_interval", fallback=0.5),
+            self.metrics.observe_lag
+        )
+        self.lag_probe.start()
+        self.metrics_server = None
+
+        port = config.getint("Metrics", "port", fallback=0)
+        if port:
+            # Every process of a cluster gets its own port
+            self.metrics_server = MetricsServer(
+                self.metrics,
+                config.get("Metrics", "host", fallback="127.0.0.1"),
+                port + (self.cluster_id or 0)
+            )
+            self.loop.create_task(self.metrics_server.start())
+
         self.loop.create_task(self.get_start_time())
         self.loop.create_task(self.load_extensions())
 
+        stats_queue = kwargs.pop("stats_queue", None)
+        if stats_queue is not None:
+            self.loop.create_task(self.report_stats(stats_queue))
+
     async def get_start_time(self):
         """
         Saves the current datetime object of when
@@ -153,6 +305,78 @@ class MyBot(commands.AutoShardedBot):
         await self.wait_until_ready()
         self.start_time = datetime.datetime.utcnow()
 
+    def cluster_stats(self) -> dict:
+        """Stats of this process, reported to the cluster supervisor"""
+        return {
+            "cluster": self.cluster_id,
+            "shards": sorted(self.shards),
+            "guilds": len(self.guilds),
+            "users": len(self.users),
+            "latency": self.latency,
+            "uptime": (
+                (datetime.datetime.utcnow() - self.start_time).total_seconds()
+                if self.start_time else 0
+            )
+        }
+
+    async def report_stats(self, queue: Any, interval: int = 30):
+        """Sends cluster_stats to the supervisor every interval seconds"""
+        await self.wait_until_ready()
+        while not self.is_closed():
+            try:
+                queue.put_nowait(self.cluster_stats())
+            except Exception:
+                logger.exception("Failed to report stats to the cluster")
+            await asyncio.sleep(interval)
+
+    def add_listener(self, func: Callable, name: str = None):
+        """
+        Registers a listener, unless its body is empty or its cog
+        did not subscribe to the event, those would only cost a task
+        per gateway event
+        """
+        name = name or func.__name__
+        cog = getattr(func, "__self__", None)
+        if is_noop(func) or not subscribed(cog, name):
+            self.skipped_listeners.append((name, func))
+            logger.debug(f"Skipped listener {func.__qualname__}")
+            return
+        super().add_listener(func, name)
+
+    def remove_listener(self, func: Callable, name: str = None):
+        name = name or func.__name__
+        try:
+            self.skipped_listeners.remove((name, func))
+        except ValueError:
+            super().remove_listener(func, name)
+
+    async def _run_event(self, coro, event_name, *args, **kwargs):
+        """Runs a single event handler, timing it"""
+        start = time.perf_counter()
+        try:
+            await super()._run_event(coro, event_name, *args, **kwargs)
+        finally:
+            self.metrics.observe_event(
+                event_name,
+                getattr(coro, "__qualname__", event_name),
+                time.perf_counter() - start
+            )
+
+    async def invoke(self, ctx: commands.Context):
+        """Invokes the command of ctx, timing it"""
+        if ctx.command is None:
+            return await super().invoke(ctx)
+
+        start = time.perf_counter()
+        try:
+            await super().invoke(ctx)
+        finally:
+            self.metrics.observe_command(
+                ctx.command.qualified_name,
+                ctx.command_failed,
+                time.perf_counter() - start
+            )
+
     async def load_extensions(self):
         """
         Gets the cogs directory relative to the script,
@@ -161,75 +385,160 @@ class MyBot(commands.AutoShardedBot):
         go through deeper levels of the dir
 
         Only adds the database cog if a database is present internally
-        then loads the rest of the scripts, exceptions can be put into
-        a directory or added as a continue condition
+        Modules are imported concurrently, then set up in order.
+        Cogs listed in lazy_cogs are loaded on first use of one of
+        their commands or events instead. Prints how long each cog took
         """
 
         # Credits to Lucy (looselystyled#7626)
         # For most of the logic behind this cog loader
-        cogs = Path("./cogs")
-        for cog in cogs.iterdir():
-            if cog.is_dir():
-                continue
-
-            elif cog.stem == "database" and not self.db:
-                continue
-
-            if cog.suffix == ".py" and cog.stem != "__init__":
-                path = ".".join(cog.with_suffix("").parts)
-                try:
-                    self.load_extension(path)
-                    print(f"{'Loaded...':<19} {path:<1}!")
-                    logger.info(f"Loaded {path}")
-                except Exception as e:
-                    logger.exception(f"Failed to load {path}")
-                    print(f"{'Failed to load...':<19} {path:<1}!")
-                    print(e, "\n")
-
-    def update(self, minute: int, method: Callable, *args: Any, **kwargs: Any):
-        """Runs a method every x minutes with passed args and kwargs"""
-
-        async def _update(minute: int, method: Callable, *args, **kwargs):
-            sec = minute * 60
-
-            # Checks if the method given is a courotine or not.
-            state = ASYNC if asyncio.iscoroutinefunction(method) else SYNC
-            while True:
-                await asyncio.sleep(sec)
-
-                if state == SYNC:
-                    try:
-                        method(*args, **kwargs)
-                    except Exception:
-                        logger.exception("Update raised an exception with "
-                                         f"method {method.__name__}\n"
-                                         f"args {args}, kwargs {kwargs}")
-
-                elif state == ASYNC:
-                    try:
-                        await method(*args, **kwargs)
-                    except Exception:
-                        logger.exception("Update raised an exception with "
-                                         f"method {method.__name__}\n"
-                                         f"args {args}, kwargs {kwargs}")
-
-        self.loop.create_task(_update(minute, method, *args, **kwargs))
+        start = time.perf_counter()
+        paths = cog_loader.discover(
+            Path("./cogs"), skip=() if self.db else ("database",))
+        lazy = {
+            cog.strip() for cog in
+            botconfig.get("lazy_cogs", fallback="").split(",")
+        }
+
+        eager = [path for path in paths if path.split(".")[-1] not in lazy]
+        timings = await cog_loader.import_all(
+            self.loop, eager,
+            botconfig.getint("import_workers", fallback=4)
+        )
+        for timing in timings:
+            if timing.error is None:
+                self.setup_extension(timing)
+            else:
+                logger.error(f"Failed to load {timing.path}",
+                             exc_info=timing.error)
+
+        for path in paths:
+            if path not in eager:
+                timing = cog_loader.CogTiming(path)
+                self.defer_extension(timing)
+                timings.append(timing)
+
+        self.cog_timings = {timing.path: timing for timing in timings}
+        print(cog_loader.format_timings(timings))
+        print(f"Loaded cogs in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    def setup_extension(self, timing: cog_loader.CogTiming):
+        """Loads an imported cog module, timing its setup"""
+        start = time.perf_counter()
+        try:
+            self.load_extension(timing.path)
+        except Exception as e:
+            timing.status, timing.error = "failed", e
+            logger.exception(f"Failed to load {timing.path}")
+        else:
+            timing.status = "loaded"
+            logger.info(f"Loaded {timing.path}")
+        timing.setup_time = time.perf_counter() - start
+
+    def defer_extension(self, timing: cog_loader.CogTiming):
+        """
+        Registers placeholder commands and events for a lazy cog,
+        which load it and then run the real thing
+        """
+        try:
+            names, events = cog_loader.triggers(timing.path)
+        except (OSError, SyntaxError) as e:
+            timing.status, timing.error = "failed", e
+            logger.exception(f"Failed to read {timing.path}")
+            return
+
+        async def load_and_invoke(ctx, *, arguments: str = None):
+            self.load_lazy(timing.path)
+            await self.process_commands(ctx.message)
+
+        stubs = []
+        for name in names:
+            if self.get_command(name) is None:
+                stub = commands.command(name=name, hidden=True)(
+                    load_and_invoke)
+                self.add_command(stub)
+                stubs.append(name)
+        for event in events:
+            self.lazy_events.setdefault(event, set()).add(timing.path)
+
+        self.lazy_cogs[timing.path] = (stubs, events)
+        timing.status = "lazy"
+
+    def load_lazy(self, path: str):
+        """Loads a lazy cog, replacing its placeholders"""
+        if path not in self.lazy_cogs:
+            return
+        stubs, events = self.lazy_cogs.pop(path)
+        for name in stubs:
+            self.remove_command(name)
+        for event in events:
+            paths = self.lazy_events[event]
+            paths.discard(path)
+            if not paths:
+                del self.lazy_events[event]
+
+        timing = self.cog_timings[path]
+        start = time.perf_counter()
+        try:
+            importlib.import_module(path)
+        except Exception as e:
+            timing.status, timing.error = "failed", e
+            logger.exception(f"Failed to load {path}")
+            return
+        finally:
+            timing.import_time = time.perf_counter() - start
+        self.setup_extension(timing)
+
+    def dispatch(self, event_name: str, *args: Any, **kwargs: Any):
+        # A lazy cog listening to this event is loaded before dispatching
+        if event_name in self.lazy_events:
+            for path in list(self.lazy_events[event_name]):
+                self.load_lazy(path)
+        super().dispatch(event_name, *args, **kwargs)
 
     async def logout(self):
         # Close other connections and tasks here like a database
         await super().logout()
+        await self.scheduler.close()
+        # Unfinished mass bans and kicks continue after the next start
+        await self.bulk_actions.close()
+        self.lag_probe.stop()
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        await self.prefixer.channel.close()
+        # Buffered log messages would be lost with the pool
+        events = self.get_cog("Events")
+        if events is not None:
+            try:
+                await events.close_log()
+            except Exception:
+                logger.exception("Failed to flush the message log")
+        await sqlite.close_pool()
+
 
+def run(shard_ids: List[int] = None, shard_count: int = None, **cluster):
+    """Loads configs needed to run the bot
 
-def run():
-    """Loads configs needed to run the bot"""
+    shard_ids and shard_count limit this process to some of the shards,
+    cluster takes the cluster_id and stats_queue set by cluster.py
+    """
 
     desc = botconfig.get("description")
     token = secrets["bot_token"]
     enc_key = config["Database"].get("encrypt_key").encode('ASCII')
+    cache_size = botconfig.getint("prefix_cache_size", fallback=50000)
+    channel = make_channel(
+        botconfig.get("prefix_sync", fallback="none"),
+        botconfig.getfloat("prefix_sync_interval", fallback=1.0)
+    )
+    prefixer = Prefixer(cache_size, channel)
     bot_kwargs = {
         "description": desc,
-        "prefix": Prefixer(),
-        "enckey": enc_key
+        "prefix": prefixer,
+        "enckey": enc_key,
+        "shard_ids": shard_ids,
+        "shard_count": shard_count,
+        **cluster
     }
 
     mybot = MyBot(**bot_kwargs)
@@ -237,20 +546,24 @@ def run():
     if not token or token == "none":
         logger.critical("No token given, add your token in config.ini!")
         print("No token given, add your token in config.ini!")
-        sys.exit(1)
+        sys.exit(EXIT_LOGIN_FAILURE)
 
     loop = asyncio.get_event_loop()
+    loop.run_until_complete(sqlite.open_pool())
+    loop.run_until_complete(channel.start(prefixer.apply_change))
+    exit_code = 1
     try:
         loop.run_until_complete(mybot.start(token))
     except discord.LoginFailure:
         logger.critical("Invalid token used!")
         print("Invalid token used!")
+        exit_code = EXIT_LOGIN_FAILURE
         loop.run_until_complete(mybot.logout())
     except KeyboardInterrupt:
         logger.warning("Bot was forcefully closed!")
         loop.run_until_complete(mybot.logout())
     finally:
-        sys.exit(1)
+        sys.exit(exit_code)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,227 @@
+# cluster.py
+#
+# Runs the bot as a cluster of processes, each owning a slice of the
+# shards, so event processing is spread over several cores.
+# The supervisor restarts workers that die, collects the log records
+# of every worker into the usual log file and aggregates their stats.
+#
+# Usage: python cluster.py   (configure the [Cluster] section first)
+
+import json
+import logging
+import multiprocessing
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+from queue import Empty
+from typing import Callable, Dict, List
+
+import bot
+from utils import database_manager as sqlite
+
+
+def split_shards(shard_count: int, processes: int) -> List[List[int]]:
+    """Splits the shard ids into contiguous, evenly sized slices"""
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    slices = []
+    start = 0
+    for i in range(processes):
+        end = start + size + (1 if i < extra else 0)
+        slices.append(list(range(start, end)))
+        start = end
+    return slices
+
+
+def worker_main(
+    cluster_id: int,
+    shard_ids: List[int],
+    shard_count: int,
+    log_queue: multiprocessing.Queue,
+    stats_queue: multiprocessing.Queue
+):
+    """Entry point of a worker process, runs the bot for some shards"""
+    # Log records go to the supervisor instead of the shared log file
+    bot.logger.removeHandler(bot.handler)
+    bot.logger.addHandler(QueueHandler(log_queue))
+
+    bot.run(
+        shard_ids=shard_ids,
+        shard_count=shard_count,
+        cluster_id=cluster_id,
+        stats_queue=stats_queue
+    )
+
+
+class Worker:
+    def __init__(self, cluster_id: int, shard_ids: List[int]):
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.process = None
+        self.restarts = 0
+        self.failures = 0
+        self.restart_at = 0.0
+        self.started_at = 0.0
+        self.stats = {}
+
+
+class Supervisor:
+    """
+    Starts one worker process per slice of shards and keeps them running
+
+    Workers that exit are restarted after restart_delay seconds, doubling
+    on every quick failure up to max_restart_delay. A worker exiting
+    because of a bad token stops the whole cluster, as restarting
+    would not help.
+    """
+
+    def __init__(
+        self,
+        shard_count: int,
+        processes: int,
+        restart_delay: float = 5.0,
+        max_restart_delay: float = 300.0,
+        stats_interval: float = 60.0,
+        target: Callable = worker_main
+    ):
+        context = multiprocessing.get_context("spawn")
+        self.context = context
+        self.shard_count = shard_count
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stats_interval = stats_interval
+        self.target = target
+        self.log_queue = context.Queue()
+        self.stats_queue = context.Queue()
+        self.workers = [
+            Worker(cluster_id, shard_ids)
+            for cluster_id, shard_ids
+            in enumerate(split_shards(shard_count, processes))
+        ]
+        self.logger = logging.getLogger("cluster")
+        self.running = False
+
+    def start_worker(self, worker: Worker):
+        worker.process = self.context.Process(
+            target=self.target,
+            name=f"cluster-{worker.cluster_id}",
+            args=(worker.cluster_id, worker.shard_ids, self.shard_count,
+                  self.log_queue, self.stats_queue),
+            daemon=True
+        )
+        worker.process.start()
+        worker.started_at = time.monotonic()
+        self.logger.info(
+            f"Started cluster {worker.cluster_id} "
+            f"with shards {worker.shard_ids}")
+
+    def check_worker(self, worker: Worker, now: float):
+        """Schedules and performs restarts of dead workers"""
+        if worker.process.is_alive():
+            return
+
+        if not worker.restart_at:
+            code = worker.process.exitcode
+            if code == bot.EXIT_LOGIN_FAILURE:
+                self.logger.critical(
+                    f"Cluster {worker.cluster_id} could not log in, "
+                    "stopping the cluster")
+                self.running = False
+                return
+
+            # Back off on workers that keep dying shortly after starting
+            if now - worker.started_at >= self.max_restart_delay:
+                worker.failures = 0
+            delay = min(
+                self.restart_delay * 2 ** worker.failures,
+                self.max_restart_delay)
+            worker.failures += 1
+            worker.restarts += 1
+            worker.restart_at = now + delay
+            self.logger.warning(
+                f"Cluster {worker.cluster_id} exited with {code}, "
+                f"restarting in {delay:.0f}s")
+
+        elif now >= worker.restart_at:
+            worker.restart_at = 0.0
+            self.start_worker(worker)
+
+    def collect_stats(self):
+        while True:
+            try:
+                stats = self.stats_queue.get_nowait()
+            except Empty:
+                return
+            self.workers[stats["cluster"]].stats = stats
+
+    def aggregate(self) -> Dict[str, object]:
+        """Totals over the last stats every worker reported"""
+        reported = [worker.stats for worker in self.workers if worker.stats]
+        latencies = [stats["latency"] for stats in reported]
+        return {
+            "processes": len(self.workers),
+            "alive": sum(
+                worker.process.is_alive() for worker in self.workers),
+            "restarts": sum(worker.restarts for worker in self.workers),
+            "shards": sum(len(stats["shards"]) for stats in reported),
+            "guilds": sum(stats["guilds"] for stats in reported),
+            "users": sum(stats["users"] for stats in reported),
+            "max_latency": max(latencies) if latencies else None
+        }
+
+    def run(self):
+        """Runs the cluster until interrupted or a worker can't log in"""
+        # Worker records are written by the supervisor's handler
+        listener = QueueListener(
+            self.log_queue, bot.handler, respect_handler_level=True)
+        bot.handler.setFormatter(logging.Formatter(
+            "%(asctime)s:%(processName)s:%(levelname)s:%(name)s: "
+            "%(message)s"))
+        self.logger.addHandler(bot.handler)
+        self.logger.setLevel(logging.INFO)
+        listener.start()
+
+        self.running = True
+        for worker in self.workers:
+            self.start_worker(worker)
+
+        next_report = time.monotonic() + self.stats_interval
+        try:
+            while self.running:
+                time.sleep(1)
+                now = time.monotonic()
+                for worker in self.workers:
+                    self.check_worker(worker, now)
+
+                self.collect_stats()
+                if now >= next_report:
+                    next_report = now + self.stats_interval
+                    self.logger.info(
+                        f"Cluster stats {json.dumps(self.aggregate())}")
+        except KeyboardInterrupt:
+            self.logger.warning("Cluster was forcefully closed!")
+        finally:
+            for worker in self.workers:
+                if worker.process.is_alive():
+                    worker.process.terminate()
+            for worker in self.workers:
+                worker.process.join(10)
+            listener.stop()
+
+
+if __name__ == "__main__":
+    config = bot.config
+    shard_count = config.getint("Cluster", "shard_count", fallback=0)
+    if not shard_count:
+        print("Set shard_count in the [Cluster] section of config.ini!")
+        sys.exit(1)
+
+    sqlite.make_sure_tables_exist()
+    Supervisor(
+        shard_count=shard_count,
+        processes=config.getint("Cluster", "processes", fallback=2),
+        restart_delay=config.getfloat(
+            "Cluster", "restart_delay", fallback=5.0),
+        stats_interval=config.getfloat(
+            "Cluster", "stats_interval", fallback=60.0)
+    ).run()
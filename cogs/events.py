@@ -1,61 +1,282 @@
 import asyncio
 import datetime
-from collections import OrderedDict as odict
-from typing import List
+import itertools
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
 
 import discord
-from Cryptodome.Cipher import AES
-from Cryptodome.Util import Padding
 from discord import *
 from discord import abc
 from discord.ext import commands
 
 from utils import database_manager as sqlite
-
-
+from utils import log_archive
+from utils.bulk_actions import ACTIONS
+from utils.listeners import subscribe
+from utils.loop_monitor import LoopLagProbe
+from utils.message_buffer import SPILL, LoggedMessage, MessageLogBuffer
+from utils.message_crypto import MessageCipher
+from utils.raid_detector import RAID_START, RaidDetector
+from utils.spam_filter import SpamFilter
+
+
+# Only these events are registered, filling in one of the template
+# listeners below also needs its event added here
+@subscribe(
+    "ready", "shard_ready", "message", "member_join",
+    "guild_join", "guild_remove"
+)
 class Events:
     def __init__(self, bot):
         self.bot = bot
         self.money_cooldown = commands.CooldownMapping.from_cooldown(
             1.0, 60.0, commands.BucketType.user
         )
-        self.aes = AES.new(self.bot.ENCRYPTKEY, AES.MODE_ECB)
-        self.log_chache = []
+        self.log_dump_job = None
+        self.raid_sweep_job = None
+        self.flush_lock = asyncio.Lock()
+        self.spill_lock = asyncio.Lock()
+        self.flush_pending = False
+        self.spill_tasks = set()
+
+        config = self.bot.config
+        self.cipher = MessageCipher(
+            self.bot.ENCRYPTKEY,
+            config.get("Database", "encrypt_mode", fallback="gcm"),
+            config.getboolean("Database", "legacy_ecb", fallback=False))
+        # Message log encryption runs in its own pool, in chunks
+        self.encrypt_pool = ThreadPoolExecutor(max_workers=config.getint(
+            "Logging", "encrypt_workers", fallback=2))
+        self.encrypt_chunk_size = config.getint(
+            "Logging", "encrypt_chunk_size", fallback=2000)
+        # Guilds without a preset of their own use the configured one
+        self.spam_filter = SpamFilter(
+            config.get("SpamFilter", "preset", fallback="off"),
+            config.getint("SpamFilter", "max_users", fallback=50000))
+        self.delete_spam = config.getboolean(
+            "SpamFilter", "delete", fallback=True)
+        self.raid_detector = RaidDetector(
+            joins=config.getint("RaidProtection", "joins", fallback=10),
+            window=config.getint("RaidProtection", "window", fallback=10),
+            young_joins=config.getint(
+                "RaidProtection", "young_joins", fallback=5),
+            young_age=config.getfloat(
+                "RaidProtection", "young_age", fallback=7 * 86400),
+            quiet=config.getfloat("RaidProtection", "quiet", fallback=120)
+        )
+        self.raid_lockdown = config.getboolean(
+            "RaidProtection", "lockdown", fallback=False)
+        self.raid_action = config.get(
+            "RaidProtection", "action", fallback="none").lower()
+        # Send permissions of @everyone per channel before a lockdown
+        self.lockdowns = {}  # type: Dict[int, Dict[int, Optional[bool]]]
+        # Tracks how long the event loop was blocked during the last flush
+        self.flush_lag = LoopLagProbe()
+
+        self.spill_path = Path(config.get(
+            "Logging", "spill_path", fallback="logs/messagelog.spill"))
+        # Optional segment files written next to the database on every flush
+        self.archive = config.getboolean(
+            "Logging", "archive", fallback=False)
+        self.archive_dir = Path(config.get(
+            "Logging", "archive_dir", fallback="logs/messagelog"))
+        self.archive_compression = config.get(
+            "Logging", "archive_compression", fallback="zlib")
+        self.archive_retention = config.getint(
+            "Logging", "archive_retention_days", fallback=0)
+        self.log_buffer = MessageLogBuffer(
+            max_entries=config.getint(
+                "Logging", "buffer_max_entries", fallback=50000),
+            max_bytes=config.getint(
+                "Logging", "buffer_max_bytes", fallback=32 * 1024 * 1024),
+            high_water=config.getfloat(
+                "Logging", "buffer_high_water", fallback=0.75),
+            overflow=config.get(
+                "Logging", "buffer_overflow", fallback="drop"),
+            on_high_water=self.request_flush,
+            on_spill=self.request_spill
+        )
 
-    def log_dump(self):
-        async def dump_method(cache: List[odict]):
-            """Pads and encrypts the contents of a message"""
-            args = []
-            for ord_d in cache:
-                if ord_d["content"]:
-                    message = Padding.pad(bytes(ord_d["content"], "utf-8"), 16)
-                    encr_msg = self.aes.encrypt(message)
+    def __unload(self):
+        """Writes out the remaining messages when the cog is unloaded"""
+        if self.log_dump_job is not None:
+            self.log_dump_job.cancel()
+        if self.raid_sweep_job is not None:
+            self.raid_sweep_job.cancel()
+        self.bot.loop.create_task(self.unload_log())
+
+    async def unload_log(self) -> None:
+        try:
+            await self.close_log()
+        finally:
+            self.encrypt_pool.shutdown(wait=False)
+
+    async def close_log(self) -> None:
+        """Waits for pending spills, then flushes the buffer and the
+        spill file, called on logout before the database closes
+        """
+        if self.spill_tasks:
+            await asyncio.wait(list(self.spill_tasks))
+        await self.flush_log()
+
+    def encrypt_chunk(self, chunk: List[LoggedMessage]) -> List[tuple]:
+        """Encrypts a chunk of messages into messagelog rows
+
+        Runs on the encrypt pool
+        """
+        contents = self.cipher.encrypt_batch(entry.content for entry in chunk)
+        return [
+            entry.row(content) for entry, content in zip(chunk, contents)
+        ]
+
+    async def encrypt_log(
+        self, cache: List[LoggedMessage]
+    ) -> List[List[tuple]]:
+        """Encrypts the cache in chunks, the loop only awaits the result"""
+        loop = asyncio.get_event_loop()
+        size = self.encrypt_chunk_size
+        return await asyncio.gather(*(
+            loop.run_in_executor(
+                self.encrypt_pool, self.encrypt_chunk, cache[i:i + size])
+            for i in range(0, len(cache), size)
+        ))
+
+    def write_spill(self, chunks: List[List[tuple]]) -> None:
+        """Appends chunks of encrypted rows to the spill file"""
+        self.spill_path.parent.mkdir(parents=True, exist_ok=True)
+        with self.spill_path.open("ab") as spill:
+            for rows in chunks:
+                pickle.dump(rows, spill, pickle.HIGHEST_PROTOCOL)
+
+    def read_spill(self) -> List[tuple]:
+        """Loads spilled rows, moving the spill file aside while flushing"""
+        flushing = self.spill_path.with_suffix(".flushing")
+        if self.spill_path.exists() and not flushing.exists():
+            self.spill_path.replace(flushing)
+
+        rows = []
+        if not flushing.exists():
+            return rows
+
+        with flushing.open("rb") as spill:
+            while True:
+                try:
+                    rows.extend(pickle.load(spill))
+                except EOFError:
+                    break
+        return rows
+
+    def remove_spill(self) -> None:
+        flushing = self.spill_path.with_suffix(".flushing")
+        if flushing.exists():
+            flushing.unlink()
+
+    async def spill_log(self, cache: List[LoggedMessage]) -> None:
+        """Encrypts an overflowing cache and writes it to disk"""
+        loop = asyncio.get_event_loop()
+        chunks = await self.encrypt_log(cache)
+        async with self.spill_lock:
+            await loop.run_in_executor(None, self.write_spill, chunks)
+
+    def request_spill(self, cache: List[LoggedMessage]) -> None:
+        task = self.bot.loop.create_task(self.spill_log(cache))
+        self.spill_tasks.add(task)
+        task.add_done_callback(self.spill_tasks.discard)
+
+    def request_flush(self) -> None:
+        """Called at the buffer's high water mark to flush early"""
+        if self.flush_pending:
+            return
+
+        self.flush_pending = True
+        self.bot.loop.create_task(self.flush_log())
+
+    async def flush_log(self) -> None:
+        """Writes all cached messages to the messagelog table
+
+        The buffer is swapped for an empty one before anything is awaited,
+        so on_message keeps buffering new messages during the flush.
+        Only one flush runs at a time, rows spilled to disk since
+        the last flush are written out with the buffered ones.
+        """
+        async with self.flush_lock, self.flush_lag:
+            self.flush_pending = False
+            cache = self.log_buffer.swap()
+
+            loop = asyncio.get_event_loop()
+            async with self.spill_lock:
+                spilled = await loop.run_in_executor(None, self.read_spill)
+            if not cache and not spilled:
+                return
+
+            chunks = await self.encrypt_log(cache)
+            rows = itertools.chain(spilled, *chunks)
+            if self.archive:
+                rows = list(rows)
+                await self.archive_log(rows)
+
+            try:
+                await sqlite.executemany("""
+                    INSERT OR IGNORE INTO messagelog(
+                        messageid,
+                        authorid,
+                        guildid,
+                        channelid,
+                        date,
+                        content
+                    ) VALUES (?, ?, ?, ?, ?, ?);
+                """, rows)
+            except Exception:
+                # Keeps the fresh messages for the next flush when spilling,
+                # the spill file being flushed is left in place
+                if self.log_buffer.overflow == SPILL:
+                    await self.spill_log(cache)
                 else:
-                    encr_msg = "No message"
-
-                ord_d["content"] = encr_msg
-                args.append(list(ord_d.values()))
-            # Loop end
-
-            # ===================================================
-            # | Example of database dumping, with postgresql
-            # ===================================================
-            # query = """
-            #    INSERT INTO messagelog(messageid, authorid, guildid, channelid, date, content)
-            #        VALUES($1, $2, $3, $4, $5, $6)
-            #    ON CONFLICT(messageid, authorid)
-            #        DO NOTHING"""
-            #
-            # # here self.bot.db is an pool from -> asyncpg.create_pool()
-            # async with self.bot.db.acquire() as connection:
-            #     async with connection.transaction():
-            #         await self.bot.db.executemany(query, args)
-            # ===================================================
-
-            # Clear cache for new messages
-            cache[:] = []
-
-        self.bot.update(5, dump_method, self.log_chache)
+                    self.log_buffer.dropped += len(cache)
+                raise
+
+            async with self.spill_lock:
+                await loop.run_in_executor(None, self.remove_spill)
+            self.log_buffer.flushed += len(cache) + len(spilled)
+
+        if self.flush_lag.max > 0.1:
+            self.bot.logger.warning(
+                f"Message log flush blocked the event loop for "
+                f"{self.flush_lag.max * 1000:.1f}ms")
+
+    def write_archive(self, rows: List[tuple]) -> None:
+        log_archive.write_segment(
+            self.archive_dir, rows, self.archive_compression)
+        if self.archive_retention:
+            before = datetime.datetime.utcnow() - datetime.timedelta(
+                days=self.archive_retention)
+            log_archive.prune_segments(self.archive_dir, before)
+
+    async def archive_log(self, rows: List[tuple]) -> None:
+        """Writes a flush as a segment file, failing here never stops
+        the flush from reaching the database
+        """
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, self.write_archive, rows)
+        except Exception:
+            self.bot.logger.exception("Failed to archive the message log")
+
+    def log_stats(self) -> dict:
+        """Message log counters, and the worst loop lag of the last flush"""
+        stats = self.log_buffer.stats()
+        stats["flush_lag_ms"] = self.flush_lag.max * 1000
+        return stats
+
+    def log_dump(self):
+        """Starts dumping the message cache to the database every 5 min"""
+        if self.log_dump_job is not None:
+            return
+
+        self.log_dump_job = self.bot.scheduler.every(
+            300, self.flush_log, name="message log flush", jitter=5)
 
     async def load_blacklisted_channels(self) -> None:
         """Loads all blacklisted channels into memory"""
@@ -71,6 +292,129 @@ class Events:
             return True
         return False
 
+    def is_spam(self, message: Message) -> bool:
+        """Runs the message through the spam filter of its guild
+        Moderators and bots are never flagged
+        """
+        author = message.author
+        if message.guild is None or author.bot:
+            return False
+
+        reason = self.spam_filter.check(
+            message.guild.id,
+            author.id,
+            self.bot.loop.time(),
+            message.content,
+            len(message.mentions) + len(message.role_mentions)
+            + message.mention_everyone
+        )
+        # Permissions are only resolved for the few flagged messages,
+        # webhook and system message authors are Users and never exempt
+        if reason is None or (
+            isinstance(author, Member)
+            and message.channel.permissions_for(author).manage_messages
+        ):
+            return False
+
+        self.bot.dispatch("spam", message, reason)
+        if self.delete_spam:
+            self.bot.loop.create_task(self.delete_message(message))
+        return True
+
+    async def delete_message(self, message: Message) -> None:
+        try:
+            await message.delete()
+        except (discord.Forbidden, discord.NotFound):
+            pass
+
+    async def lockdown(self, guild: Guild) -> None:
+        """Stops @everyone from sending messages in every text channel
+        the bot can manage, remembering the permission to restore
+        """
+        if guild.id in self.lockdowns:
+            return
+        saved = self.lockdowns[guild.id] = {}
+        everyone = guild.default_role
+
+        async def lock(channel: TextChannel) -> None:
+            overwrite = channel.overwrites_for(everyone)
+            if overwrite.send_messages is False:
+                return
+            saved[channel.id] = overwrite.send_messages
+            overwrite.send_messages = False
+            await channel.set_permissions(
+                everyone, overwrite=overwrite, reason="Raid lockdown")
+
+        # Every channel is its own rate limit bucket
+        await asyncio.gather(*(
+            lock(channel) for channel in guild.text_channels
+            if channel.permissions_for(guild.me).manage_roles
+        ), return_exceptions=True)
+
+    async def unlock(self, guild: Guild) -> None:
+        """Restores the channels changed by lockdown"""
+        saved = self.lockdowns.pop(guild.id, None)
+        if not saved:
+            return
+        everyone = guild.default_role
+
+        async def restore(channel: TextChannel, send: Optional[bool]):
+            overwrite = channel.overwrites_for(everyone)
+            overwrite.send_messages = send
+            await channel.set_permissions(
+                everyone,
+                overwrite=None if overwrite.is_empty() else overwrite,
+                reason="Raid lockdown lifted"
+            )
+
+        await asyncio.gather(*(
+            restore(channel, saved[channel.id])
+            for channel in guild.text_channels if channel.id in saved
+        ), return_exceptions=True)
+
+    async def start_raid(self, member: Member) -> None:
+        guild = member.guild
+        histogram = self.raid_detector.histogram(guild.id)
+        self.bot.logger.warning(
+            f"Raid detected in {guild.name} ({guild.id}), "
+            f"{sum(histogram)} joins within "
+            f"{self.raid_detector.window}s")
+        self.bot.dispatch("raid", guild, histogram)
+
+        if self.raid_lockdown:
+            await self.lockdown(guild)
+        if self.raid_action in ACTIONS:
+            state = self.raid_detector.raid(guild.id)
+            since = state.raid_since - self.raid_detector.window
+            young = [
+                user for user in self.raid_detector.joiners(guild.id, since)
+                if self.raid_detector.is_young(user)
+            ]
+            job = await self.bot.bulk_actions.create(
+                guild, None, None, self.raid_action, young,
+                "Raid protection")
+            self.bot.bulk_actions.start(job)
+
+    async def end_quiet_raids(self) -> None:
+        """Lifts the lockdowns of raids that went quiet"""
+        for guild_id in self.raid_detector.sweep():
+            guild = self.bot.get_guild(guild_id)
+            if guild is None:
+                self.lockdowns.pop(guild_id, None)
+                continue
+            self.bot.logger.info(f"Raid in {guild.name} ({guild_id}) ended")
+            self.bot.dispatch("raid_end", guild)
+            await self.unlock(guild)
+
+        # Guilds the detector forgot while locked down
+        for guild_id in list(self.lockdowns):
+            if self.raid_detector.raid(guild_id) is None:
+                guild = self.bot.get_guild(guild_id)
+                if guild is None:
+                    self.lockdowns.pop(guild_id, None)
+                else:
+                    await self.unlock(guild)
+
     async def on_connect(self) -> None:
         """Called when the client has successfully connected to Discord.
         This is not the same as the client being fully prepared, see on_ready() for that.
@@ -87,8 +431,14 @@ class Events:
         """
         # Logs in channels that are blacklsited from database
         await self.load_blacklisted_channels()
+        await self.spam_filter.load()
         # Starts a background task that dumpts a dict of messages tracked every 5 min
         self.log_dump()
+        if self.raid_sweep_job is None:
+            self.raid_sweep_job = self.bot.scheduler.every(
+                10, self.end_quiet_raids, name="raid sweep")
+        # Mass bans and kicks interrupted by the last shutdown
+        await self.bot.bulk_actions.resume()
 
         self.bot.app_info = await self.bot.application_info()
         print("-" * 10)
@@ -103,7 +453,11 @@ class Events:
 
         shard_id -- The shard ID that is ready.
         """
-        pass
+        # Only the guilds of shards this process serves are loaded
+        await self.bot.prefixer.load_guilds(
+            guild.id for guild in self.bot.guilds
+            if guild.shard_id == shard_id
+        )
 
     async def on_resumed(self) -> None:
         """Called when the client has resumed a session."""
@@ -131,15 +485,16 @@ class Events:
         # Logging setup with encryption
         # See log_dump for how to store.
 
-        self.log_chache.append(
-            odict(
-                messageid=message.id,
-                authorid=message.author.id,
-                guildid=message.guild.id,
-                channelid=message.channel.id,
-                date=datetime.datetime.utcnow(),
-                content=message.content
-            )
+        self.log_buffer.append(
+            LoggedMessage(
+                message.id,
+                message.author.id,
+                message.guild.id if message.guild else None,
+                message.channel.id,
+                datetime.datetime.utcnow(),
+                message.content
+            ),
+            len(message.content.encode("utf-8"))
         )
 
         # Add checks to be ignored by blacklists above this
@@ -148,6 +503,10 @@ class Events:
 
         # Add checks that respect the blacklist below this
 
+        # Spam ends here, listeners of on_spam get the message and reason
+        if self.is_spam(message):
+            return
+
         # Example of a pay pr message with a cooldown system
         bucket = self.money_cooldown.get_bucket(message)
         retry_after = bucket.update_rate_limit()
@@ -288,7 +647,17 @@ class Events:
 
         member -- The Member that joined.
         """
-        pass
+        if member.bot:
+            return
+        guild = member.guild
+        if self.raid_detector.join(guild.id, member.id) == RAID_START:
+            await self.start_raid(member)
+        elif (self.raid_action in ACTIONS
+              and self.raid_detector.raid(guild.id) is not None
+              and self.raid_detector.is_young(member.id)):
+            # Joined during a raid that already started
+            await self.bot.bulk_actions.act(
+                guild, self.raid_action, member.id, "Raid protection")
 
     async def on_member_remove(self, member: Member) -> None:
         """
@@ -319,7 +688,7 @@ class Events:
 
         guild -- The Guild that was joined.
         """
-        pass
+        await self.bot.prefixer.load_guilds([guild.id])
 
     async def on_guild_remove(self, guild: Guild) -> None:
         """
@@ -335,7 +704,7 @@ class Events:
 
         guild -- The Guild that got removed.
         """
-        pass
+        self.bot.prefixer.forget(guild.id)
 
     async def on_guild_update(self, before: Guild, after: Guild) -> None:
         """
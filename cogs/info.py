@@ -1,14 +1,41 @@
 import asyncio
 import datetime as dt
 import re
+from collections import defaultdict
+from typing import List
 
 import discord
 from discord.ext import commands
 
+from utils.reminders import Reminder, ReminderDispatcher
+
+REMINDER_TIME = re.compile(
+    r"((?P<days>\d+)d)?((?P<hours>\d+)h)?"
+    r"((?P<minutes>\d+)m)?((?P<seconds>\d+)s)?"
+)
+
 
 class Info:
     def __init__(self, bot):
         self.bot = bot
+        # Each cluster process handles the reminders of its own shards,
+        # DM reminders are left to the first one
+        self.reminders = ReminderDispatcher(
+            self.deliver_reminders,
+            shard_count=bot.shard_count if bot.shard_ids else None,
+            shards=bot.shard_ids,
+            dms=not bot.cluster_id
+        )
+        self.bot.loop.create_task(self.api_tasks())
+
+    async def api_tasks(self):
+        """Starts delivering reminders, the ones made before a restart too
+        """
+        await self.bot.wait_until_ready()
+        await self.reminders.start()
+
+    def __unload(self):
+        self.reminders.stop()
 
     @commands.command()
     async def ping(self, ctx):
@@ -27,7 +54,7 @@ class Info:
         await ctx.send(embed=embed)
 
     @commands.command()
-    async def remindme(self, ctx, time: str, message: str = None):
+    async def remindme(self, ctx, time: str, *, message: str = None):
         """remind_me <time> [message]
 
         Time units:
@@ -45,47 +72,93 @@ class Info:
         """
         await ctx.message.delete()
         message = message or "No message attached!"
-        pattern = re.compile(
-            r'((?P < days >\d+)d)?((?P < hours >\d+)h)?'
-            r'((?P < minutes >\d+)m)?((?P < seconds >\d+)s)?'
-        )
 
-        match = pattern.fullmatch(time)
-        if match:
-            kwargs = {
-                "days": int(match.group("days"))
-                if match.group("days") is not None else 0,
-                "hours": int(match.group("hours"))
-                if match.group("hours") is not None else 0,
-                "minutes": int(match.group("minutes"))
-                if match.group("minutes") is not None else 0,
-                "seconds": int(match.group("seconds"))
-                if match.group("seconds") is not None else 0,
-            }
-        else:
+        match = REMINDER_TIME.fullmatch(time)
+        if not match or not any(match.groups()):
             return
-        reminder_string = ""
-        reminder_string += f'{kwargs["days"]:g} days ' if kwargs.get(
-            "days") else ""
-        reminder_string += f'{kwargs["hours"]:g} hours ' if kwargs.get(
-            "hours") else ""
-        reminder_string += f'{kwargs["minutes"]:g} minutes ' if kwargs.get(
-            "minutes") else ""
-        reminder_string += f'{kwargs["seconds"]:g} seconds ' if kwargs.get(
-            "seconds") else ""
+        kwargs = {
+            unit: int(value) for unit, value in match.groupdict().items()
+            if value is not None
+        }
+        reminder_string = "".join(
+            f"{kwargs[unit]:g} {unit} "
+            for unit in ("days", "hours", "minutes", "seconds")
+            if kwargs.get(unit)
+        )
+
+        delta = dt.timedelta(**kwargs)
+        await self.reminders.add(
+            ctx.author.id,
+            ctx.channel.id,
+            ctx.guild.id if ctx.guild else None,
+            dt.datetime.utcnow() + delta,
+            message
+        )
         await ctx.send(f"""A reminder for {reminder_string}has been set\n
                         \r__Message:__
                         \r{message}""", delete_after=10)
-
-        delta = dt.timedelta(**kwargs)
-        sleeptime = delta.total_seconds()
-        await asyncio.sleep(sleeptime)
-
-        await ctx.send(f"It's been {sleeptime:g} seconds since "
-                       f"{ctx.author.mention} made this reminder:\n{message}")
         self.bot.logger.info(
             f"{str(ctx.author)}set a reminder for {reminder_string}")
 
+    async def deliver_reminders(
+        self, batch: List[Reminder]
+    ) -> List[Reminder]:
+        """Sends due reminders, one message per channel where possible
+        Returns the reminders that were sent or can't ever be sent
+        """
+        by_channel = defaultdict(list)
+        for reminder in batch:
+            channel = self.bot.get_channel(reminder.channelid)
+            if channel is None:
+                # The channel is gone, or it was a DM
+                channel = self.bot.get_user(reminder.userid)
+            by_channel[channel].append(reminder)
+
+        done = by_channel.pop(None, [])
+        if done:
+            self.bot.logger.warning(
+                f"Dropped {len(done)} reminders, "
+                f"their channel and user are gone")
+
+        channels = list(by_channel)
+        results = await asyncio.gather(*(
+            self.send_reminders(channel, by_channel[channel])
+            for channel in channels
+        ), return_exceptions=True)
+        for channel, result in zip(channels, results):
+            if isinstance(result, Exception):
+                # Kept for another try
+                self.bot.logger.error(f"Failed to send reminders: {result}")
+            else:
+                done.extend(by_channel[channel])
+        return done
+
+    async def send_reminders(
+        self, channel: discord.abc.Messageable, reminders: List[Reminder]
+    ) -> None:
+        """Falls back to the user's DMs when the channel refuses them"""
+        chunks = [""]
+        for reminder in reminders:
+            sleeptime = (reminder.due - reminder.created).total_seconds()
+            text = (f"It's been {sleeptime:g} seconds since "
+                    f"<@{reminder.userid}> made this reminder:\n"
+                    f"{reminder.message}\n")
+            if len(chunks[-1]) + len(text) > 2000:
+                chunks.append("")
+            chunks[-1] += text[:2000]
+
+        try:
+            for chunk in chunks:
+                await channel.send(chunk)
+        except (discord.Forbidden, discord.NotFound):
+            if isinstance(channel, discord.abc.User):
+                # Nowhere left to send them
+                return
+            for reminder in reminders:
+                user = self.bot.get_user(reminder.userid)
+                if user is not None:
+                    await self.send_reminders(user, [reminder])
+
 
 def setup(bot):
     bot.add_cog(Info(bot))
@@ -1,11 +1,31 @@
 import asyncio
-from datetime import datetime
+import re
+from datetime import datetime, timedelta
 from textwrap import dedent
+from typing import List
 
 import discord
 from discord.ext import commands
 
 from utils import database_manager as db
+from utils import message_log
+from utils.message_crypto import MessageCipher, decrypt_rows
+from utils.raid_detector import AGE_LABELS
+from utils.spam_filter import OFF, PRESETS
+from utils.strikes import (
+    BAN, KICK, MUTE, StrikeEngine, StrikeRule, parse_duration
+)
+from utils.warning_counts import WarningCounter
+
+
+class UserID(commands.Converter):
+    """A user id or mention, the user needn't be a member"""
+
+    async def convert(self, ctx, argument: str) -> int:
+        match = re.fullmatch(r"<@!?(\d+)>|(\d{15,21})", argument)
+        if match is None:
+            raise commands.BadArgument(f"{argument} is not a user id")
+        return int(match.group(1) or match.group(2))
 
 
 class Moderator:
@@ -14,6 +34,22 @@ class Moderator:
 
     def __init__(self, bot):
         self.bot = bot
+        self.cipher = MessageCipher(
+            self.bot.ENCRYPTKEY,
+            bot.config.get("Database", "encrypt_mode", fallback="gcm"),
+            bot.config.getboolean("Database", "legacy_ecb", fallback=False))
+        self.warnings = WarningCounter()
+        self.strike_engine = StrikeEngine(self.warnings)
+        self.expiry_job = bot.scheduler.every(
+            bot.config.getfloat(
+                "Moderation", "warning_expiry_interval", fallback=600),
+            self.strike_engine.expire,
+            name="warning expiry",
+            jitter=10
+        )
+
+    def __unload(self):
+        self.expiry_job.cancel()
 
     async def __local_check(self, ctx):
         return ctx.author.guild_permissions.administrator
@@ -29,10 +65,6 @@ class Moderator:
         prefix -- string to be used as a new prefix for the guild
         """
         await self.bot.prefixer.add_prefix(ctx.guild.id, prefix)
-        query = """
-        INSERT OR IGNORE INTO prefixes(guild, prefix)
-        VALUES (?, ?);"""
-        await db.execute(query, [ctx.guild.id, prefix])
         await ctx.message.add_reaction("👌")
         self.bot.logger.info(
             f"{str(ctx.author)} added {prefix} to {ctx.guild.name}"
@@ -44,7 +76,7 @@ class Moderator:
         Also fetches the default prefix in configs
         """
         guild = ctx.guild.id
-        prefixes = self.bot.prefixer.fetch_prefix(guild)
+        prefixes = await self.bot.prefixer.fetch_prefix(guild)
         prefixes = ", ".join(prefixes)
         await ctx.send(f"Prefixes available on this server are: `{prefixes}`")
 
@@ -54,7 +86,7 @@ class Moderator:
             await ctx.send("Can't delete default prefix!")
             return
 
-        if prefix in self.bot.prefixer.fetch_prefix(ctx.guild.id):
+        if prefix in await self.bot.prefixer.fetch_prefix(ctx.guild.id):
             await self.bot.prefixer.remove_prefix(ctx.guild.id, prefix)
             await ctx.message.add_reaction("👌")
             self.bot.logger.info(
@@ -140,9 +172,13 @@ class Moderator:
 
     @commands.command()
     async def cleartable(self, ctx, table: str):
-        await db.execute(
-            f"DELETE FROM {table} where guildid = ?;", [ctx.guild.id]
-        )
+        if table == "warnings":
+            await self.warnings.clear(ctx.guild.id)
+            self.strike_engine.forget_members({ctx.guild.id})
+        else:
+            await db.execute(
+                f"DELETE FROM {table} where guildid = ?;", [ctx.guild.id]
+            )
         await ctx.message.add_reaction("🔨")
         self.bot.logger.warning(
             f"{(ctx.author)} wiped data for the guild {ctx.guild.name}"
@@ -152,6 +188,9 @@ class Moderator:
     @commands.is_owner()
     async def droptable(self, ctx, table: str):
         await db.execute(f"DROP TABLE IF EXISTS {table}")
+        if table == "warnings":
+            self.warnings.forget()
+            self.strike_engine.forget_members()
         await ctx.message.add_reaction("🔨")
         self.bot.logger.warning(
             f"Owner dropped the table {table}, if it existed"
@@ -159,20 +198,17 @@ class Moderator:
 
     @commands.command()
     async def warn(self, ctx, user: discord.Member, *, reason: str = None):
-        await db.execute("""
-            INSERT INTO warnings(guildid, userid)
-                VALUES (?, ?);
-        """, [ctx.guild.id, user.id])
-
-        rows = await db.fetchall("""
-            SELECT id FROM warnings
-                WHERE userid = ? AND guildid = ?;
-        """, [user.id, ctx.guild.id])
+        count, action = await self.strike_engine.warn(
+            ctx.guild.id, user.id)
         if reason:
             warning = f"You have been warned in {ctx.guild.name}\n{reason}"
         else:
             warning = f"You have been warned in {ctx.guild.name}"
-        await user.send(f"{warning}, you have been warned {len(rows)} times")
+        try:
+            await user.send(f"{warning}, you have been warned {count} times")
+        except discord.HTTPException:
+            # DMs closed, the strike rule still applies
+            self.bot.logger.info(f"Couldn't DM the warning to {str(user)}")
 
         embed = discord.Embed()
         if reason:
@@ -184,14 +220,362 @@ class Moderator:
             icon_url=user.avatar_url
         )
 
-        if len(rows) > 1:
-            countstr = f"This is your {len(rows)}. warning"
+        if count > 1:
+            countstr = f"This is your {count}. warning"
         else:
             countstr = f"This is your first warning"
         embed.set_footer(text=countstr)
         embed.colour = 0xff0000
         await ctx.send(embed=embed)
 
+        if action is not None:
+            await self.punish(ctx, user, action)
+
+    async def punish(self, ctx, member: discord.Member, action: str):
+        """Applies the action of a strike rule the member reached"""
+        reason = f"Reached the {action} strike limit"
+        try:
+            if action == MUTE:
+                role = discord.utils.get(ctx.guild.roles, name="Muted")
+                if role is None:
+                    await ctx.send("There is no Muted role to give, "
+                                   "the mute command creates one")
+                    return
+                await member.add_roles(role, reason=reason)
+            elif action == KICK:
+                await member.kick(reason=reason)
+            elif action == BAN:
+                await ctx.guild.ban(
+                    member, reason=reason, delete_message_days=0)
+        except discord.HTTPException:
+            self.bot.logger.exception(
+                f"Strike {action} failed for {str(member)}")
+            await ctx.send(f"Failed to {action} {member.mention}")
+            return
+
+        await ctx.send(f"{member.mention} reached a strike limit, {reason}")
+        self.bot.logger.info(
+            f"{str(member)} got a strike {action} in {ctx.guild.name}")
+
+    @commands.group(name="strikes", invoke_without_command=True)
+    async def strikes_group(self, ctx):
+        """Lists the strike rules of the guild
+        A rule punishes members who get a number of warnings
+        within a time window
+        """
+        settings = await self.strike_engine.settings(ctx.guild.id)
+        embed = discord.Embed(title="Strike rules")
+        lines = [
+            f"{rule.warnings} warnings within "
+            f"{timedelta(seconds=rule.window)} -> {rule.action}"
+            for rule in sorted(
+                settings.rules, key=lambda rule: (rule.window, rule.warnings))
+        ]
+        embed.description = "\n".join(lines) or "No strike rules are set"
+        decay = (timedelta(seconds=settings.decay)
+                 if settings.decay else "never")
+        embed.set_footer(text=f"Warnings expire after: {decay}")
+        await ctx.send(embed=embed)
+
+    @strikes_group.command(name="add")
+    async def add_strike(
+        self, ctx, warnings: int, window: str, action: str
+    ):
+        """Adds a strike rule, window like 1d, 2h30m or 45s
+        action is one of mute, kick or ban
+
+        example: strikes add 3 1h mute
+        """
+        try:
+            rule = StrikeRule(
+                warnings, int(parse_duration(window).total_seconds()),
+                action.lower())
+        except ValueError as e:
+            return await ctx.send(str(e))
+
+        await self.strike_engine.add_rule(ctx.guild.id, rule)
+        await ctx.message.add_reaction("👌")
+
+    @strikes_group.command(name="remove", aliases=["delete"])
+    async def remove_strike(self, ctx, warnings: int, window: str):
+        try:
+            seconds = int(parse_duration(window).total_seconds())
+        except ValueError as e:
+            return await ctx.send(str(e))
+
+        await self.strike_engine.remove_rule(
+            ctx.guild.id, warnings, seconds)
+        await ctx.message.add_reaction("👌")
+
+    @strikes_group.command(name="decay")
+    async def strike_decay(self, ctx, after: str):
+        """Deletes warnings once they are older than after,
+        0 keeps them forever
+        """
+        try:
+            seconds = (0 if after == "0"
+                       else int(parse_duration(after).total_seconds()))
+        except ValueError as e:
+            return await ctx.send(str(e))
+
+        await self.strike_engine.set_decay(ctx.guild.id, seconds)
+        await ctx.message.add_reaction("👌")
+
+    @commands.command(name="spamfilter")
+    async def spam_filter(self, ctx, preset: str = None):
+        """Shows or sets the spam filter preset of the guild
+        One of off, relaxed, normal or strict
+
+        example: spamfilter strict
+        """
+        events = self.bot.get_cog("Events")
+        if events is None:
+            return await ctx.send("The spam filter is not loaded")
+        spam_filter = events.spam_filter
+
+        if preset is None:
+            current = spam_filter.preset(ctx.guild.id)
+            name = current.name if current else OFF
+            presets = ", ".join([OFF, *PRESETS])
+            return await ctx.send(
+                f"Spam filter preset: {name}\nAvailable: {presets}")
+
+        try:
+            await spam_filter.set_preset(ctx.guild.id, preset.lower())
+        except ValueError as e:
+            return await ctx.send(str(e))
+        await ctx.message.add_reaction("👌")
+
+    @commands.group(name="raid", invoke_without_command=True)
+    async def raid_group(self, ctx):
+        """Shows the joins of the last seconds by account age,
+        and whether the guild is being raided
+        """
+        events = self.bot.get_cog("Events")
+        if events is None:
+            return await ctx.send("Raid protection is not loaded")
+        detector = events.raid_detector
+
+        histogram = detector.histogram(ctx.guild.id)
+        embed = discord.Embed(title="Raid protection")
+        embed.description = "\n".join(
+            f"`{label:>5}` {count}"
+            for label, count in zip(AGE_LABELS, histogram))
+        state = detector.raid(ctx.guild.id)
+        if state is not None:
+            since = datetime.utcfromtimestamp(state.raid_since)
+            embed.add_field(
+                name="Raid",
+                value=f"Since {since:%H:%M:%S} UTC, {state.raid_joins} joins")
+        if ctx.guild.id in events.lockdowns:
+            embed.add_field(name="Lockdown", value="Active")
+        embed.set_footer(text=f"Joins within {detector.window}s")
+        await ctx.send(embed=embed)
+
+    @raid_group.command(name="lockdown")
+    @commands.bot_has_permissions(manage_roles=True)
+    async def raid_lockdown(self, ctx):
+        """Stops @everyone from talking until raid end"""
+        events = self.bot.get_cog("Events")
+        if events is None:
+            return await ctx.send("Raid protection is not loaded")
+        await events.lockdown(ctx.guild)
+        await ctx.message.add_reaction("🔒")
+
+    @raid_group.command(name="end")
+    async def raid_end(self, ctx):
+        """Ends the raid and lifts the lockdown"""
+        events = self.bot.get_cog("Events")
+        if events is None:
+            return await ctx.send("Raid protection is not loaded")
+        events.raid_detector.end(ctx.guild.id)
+        await events.unlock(ctx.guild)
+        await ctx.message.add_reaction("🔓")
+
+    @raid_group.command(name="ban", aliases=["kick"])
+    async def raid_punish(self, ctx, minutes: float = 10.0):
+        """Bans, or kicks with raid kick, everyone who joined
+        within the last minutes
+
+        example: raid ban 5
+        """
+        events = self.bot.get_cog("Events")
+        if events is None:
+            return await ctx.send("Raid protection is not loaded")
+        action = ctx.invoked_with
+        permissions = ctx.guild.me.guild_permissions
+        if not (permissions.ban_members if action == "ban"
+                else permissions.kick_members):
+            raise commands.BotMissingPermissions([f"{action}_members"])
+
+        since = datetime.now().timestamp() - minutes * 60
+        users = [
+            user for user in events.raid_detector.joiners(ctx.guild.id, since)
+            if user != ctx.author.id
+        ]
+        await self.mass_action(
+            ctx, action, users, f"Raid cleanup by {ctx.author}")
+
+    def is_protected(self, ctx, user: int) -> bool:
+        """
+        Staff, bots and members ranking at or above the invoker
+        are never part of a mass action
+        """
+        if user in (ctx.author.id, ctx.guild.owner_id, ctx.me.id):
+            return True
+        member = ctx.guild.get_member(user)
+        if member is None:
+            return False
+        permissions = member.guild_permissions
+        return (
+            member.bot
+            or permissions.administrator
+            or permissions.ban_members
+            or permissions.manage_messages
+            or (ctx.author.id != ctx.guild.owner_id
+                and member.top_role >= ctx.author.top_role)
+        )
+
+    async def mass_action(
+        self, ctx, action: str, users: List[int], reason: str = None
+    ) -> None:
+        """Stores and starts a bulk job, its progress is shown in ctx"""
+        targets = [user for user in users if not self.is_protected(ctx, user)]
+        skipped = len(users) - len(targets)
+        if skipped:
+            await ctx.send(f"Leaving out {skipped} moderators, bots "
+                           f"and members ranking at or above you")
+        users = targets
+        if not users:
+            return await ctx.send("Nobody to act on")
+
+        job = await self.bot.bulk_actions.create(
+            ctx.guild, ctx.channel, ctx.author, action, users,
+            reason or f"Mass {action} by {str(ctx.author)}")
+        self.bot.bulk_actions.start(job)
+        self.bot.logger.info(
+            f"{str(ctx.author)} started a mass {action} of {len(users)} "
+            f"users in {ctx.guild.name} (job {job.id})")
+
+    async def log_authors(
+        self, ctx, channel: discord.TextChannel, minutes: float, text: str
+    ) -> List[int]:
+        """
+        Members who wrote in channel within the last minutes,
+        only those whose messages contain text when given
+        """
+        events = self.bot.get_cog("Events")
+        if events is not None:
+            # Messages still in the buffer aren't in the database yet
+            await events.flush_log()
+
+        rows = await message_log.since(
+            channel.id, datetime.utcnow() - timedelta(minutes=minutes))
+        if text:
+            loop = asyncio.get_event_loop()
+            rows = await loop.run_in_executor(
+                None, decrypt_rows, self.cipher, rows)
+            text = text.lower()
+            rows = [row for row in rows if text in (row[5] or "").lower()]
+        return list(dict.fromkeys(row[1] for row in rows))
+
+    @commands.group(invoke_without_command=True)
+    @commands.bot_has_permissions(ban_members=True)
+    async def massban(
+        self, ctx, users: commands.Greedy[UserID], *, reason: str = None
+    ):
+        """Bans every user id or mention given, members or not
+        Progress is shown in a message that keeps updating
+
+        example: massban 1234 5678 @someone spam bots
+        """
+        await self.mass_action(ctx, BAN, users, reason)
+
+    @massban.command(name="log")
+    @commands.bot_has_permissions(ban_members=True)
+    async def massban_log(
+        self, ctx, channel: discord.TextChannel, minutes: float,
+        *, text: str = None
+    ):
+        """Bans everyone who wrote in channel within the last minutes,
+        only those whose messages contain text when given
+
+        example: massban log #general 10 free nitro
+        """
+        users = await self.log_authors(ctx, channel, minutes, text)
+        await self.mass_action(ctx, BAN, users)
+
+    @commands.group(invoke_without_command=True)
+    @commands.bot_has_permissions(kick_members=True)
+    async def masskick(
+        self, ctx, users: commands.Greedy[UserID], *, reason: str = None
+    ):
+        """Kicks every member id or mention given
+
+        example: masskick 1234 5678 @someone raid
+        """
+        await self.mass_action(ctx, KICK, users, reason)
+
+    @masskick.command(name="log")
+    @commands.bot_has_permissions(kick_members=True)
+    async def masskick_log(
+        self, ctx, channel: discord.TextChannel, minutes: float,
+        *, text: str = None
+    ):
+        """Kicks everyone who wrote in channel within the last minutes,
+        only those whose messages contain text when given
+
+        example: masskick log #general 10 free nitro
+        """
+        users = await self.log_authors(ctx, channel, minutes, text)
+        await self.mass_action(ctx, KICK, users)
+
+    @commands.command(name="massstop")
+    async def mass_stop(self, ctx, job: int):
+        """Stops a mass ban or kick for good, by the job number
+        shown in its progress message
+        """
+        running = self.bot.bulk_actions.jobs.get(job)
+        if running is None or running.guildid != ctx.guild.id:
+            return await ctx.send(f"No job {job} is running here")
+        await self.bot.bulk_actions.stop(job)
+        await ctx.message.add_reaction("👌")
+
+    @commands.command(name="messages")
+    async def fetch_messages(
+        self, ctx, user: discord.Member, amount: int = 10, cursor: str = None
+    ):
+        """Shows the last logged messages of a member, newest first
+
+        user   -- member to look up
+        amount -- messages per page, at most 25
+        cursor -- continues from the page that handed out this cursor
+        """
+        try:
+            position = message_log.decode_cursor(cursor)
+        except ValueError:
+            return await ctx.send("That cursor is not valid!")
+
+        rows, position = await message_log.by_author(
+            ctx.guild.id, user.id, max(1, min(amount, 25)), position
+        )
+        rows = decrypt_rows(self.cipher, rows)
+
+        embed = discord.Embed(title=f"Logged messages of {str(user)}")
+        lines = []
+        for _, _, _, channelid, date, content in rows:
+            channel = ctx.guild.get_channel(channelid)
+            lines.append(
+                f"`{date:%d.%m.%y %H:%M}` #{channel}: {content or ''}"[:200]
+            )
+        embed.description = "\n".join(lines) or "No logged messages found."
+
+        if position is not None:
+            embed.set_footer(
+                text=f"Next page: {message_log.encode_cursor(position)}"
+            )
+        await ctx.send(embed=embed)
+
     @commands.command()
     @commands.bot_has_permissions(kick_members=True)
     async def kick(self, ctx, to_kick: discord.Member, *, reason=None):
@@ -201,7 +585,6 @@ class Moderator:
                 "You've been kicked from "
                 f"{ctx.guild.name} by {str(ctx.author)}"
             )
-            await asyncio.sleep(0.2)
         except discord.Forbidden:
             pass
 
@@ -227,7 +610,6 @@ class Moderator:
                     "You've been banned from "
                     f"{ctx.guild.name} by {str(ctx.author)}"
                 )
-                await asyncio.sleep(0.2)
             except discord.Forbidden:
                 pass
         except Exception:
@@ -291,7 +673,6 @@ class Moderator:
 
         try:
             await to_ban.send(embed=discord.Embed(description=msg))
-            await asyncio.sleep(0.2)
         except discord.Forbidden:
             pass
 
@@ -0,0 +1,80 @@
+import discord
+from discord.ext import commands
+
+
+class Owner:
+    """Diagnostics only the bot owner can see
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    async def __local_check(self, ctx):
+        return await self.bot.is_owner(ctx.author)
+
+    @staticmethod
+    def _table(rows) -> str:
+        lines = [f"{'name':<34} {'calls':>7} {'p50ms':>7} {'p99ms':>7}"]
+        for name, histogram in rows:
+            lines.append(
+                f"{name[:34]:<34} {histogram.count:>7} "
+                f"{histogram.quantile(0.5) * 1000:>7.2f} "
+                f"{histogram.quantile(0.99) * 1000:>7.2f}"
+            )
+        return "```\n" + "\n".join(lines) + "\n```"
+
+    @commands.command()
+    async def stats(self, ctx, amount: int = 10):
+        """Shows the event handlers and commands with the most time spent,
+        and how late the event loop has been running
+
+        amount -- how many handlers and commands to list, at most 12
+        """
+        # Embed fields hold 1024 characters
+        amount = max(1, min(amount, 12))
+        metrics = self.bot.metrics
+        lag = metrics.loop_lag
+
+        embed = discord.Embed(title="Latency stats")
+        embed.description = (
+            f"Loop lag p50 {lag.quantile(0.5) * 1000:.2f}ms, "
+            f"p99 {lag.quantile(0.99) * 1000:.2f}ms, "
+            f"max {lag.max * 1000:.2f}ms over {lag.count} samples"
+        )
+        embed.add_field(
+            name="Event handlers",
+            value=self._table(metrics.slowest(metrics.events, amount)),
+            inline=False
+        )
+        embed.add_field(
+            name="Commands",
+            value=self._table(metrics.slowest(metrics.commands, amount)),
+            inline=False
+        )
+        await ctx.send(embed=embed)
+
+    @commands.command()
+    async def jobs(self, ctx):
+        """Shows every scheduled job, when it runs next
+        and how long its last run took
+        """
+        scheduler = self.bot.scheduler
+        now = scheduler.loop.time()
+        lines = [f"{'job':<24} {'every':>7} {'next in':>8} {'last ms':>8} "
+                 f"{'runs':>6} {'skip':>5} {'fail':>5}"]
+        for job in sorted(scheduler.jobs.values(), key=lambda j: j.next_run):
+            last = (f"{job.last_duration * 1000:.1f}"
+                    if job.last_duration is not None else "-")
+            lines.append(
+                f"{job.name[:24]:<24} {job.interval:>6g}s "
+                f"{job.next_run - now:>7.1f}s {last:>8} "
+                f"{job.runs:>6} {job.skipped:>5} {job.failures:>5}"
+            )
+        if len(lines) == 1:
+            await ctx.send("No jobs are scheduled")
+            return
+        await ctx.send("```\n" + "\n".join(lines[:26]) + "\n```")
+
+
+def setup(bot):
+    bot.add_cog(Owner(bot))
@@ -1,8 +1,6 @@
 import discord
 from discord.ext import commands
 
-from emoji import UNICODE_EMOJI as emoji
-
 
 class MyError(Exception):
     pass
@@ -15,6 +13,8 @@ class Test:
 
     @commands.command()
     async def repeat(self, ctx, *, arg):
+        # emoji takes a while to import, only needed here
+        from emoji import UNICODE_EMOJI as emoji
         print(arg)
         await ctx.send(list(emoji.keys())[10:])
 
@@ -0,0 +1,308 @@
+# bulk_actions.py
+#
+# Mass bans and kicks that survive restarts.
+# A job and its targets are rows in bulk_jobs and bulk_targets. A few
+# workers per job work off the pending targets, every request taking a
+# token from a limiter shared by all jobs, which keeps them well below
+# the global rate limit. Per route buckets are left to discord.py, it
+# holds a lock per bucket for every request and waits out exhausted
+# buckets, so bans in one guild go out back to back while the workers
+# keep the next ones queued. Progress is written back in batches and
+# shown in one message that is edited as the job goes, a job
+# interrupted by a restart continues with the targets still pending.
+
+import asyncio
+import datetime
+import logging
+import time
+from typing import Dict, Iterable, List, Optional
+
+import discord
+
+from utils import database_manager as db
+from utils.strikes import BAN, KICK
+
+logger = logging.getLogger("discord")
+
+ACTIONS = (BAN, KICK)
+
+PENDING = 0
+DONE = 1
+FAILED = 2
+
+COLUMNS = "id, guildid, channelid, authorid, action, reason"
+
+
+class RateLimiter:
+    """Token bucket, `rate` acquisitions per second, `burst` at once"""
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.tokens = 1.0
+                self.updated = time.monotonic()
+            self.tokens -= 1
+
+
+class BulkJob:
+    __slots__ = (
+        "id", "guildid", "channelid", "authorid", "action", "reason",
+        "total", "done", "failed", "message", "stopped"
+    )
+
+    def __init__(
+        self,
+        id: int,
+        guildid: int,
+        channelid: Optional[int],
+        authorid: Optional[int],
+        action: str,
+        reason: Optional[str]
+    ):
+        self.id = id
+        self.guildid = guildid
+        self.channelid = channelid
+        self.authorid = authorid
+        self.action = action
+        self.reason = reason
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        # The progress message, sent on the first report
+        self.message = None  # type: Optional[discord.Message]
+        self.stopped = False
+
+    def progress(self, finished: bool = False) -> str:
+        if finished:
+            verb = "Banned" if self.action == BAN else "Kicked"
+            return (f"{verb} {self.done} of {self.total} users, "
+                    f"{self.failed} failed (job {self.id})")
+        verb = "Banning" if self.action == BAN else "Kicking"
+        return (f"{verb} users: {self.done + self.failed}/{self.total}, "
+                f"{self.failed} failed (job {self.id})")
+
+
+class BulkActions:
+    """
+    Runs mass bans and kicks, `workers` requests at a time per job
+    and at most `rate` requests per second over all jobs
+    """
+
+    def __init__(
+        self,
+        bot,
+        workers: int = 4,
+        rate: float = 20.0,
+        progress_interval: float = 2.0
+    ):
+        self.bot = bot
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self.progress_interval = progress_interval
+        self.jobs = {}  # type: Dict[int, BulkJob]
+        self.tasks = {}  # type: Dict[int, asyncio.Task]
+
+    async def act(
+        self, guild: discord.Guild, action: str, user: int, reason: str
+    ) -> bool:
+        """Bans or kicks a single user by id, False when it failed"""
+        await self.limiter.acquire()
+        try:
+            if action == BAN:
+                await guild.ban(discord.Object(id=user),
+                                reason=reason, delete_message_days=1)
+            else:
+                await guild.kick(discord.Object(id=user), reason=reason)
+        except discord.HTTPException:
+            # Not a member, above the bot, or retried out by discord.py
+            return False
+        return True
+
+    async def create(
+        self,
+        guild: discord.Guild,
+        channel: Optional[discord.abc.Messageable],
+        author: Optional[discord.abc.User],
+        action: str,
+        users: Iterable[int],
+        reason: str = None
+    ) -> BulkJob:
+        """Stores a job, raises ValueError for unknown actions"""
+        if action not in ACTIONS:
+            raise ValueError(f"Unknown action {action}")
+        users = list(dict.fromkeys(users))
+        job = BulkJob(
+            None, guild.id, channel.id if channel else None,
+            author.id if author else None, action, reason)
+        job.id = await db.insert(f"""
+            INSERT INTO bulk_jobs({COLUMNS}, created)
+                VALUES (NULL, ?, ?, ?, ?, ?, ?);
+        """, [job.guildid, job.channelid, job.authorid, action, reason,
+              datetime.datetime.utcnow()])
+        await db.executemany("""
+            INSERT OR IGNORE INTO bulk_targets(jobid, userid, status)
+                VALUES (?, ?, ?);
+        """, [(job.id, user, PENDING) for user in users])
+        job.total = len(users)
+        return job
+
+    def start(self, job: BulkJob) -> asyncio.Task:
+        task = self.tasks.get(job.id)
+        if task is None:
+            task = self.tasks[job.id] = asyncio.ensure_future(self._run(job))
+            self.jobs[job.id] = job
+        return task
+
+    def _serves(self, guild: int) -> bool:
+        """Whether the guild is on one of the shards of this process"""
+        shards = getattr(self.bot, "shards", None)
+        if not shards or not self.bot.shard_count:
+            return True
+        return (guild >> 22) % self.bot.shard_count in shards
+
+    async def resume(self) -> int:
+        """
+        Restarts the unfinished jobs of the guilds this process serves,
+        returns how many there were
+        """
+        rows = await db.fetchall(f"""
+            SELECT {COLUMNS} FROM bulk_jobs
+                WHERE finished IS NULL;
+        """)
+        resumed = 0
+        for row in rows:
+            # Jobs of other cluster processes are theirs to resume,
+            # _run finishes those of guilds this process has left
+            if row[0] in self.tasks or not self._serves(row[1]):
+                continue
+            job = BulkJob(*row)
+            counts = dict(await db.fetchall("""
+                SELECT status, COUNT(*) FROM bulk_targets
+                    WHERE jobid = ?
+                    GROUP BY status;
+            """, [job.id]))
+            job.total = sum(counts.values())
+            job.done = counts.get(DONE, 0)
+            job.failed = counts.get(FAILED, 0)
+            self.start(job)
+            resumed += 1
+        return resumed
+
+    async def stop(self, jobid: int) -> bool:
+        """Stops a job for good, False when it isn't running"""
+        job = self.jobs.get(jobid)
+        if job is None:
+            return False
+        job.stopped = True
+        task = self.tasks[jobid]
+        task.cancel()
+        await asyncio.wait([task])
+        return True
+
+    async def close(self) -> None:
+        """Interrupts every job, they resume on the next start"""
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+
+    async def _run(self, job: BulkJob) -> None:
+        results = []  # type: List[tuple]
+        workers = []
+        try:
+            rows = await db.fetchall("""
+                SELECT userid FROM bulk_targets
+                    WHERE jobid = ? AND status = ?;
+            """, [job.id, PENDING])
+            guild = self.bot.get_guild(job.guildid)
+            if guild is None:
+                if not self._serves(job.guildid):
+                    # Left for the process that serves the guild
+                    return
+                logger.warning(f"Bulk job {job.id} dropped, "
+                               f"guild {job.guildid} is gone")
+                return await self._finish(job)
+
+            # Workers share the iterator, each target is taken once
+            targets = iter([row[0] for row in rows])
+
+            async def work() -> None:
+                for user in targets:
+                    ok = await self.act(guild, job.action, user, job.reason)
+                    if ok:
+                        job.done += 1
+                    else:
+                        job.failed += 1
+                    results.append((DONE if ok else FAILED, job.id, user))
+
+            workers = [
+                asyncio.ensure_future(work())
+                for _ in range(min(self.workers, len(rows)))
+            ]
+            pending = set(workers)
+            while pending:
+                _, pending = await asyncio.wait(
+                    pending, timeout=self.progress_interval)
+                await self._save(results)
+                await self._report(job)
+            for worker in workers:
+                # Raises what a worker failed with
+                worker.result()
+            await self._finish(job)
+        except asyncio.CancelledError:
+            for worker in workers:
+                worker.cancel()
+            await self._save(results)
+            if job.stopped:
+                await self._finish(job)
+            raise
+        except Exception:
+            logger.exception(f"Bulk job {job.id} failed, resumes on restart")
+            await self._save(results)
+        finally:
+            self.tasks.pop(job.id, None)
+            self.jobs.pop(job.id, None)
+
+    async def _save(self, results: List[tuple]) -> None:
+        if not results:
+            return
+        batch = results[:]
+        del results[:len(batch)]
+        await db.executemany("""
+            UPDATE bulk_targets SET status = ?
+                WHERE jobid = ? AND userid = ?;
+        """, batch)
+
+    async def _finish(self, job: BulkJob) -> None:
+        await db.executemany("""
+            UPDATE bulk_jobs SET finished = ?
+                WHERE id = ?;
+        """, [(datetime.datetime.utcnow(), job.id)])
+        await self._report(job, finished=True)
+
+    async def _report(self, job: BulkJob, finished: bool = False) -> None:
+        """Sends or edits the progress message of the job"""
+        channel = self.bot.get_channel(job.channelid)
+        if channel is None:
+            return
+        text = job.progress(finished)
+        try:
+            if job.message is None:
+                job.message = await channel.send(text)
+            elif job.message.content != text:
+                await job.message.edit(content=text)
+        except discord.HTTPException:
+            logger.warning(f"Couldn't report progress of bulk job {job.id}")
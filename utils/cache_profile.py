@@ -0,0 +1,118 @@
+# cache_profile.py
+#
+# How much of the gateway state MyBot keeps in memory, read from the
+# [Cache] section of config.ini. A profile sets the defaults,
+# every option can still be overridden on its own.
+#
+# discord.py has no gateway intents, events of a disabled category
+# still arrive over the websocket, but they are dropped before being
+# parsed, so they neither update the cache nor reach any listener.
+
+import configparser
+from typing import FrozenSet
+
+# Gateway events by category, the categories that can be switched off
+EVENT_CATEGORIES = {
+    "typing": ("TYPING_START",),
+    "presences": ("PRESENCE_UPDATE",),
+    "reactions": (
+        "MESSAGE_REACTION_ADD",
+        "MESSAGE_REACTION_REMOVE",
+        "MESSAGE_REACTION_REMOVE_ALL",
+    ),
+    "message_edits": ("MESSAGE_UPDATE",),
+    "pins": ("CHANNEL_PINS_UPDATE",),
+    "voice": ("VOICE_STATE_UPDATE",),
+    "integrations": ("GUILD_INTEGRATIONS_UPDATE", "WEBHOOKS_UPDATE"),
+}
+
+PROFILES = {
+    # Everything discord.py caches by default
+    "full": {
+        "max_messages": 5000,
+        "chunk_members": True,
+        "events": "all",
+    },
+    # Members are only known once they talk or join
+    "lean": {
+        "max_messages": 1000,
+        "chunk_members": False,
+        "events": "reactions, message_edits, voice",
+    },
+    # Only what the bot's own commands and message log need
+    "minimal": {
+        "max_messages": 100,
+        "chunk_members": False,
+        "events": "",
+    },
+}
+
+
+class CacheProfile:
+    __slots__ = ("name", "max_messages", "chunk_members", "events")
+
+    def __init__(
+        self,
+        name: str,
+        max_messages: int,
+        chunk_members: bool,
+        events: FrozenSet[str]
+    ):
+        self.name = name
+        # discord.py never keeps fewer than 100 messages
+        self.max_messages = max(max_messages, 100)
+        self.chunk_members = chunk_members
+        self.events = events
+
+    @property
+    def disabled_events(self) -> FrozenSet[str]:
+        """Gateway events of every category not subscribed to"""
+        return frozenset(
+            event
+            for category, events in EVENT_CATEGORIES.items()
+            if category not in self.events
+            for event in events
+        )
+
+    def apply(self, state) -> None:
+        """Makes the ConnectionState drop the disabled events unparsed"""
+        for event in self.disabled_events:
+            setattr(state, "parse_" + event.lower(), _ignore)
+
+
+def _ignore(data: dict) -> None:
+    pass
+
+
+def parse_events(value: str) -> FrozenSet[str]:
+    """Raises ValueError for unknown categories"""
+    value = value.strip().lower()
+    if value == "all":
+        return frozenset(EVENT_CATEGORIES)
+
+    events = frozenset(
+        category.strip() for category in value.split(",") if category.strip()
+    )
+    unknown = events - set(EVENT_CATEGORIES)
+    if unknown:
+        raise ValueError(
+            f"Unknown event categories {', '.join(sorted(unknown))}")
+    return events
+
+
+def from_config(config: configparser.ConfigParser) -> CacheProfile:
+    """Raises ValueError for unknown profiles or event categories"""
+    name = config.get("Cache", "profile", fallback="full")
+    if name not in PROFILES:
+        raise ValueError(f"Unknown cache profile {name}")
+    defaults = PROFILES[name]
+
+    return CacheProfile(
+        name,
+        config.getint(
+            "Cache", "max_messages", fallback=defaults["max_messages"]),
+        config.getboolean(
+            "Cache", "chunk_members", fallback=defaults["chunk_members"]),
+        parse_events(
+            config.get("Cache", "events", fallback=defaults["events"]))
+    )
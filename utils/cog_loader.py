@@ -0,0 +1,143 @@
+# cog_loader.py
+#
+# Startup pipeline for the cogs directory.
+# Cog modules are imported concurrently on a thread pool, then set up
+# one by one on the event loop, as setup touches the bot.
+# Lazy cogs are not imported at all, their source is only scanned for
+# the commands and events that should load them on first use.
+
+import ast
+import importlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+from utils.listeners import declared_subscriptions, is_empty
+
+
+class CogTiming:
+    __slots__ = ("path", "import_time", "setup_time", "status", "error")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.import_time = None  # type: Optional[float]
+        self.setup_time = None  # type: Optional[float]
+        self.status = "pending"
+        self.error = None  # type: Optional[Exception]
+
+
+def discover(directory: Path, skip: Iterable[str] = ()) -> List[str]:
+    """
+    Module paths of the scripts in directory, not recursing into
+    deeper levels, leaving out __init__ and the stems in skip
+    """
+    skip = set(skip)
+    return [
+        ".".join(cog.with_suffix("").parts)
+        for cog in sorted(directory.iterdir())
+        if cog.suffix == ".py"
+        and not cog.is_dir()
+        and cog.stem != "__init__"
+        and cog.stem not in skip
+    ]
+
+
+def _import(path: str) -> float:
+    start = time.perf_counter()
+    importlib.import_module(path)
+    return time.perf_counter() - start
+
+
+async def import_all(
+    loop, paths: List[str], workers: int
+) -> List[CogTiming]:
+    """
+    Imports every module, workers at a time, recording how long each
+    took. Failed imports keep their exception in CogTiming.error
+    """
+    timings = [CogTiming(path) for path in paths]
+    if workers <= 1:
+        for timing in timings:
+            try:
+                timing.import_time = _import(timing.path)
+            except Exception as e:
+                timing.status, timing.error = "failed", e
+        return timings
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            loop.run_in_executor(executor, _import, timing.path)
+            for timing in timings
+        ]
+        for timing, future in zip(timings, futures):
+            try:
+                timing.import_time = await future
+            except Exception as e:
+                timing.status, timing.error = "failed", e
+    return timings
+
+
+def _decorator_name(decorator: ast.expr) -> Optional[str]:
+    """'command' for @commands.command() and @commands.command"""
+    if isinstance(decorator, ast.Call):
+        decorator = decorator.func
+    if (isinstance(decorator, ast.Attribute)
+            and isinstance(decorator.value, ast.Name)
+            and decorator.value.id == "commands"):
+        return decorator.attr
+    return None
+
+
+def _command_names(
+    function: ast.AsyncFunctionDef, decorator: ast.expr
+) -> List[str]:
+    name = function.name
+    aliases = []
+    if isinstance(decorator, ast.Call):
+        for keyword in decorator.keywords:
+            try:
+                value = ast.literal_eval(keyword.value)
+            except ValueError:
+                continue
+            if keyword.arg == "name":
+                name = value
+            elif keyword.arg == "aliases":
+                aliases = list(value)
+    return [name] + aliases
+
+
+def triggers(path: str) -> Tuple[List[str], List[str]]:
+    """
+    The top level command names and aliases, and the events
+    a cog module defines, read from its source without importing it
+    """
+    source = Path(*path.split(".")).with_suffix(".py").read_text("utf-8")
+    commands, events = [], []
+    for node in ast.walk(ast.parse(source)):
+        if not isinstance(node, ast.ClassDef):
+            continue
+        subscribed = declared_subscriptions(node)
+        for function in node.body:
+            if not isinstance(function, ast.AsyncFunctionDef):
+                continue
+            event = function.name[3:]
+            if (function.name.startswith("on_") and not is_empty(function)
+                    and (subscribed is None or event in subscribed)):
+                events.append(event)
+            for decorator in function.decorator_list:
+                if _decorator_name(decorator) in ("command", "group"):
+                    commands.extend(_command_names(function, decorator))
+    return commands, events
+
+
+def format_timings(timings: Iterable[CogTiming]) -> str:
+    lines = [f"{'cog':<24} {'import ms':>10} {'setup ms':>9}  status"]
+    for timing in timings:
+        import_ms = (f"{timing.import_time * 1000:.1f}"
+                     if timing.import_time is not None else "-")
+        setup_ms = (f"{timing.setup_time * 1000:.1f}"
+                    if timing.setup_time is not None else "-")
+        lines.append(f"{timing.path:<24} {import_ms:>10} {setup_ms:>9}  "
+                     f"{timing.status}")
+    return "\n".join(lines)
@@ -3,65 +3,392 @@
 # All methods here can be converted to handle query and
 # an arbitrary amount of args to support any database system
 # Note; asyncronous methods can not be interchanged with syncronous
+#
+# The asyncronous methods run on a persistent ConnectionPool,
+# one writer connection and a set of reader connections, each living
+# on its own worker thread for the lifetime of the bot.
 
+import asyncio
 import configparser
 import sqlite3 as sql
-from typing import List
-
-import aiosqlite
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
 
 
 config = configparser.ConfigParser()
 config.read("./config.ini")
-db_path = config["Database"]["sqlite"]
+db_path = config.get("Database", "sqlite", fallback="my_database.db")
+pool_readers = config.getint("Database", "pool_readers", fallback=4)
+statement_cache = config.getint("Database", "statement_cache", fallback=128)
+write_behind = config.getboolean("Database", "write_behind", fallback=False)
+write_behind_ms = config.getint("Database", "write_behind_ms", fallback=50)
+write_behind_max = config.getint("Database", "write_behind_max", fallback=500)
 
 
 def sync_execute(query: str, *args) -> None:
     """Syncronous function to execute a statement"""
     db = sql.connect(db_path, detect_types=sql.PARSE_DECLTYPES)
-    cursor = db.cursor()
-    cursor.execute(query, *args)
-    db.commit()
-    db.close()
+    try:
+        cursor = db.cursor()
+        cursor.execute(query, *args)
+        db.commit()
+    finally:
+        db.close()
 
 
 def sync_fetchall(query: str, *args) -> List[sql.Row]:
     """Syncronous function to fetch all results from query"""
     db = sql.connect(db_path, detect_types=sql.PARSE_DECLTYPES)
-    cursor = db.cursor()
-    cursor.execute(query, *args)
-    all_rows = cursor.fetchall()
+    try:
+        cursor = db.cursor()
+        cursor.execute(query, *args)
+        all_rows = cursor.fetchall()
+    finally:
+        db.close()
     return all_rows
 
 
+class PooledConnection:
+    """A sqlite3 connection pinned to a single worker thread"""
+
+    def __init__(self, path: str, cached_statements: int):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._path = path
+        self._cached_statements = cached_statements
+        self.conn = None
+
+    async def run(self, fn: Callable, *args: Any) -> Any:
+        """Runs fn(connection, *args) on the connection's thread"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self._executor, fn, self.conn, *args
+        )
+
+    async def open(self) -> None:
+        loop = asyncio.get_event_loop()
+        self.conn = await loop.run_in_executor(self._executor, self._connect)
+
+    def _connect(self) -> sql.Connection:
+        conn = sql.connect(
+            self._path,
+            detect_types=sql.PARSE_DECLTYPES,
+            cached_statements=self._cached_statements,
+            check_same_thread=False
+        )
+        # WAL lets the readers keep going while the writer commits
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        return conn
+
+    async def close(self) -> None:
+        if self.conn is not None:
+            await self.run(lambda conn: conn.close())
+            self.conn = None
+        self._executor.shutdown(wait=True)
+
+
+def _execute(conn: sql.Connection, query: str, args: tuple) -> None:
+    try:
+        conn.execute(query, *args)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _insert(conn: sql.Connection, query: str, args: tuple) -> int:
+    try:
+        cursor = conn.execute(query, *args)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    try:
+        return cursor.lastrowid
+    finally:
+        cursor.close()
+
+
+def _executemany(conn: sql.Connection, query: str, rows: list) -> None:
+    try:
+        conn.executemany(query, rows)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _fetchone(conn: sql.Connection, query: str, args: tuple) -> sql.Row:
+    cursor = conn.execute(query, *args)
+    try:
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+
+
+def _fetchall(
+    conn: sql.Connection, query: str, args: tuple
+) -> List[sql.Row]:
+    cursor = conn.execute(query, *args)
+    try:
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def _execute_batch(conn: sql.Connection, batch: list) -> list:
+    """
+    Runs a batch of writes in one transaction, every statement gets its
+    own savepoint so a failing statement does not take the others with it
+    """
+    results = []
+    conn.execute("BEGIN;")
+    try:
+        for query, args in batch:
+            conn.execute("SAVEPOINT batch_item;")
+            try:
+                conn.execute(query, *args)
+            except Exception as e:
+                conn.execute("ROLLBACK TO batch_item;")
+                results.append(e)
+            else:
+                results.append(None)
+            conn.execute("RELEASE batch_item;")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return results
+
+
+class WriteBehindQueue:
+    """
+    Coalesces writes from many coroutines into a single transaction
+
+    A batch is flushed `interval` seconds after the first write was queued,
+    or as soon as `max_batch` writes are waiting.
+    Every write returns a future resolving once its batch is committed,
+    or raising the exception its statement failed with.
+    """
+
+    def __init__(
+        self, pool: "ConnectionPool", interval: float, max_batch: int
+    ):
+        self.pool = pool
+        self.interval = interval
+        self.max_batch = max(max_batch, 1)
+        self._pending = []
+        self._has_items = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task = None
+        self._closing = False
+
+    def start(self) -> None:
+        self._closing = False
+        self._task = asyncio.ensure_future(self._run())
+
+    async def close(self) -> None:
+        """Stops the flush task and writes out everything still queued"""
+        if self._task is not None:
+            # Not cancelled, a batch being written still resolves its
+            # futures before the task stops
+            self._closing = True
+            self._has_items.set()
+            self._full.set()
+            await self._task
+            self._task = None
+
+        while self._pending:
+            await self.flush()
+
+    def submit(self, query: str, args: tuple) -> asyncio.Future:
+        future = asyncio.get_event_loop().create_future()
+        self._pending.append((query, args, future))
+        self._has_items.set()
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+        return future
+
+    async def _run(self) -> None:
+        while not self._closing:
+            await self._has_items.wait()
+            if self._closing:
+                break
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Writes out the oldest batch of queued statements"""
+        batch = self._pending[:self.max_batch]
+        del self._pending[:self.max_batch]
+        if not self._pending:
+            self._has_items.clear()
+        if len(self._pending) < self.max_batch:
+            self._full.clear()
+        if not batch:
+            return
+
+        try:
+            results = await self.pool.write(
+                _execute_batch, [(query, args) for query, args, _ in batch]
+            )
+        except Exception as e:
+            results = [e] * len(batch)
+
+        for (_, _, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if result is None:
+                future.set_result(None)
+            else:
+                future.set_exception(result)
+
+
+class ConnectionPool:
+    """
+    Long lived connections to the sqlite database
+
+    Writes are serialized on a single writer connection,
+    reads are spread over `readers` connections running in WAL mode.
+    Every connection keeps its own prepared statement cache.
+    """
+
+    def __init__(
+        self, path: str, readers: int = 4, cached_statements: int = 128
+    ):
+        self.path = path
+        self.writer = PooledConnection(path, cached_statements)
+        self.readers = [
+            PooledConnection(path, cached_statements)
+            for _ in range(max(readers, 1))
+        ]
+        self._idle = None
+        self._write_lock = None
+        self.write_behind = None  # type: Optional[WriteBehindQueue]
+
+    async def open(self) -> None:
+        """Opens the writer first, so WAL is set before readers attach"""
+        await self.writer.open()
+        for reader in self.readers:
+            await reader.open()
+
+        self._idle = asyncio.Queue()
+        for reader in self.readers:
+            self._idle.put_nowait(reader)
+        self._write_lock = asyncio.Lock()
+
+    def enable_write_behind(
+        self, interval_ms: int = 50, max_batch: int = 500
+    ) -> None:
+        """Routes execute() through a batching WriteBehindQueue"""
+        if self.write_behind is None:
+            self.write_behind = WriteBehindQueue(
+                self, interval_ms / 1000, max_batch
+            )
+            self.write_behind.start()
+
+    async def close(self) -> None:
+        """Waits for running statements and closes all connections"""
+        if self.write_behind is not None:
+            await self.write_behind.close()
+            self.write_behind = None
+
+        async with self._write_lock:
+            await self.writer.close()
+        for _ in self.readers:
+            await self._idle.get()
+        for reader in self.readers:
+            await reader.close()
+
+    async def write(self, fn: Callable, *args: Any) -> Any:
+        """Runs fn(connection, *args) on the writer connection"""
+        async with self._write_lock:
+            return await self.writer.run(fn, *args)
+
+    async def read(self, fn: Callable, *args: Any) -> Any:
+        """Runs fn(connection, *args) on the first idle reader connection"""
+        reader = await self._idle.get()
+        try:
+            return await reader.run(fn, *args)
+        finally:
+            self._idle.put_nowait(reader)
+
+
+pool = None  # type: Optional[ConnectionPool]
+_pool_lock = None  # type: Optional[asyncio.Lock]
+
+
+async def open_pool() -> ConnectionPool:
+    """Opens the module pool, called once on startup"""
+    global pool, _pool_lock
+    if _pool_lock is None:
+        _pool_lock = asyncio.Lock()
+
+    async with _pool_lock:
+        if pool is None:
+            new_pool = ConnectionPool(db_path, pool_readers, statement_cache)
+            await new_pool.open()
+            if write_behind:
+                new_pool.enable_write_behind(
+                    write_behind_ms, write_behind_max
+                )
+            pool = new_pool
+    return pool
+
+
+async def close_pool() -> None:
+    """Closes the module pool, called on logout"""
+    global pool
+    if pool is not None:
+        old_pool, pool = pool, None
+        await old_pool.close()
+
+
+async def get_pool() -> ConnectionPool:
+    """Returns the module pool, opening it on first use"""
+    return pool or await open_pool()
+
+
 async def execute(query: str, *args) -> None:
-    """Asyncronous function to execute statement"""
-    types = sql.PARSE_DECLTYPES
-    async with aiosqlite.connect(db_path, detect_types=types) as db:
-        await db.execute(query, *args)
-        await db.commit()
+    """
+    Asyncronous function to execute statement
+    With write_behind enabled the statement is committed in a batch
+    """
+    db = await get_pool()
+    if db.write_behind is not None:
+        await db.write_behind.submit(query, args)
+    else:
+        await db.write(_execute, query, args)
+
+
+async def insert(query: str, *args) -> int:
+    """
+    Executes an INSERT and returns the rowid of the new row
+    Always committed right away, even with write_behind enabled
+    """
+    db = await get_pool()
+    return await db.write(_insert, query, args)
+
+
+async def executemany(query: str, rows: List[tuple]) -> None:
+    """Executes statement once per row, all in a single transaction"""
+    db = await get_pool()
+    await db.write(_executemany, query, rows)
 
 
 async def fetchone(query: str, *args) -> sql.Row:
     """Asyncronous function to execute statement"""
-    row = None
-    types = sql.PARSE_DECLTYPES
-    async with aiosqlite.connect(db_path, detect_types=types) as db:
-        async with db.execute(query, *args) as cursor:
-            row = await cursor.fetchone()
-            await cursor.close()
-    return row
+    db = await get_pool()
+    return await db.read(_fetchone, query, args)
 
 
 async def fetchall(query: str, *args) -> List[sql.Row]:
     """Fetches all results in a list of tuples"""
-    rows = None
-    types = sql.PARSE_DECLTYPES
-    async with aiosqlite.connect(db_path, detect_types=types) as db:
-        async with db.execute(query, *args) as cursor:
-            rows = await cursor.fetchall()
-            await cursor.close()
-    return rows
+    db = await get_pool()
+    return await db.read(_fetchall, query, args)
 
 
 def make_sure_tables_exist():
@@ -83,8 +410,99 @@ def make_sure_tables_exist():
             prefix text,
             PRIMARY KEY (guildid, prefix));""")
 
+    sync_execute("""
+        CREATE TABLE IF NOT EXISTS prefix_changes(
+            version     INTEGER PRIMARY KEY AUTOINCREMENT,
+            guildid     BIGINT,
+            prefix      text,
+            action      text,
+            origin      text,
+            date        timestamp);""")
+
     sync_execute("""
         CREATE TABLE IF NOT EXISTS warnings(
             id int PRIMARY KEY,
             guildid BIGINT,
-            userid BIGINT);""")
+            userid BIGINT,
+            date timestamp);""")
+
+    # Warnings stored before they had a date never expire
+    columns = [row[1] for row in sync_fetchall("PRAGMA table_info(warnings);")]
+    if "date" not in columns:
+        sync_execute("ALTER TABLE warnings ADD COLUMN date timestamp;")
+
+    sync_execute("""
+        CREATE INDEX IF NOT EXISTS warnings_guild_user
+            ON warnings(guildid, userid);""")
+
+    sync_execute("""
+        CREATE INDEX IF NOT EXISTS warnings_guild_date
+            ON warnings(guildid, date);""")
+
+    sync_execute("""
+        CREATE TABLE IF NOT EXISTS strike_rules(
+            guildid     BIGINT,
+            warnings    int,
+            window      int,
+            action      text,
+            PRIMARY KEY (guildid, warnings, window));""")
+
+    sync_execute("""
+        CREATE TABLE IF NOT EXISTS strike_settings(
+            guildid     BIGINT PRIMARY KEY,
+            decay       int);""")
+
+    sync_execute("""
+        CREATE TABLE IF NOT EXISTS bulk_jobs(
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            guildid     BIGINT,
+            channelid   BIGINT,
+            authorid    BIGINT,
+            action      text,
+            reason      text,
+            created     timestamp,
+            finished    timestamp);""")
+
+    sync_execute("""
+        CREATE TABLE IF NOT EXISTS bulk_targets(
+            jobid       int,
+            userid      BIGINT,
+            status      int,
+            PRIMARY KEY (jobid, userid));""")
+
+    sync_execute("""
+        CREATE TABLE IF NOT EXISTS spam_settings(
+            guildid     BIGINT PRIMARY KEY,
+            preset      text);""")
+
+    sync_execute("""
+        CREATE TABLE IF NOT EXISTS reminders(
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            userid      BIGINT,
+            channelid   BIGINT,
+            guildid     BIGINT,
+            created     timestamp,
+            due         timestamp,
+            message     text);""")
+
+    sync_execute("""
+        CREATE INDEX IF NOT EXISTS reminders_due
+            ON reminders(due);""")
+
+    sync_execute("""
+        CREATE TABLE IF NOT EXISTS messagelog(
+            messageid   BIGINT,
+            authorid    BIGINT,
+            guildid     BIGINT,
+            channelid   BIGINT,
+            date        timestamp,
+            content     BLOB,
+            PRIMARY KEY (messageid, authorid));""")
+
+    sync_execute("""
+        CREATE INDEX IF NOT EXISTS messagelog_guild_author_date
+            ON messagelog(guildid, authorid, date);""")
+
+    sync_execute("""
+        CREATE INDEX IF NOT EXISTS messagelog_channel_date
+            ON messagelog(channelid, date);""")
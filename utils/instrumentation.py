@@ -0,0 +1,185 @@
+# instrumentation.py
+#
+# Latency histograms for every dispatched event handler, every command
+# and the event loop lag, kept in fixed buckets so recording is a
+# bisect and an increment no matter how long the bot runs.
+# MetricsServer serves them in the Prometheus text format.
+
+import asyncio
+import logging
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger("discord")
+
+# Upper bounds in seconds, the last bucket catches everything above
+BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, fraction: float) -> float:
+        """Upper bound of the bucket holding the quantile"""
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Instrumentation:
+    """All histograms of one bot process"""
+
+    def __init__(self):
+        self.events = {}  # type: Dict[Labels, Histogram]
+        self.commands = {}  # type: Dict[Labels, Histogram]
+        self.loop_lag = Histogram()
+
+    @staticmethod
+    def _get(metric: Dict[Labels, Histogram], labels: Labels) -> Histogram:
+        histogram = metric.get(labels)
+        if histogram is None:
+            histogram = metric[labels] = Histogram()
+        return histogram
+
+    def observe_event(self, event: str, handler: str, seconds: float):
+        self._get(
+            self.events, (("event", event), ("handler", handler))
+        ).observe(seconds)
+
+    def observe_command(self, command: str, failed: bool, seconds: float):
+        status = "error" if failed else "ok"
+        self._get(
+            self.commands, (("command", command), ("status", status))
+        ).observe(seconds)
+
+    def observe_lag(self, seconds: float):
+        self.loop_lag.observe(seconds)
+
+    def slowest(
+        self, metric: Dict[Labels, Histogram], limit: int = 10
+    ) -> List[Tuple[str, Histogram]]:
+        """The histograms with the most total time spent, named by labels"""
+        ranked = sorted(
+            metric.items(), key=lambda item: item[1].sum, reverse=True)
+        return [
+            (" ".join(value for _, value in labels), histogram)
+            for labels, histogram in ranked[:limit]
+        ]
+
+    def render(self) -> str:
+        """All histograms in the Prometheus text exposition format"""
+        lines = []
+        for name, text, metric in (
+            ("bot_event_handler_seconds",
+             "Time spent in each event handler", self.events),
+            ("bot_command_seconds",
+             "Time spent invoking each command", self.commands),
+            ("bot_loop_lag_seconds",
+             "How late the event loop ran the lag probe",
+             {(): self.loop_lag}),
+        ):
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in metric.items():
+                lines.extend(_render_histogram(name, labels, histogram))
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return (value.replace("\\", "\\\\")
+                 .replace("\n", "\\n")
+                 .replace('"', '\\"'))
+
+
+def _render_histogram(
+    name: str, labels: Labels, histogram: Histogram
+) -> List[str]:
+    label_text = ",".join(f'{key}="{_escape(value)}"' for key, value in labels)
+    prefix = label_text + "," if label_text else ""
+    suffix = "{" + label_text + "}" if label_text else ""
+
+    lines = []
+    cumulative = 0
+    for bound, count in zip(BUCKETS + (None,), histogram.counts):
+        cumulative += count
+        le = "+Inf" if bound is None else repr(bound)
+        lines.append(f'{name}_bucket{{{prefix}le="{le}"}} {cumulative}')
+    lines.append(f"{name}_sum{suffix} {histogram.sum!r}")
+    lines.append(f"{name}_count{suffix} {histogram.count}")
+    return lines
+
+
+class MetricsServer:
+    """Serves Instrumentation.render on GET /metrics over plain HTTP"""
+
+    def __init__(
+        self, instrumentation: Instrumentation, host: str, port: int
+    ):
+        self.instrumentation = instrumentation
+        self.host = host
+        self.port = port
+        self._server = None  # type: Optional[asyncio.AbstractServer]
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(
+            self._handle, self.host, self.port)
+        logger.info(f"Serving metrics on {self.host}:{self.port}")
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            request = await reader.readline()
+            # Headers are not needed, read up to the blank line
+            while (await reader.readline()).strip():
+                pass
+
+            parts = request.split()
+            if parts[:2] == [b"GET", b"/metrics"]:
+                status = "200 OK"
+                body = self.instrumentation.render().encode()
+            else:
+                status = "404 Not Found"
+                body = b""
+
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,105 @@
+# listeners.py
+#
+# Decides which cog listeners MyBot actually registers.
+# Every registered listener is scheduled as its own task for each
+# matching gateway event, so listeners that do nothing, or that a cog
+# did not subscribe to, are left out instead.
+# Empty bodies are recognised in the source rather than the bytecode,
+# which changes between Python versions.
+
+import ast
+import inspect
+import textwrap
+from typing import Callable, FrozenSet, Optional, Union
+
+FunctionNode = Union[ast.FunctionDef, ast.AsyncFunctionDef]
+
+
+def _is_literal(node: ast.expr) -> bool:
+    """A string or ..., Python before 3.8 parses them as Str and Ellipsis"""
+    if type(node).__name__ in ("Str", "Ellipsis"):
+        return True
+    return isinstance(node, ast.Constant) and isinstance(
+        node.value, (str, type(...)))
+
+
+def is_empty(function: FunctionNode) -> bool:
+    """Only a docstring, pass or ..."""
+    return all(
+        isinstance(statement, ast.Pass)
+        or (isinstance(statement, ast.Expr) and _is_literal(statement.value))
+        for statement in function.body
+    )
+
+
+def is_noop(func: Callable) -> bool:
+    """
+    True when the body of func is only a docstring, pass or ...
+    Functions without available source are never taken for no-ops
+    """
+    func = getattr(func, "__func__", func)
+    try:
+        source = textwrap.dedent(inspect.getsource(func))
+        tree = ast.parse(source)
+    except (OSError, TypeError, SyntaxError):
+        return False
+    function = tree.body[0] if tree.body else None
+    if not isinstance(function, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        return False
+    return is_empty(function)
+
+
+def event_name(name: str) -> str:
+    """The event a listener name stands for, message for on_message"""
+    return name[3:] if name.startswith("on_") else name
+
+
+def subscribe(*events: str) -> Callable[[type], type]:
+    """
+    Class decorator limiting a cog to the listeners of the given events,
+    with or without the on_ prefix. Listeners for other events are not
+    registered even when the cog defines them
+
+        @subscribe("message", "guild_join")
+        class MyCog:
+            ...
+    """
+
+    def decorator(cls: type) -> type:
+        cls.__subscriptions__ = frozenset(event_name(e) for e in events)
+        return cls
+
+    return decorator
+
+
+def subscriptions(cog: object) -> Optional[FrozenSet[str]]:
+    """The events cog subscribed to, None when it never declared any"""
+    return getattr(cog, "__subscriptions__", None)
+
+
+def subscribed(cog: object, name: str) -> bool:
+    """Whether cog wants the listener called name, cogs without
+    a subscription want every event
+    """
+    events = subscriptions(cog)
+    return events is None or event_name(name) in events
+
+
+def declared_subscriptions(
+    cls: ast.ClassDef
+) -> Optional[FrozenSet[str]]:
+    """The events a @subscribe(...) on cls names, read from its source"""
+    for decorator in cls.decorator_list:
+        if not isinstance(decorator, ast.Call):
+            continue
+        func = decorator.func
+        name = getattr(func, "id", None) or getattr(func, "attr", None)
+        if name != "subscribe":
+            continue
+        try:
+            events = [ast.literal_eval(arg) for arg in decorator.args]
+        except ValueError:
+            # Not literal names, the scan can't tell which events
+            return None
+        return frozenset(event_name(event) for event in events)
+    return None
@@ -0,0 +1,194 @@
+# log_archive.py
+#
+# Append-only, column oriented segment files for the message log.
+# Every flush of the message log can be written as one segment:
+#
+#   <column block> ... <column block> <footer> <footer length> MAGIC
+#
+# Column blocks are compressed separately, ids are packed int64 arrays,
+# dates are int64 epoch milliseconds and contents are the encrypted blobs
+# stored as an array of lengths followed by the concatenated bytes.
+# The footer is a small JSON index holding the row count, the date and
+# message id ranges and the offset and length of every block, so a
+# segment can be pruned or skipped without decompressing anything.
+
+import datetime
+import itertools
+import json
+import os
+import struct
+import time
+import zlib
+from array import array
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b"MLOGSEG1"
+SUFFIX = ".seg"
+ID_COLUMNS = ("messageid", "authorid", "guildid", "channelid")
+EPOCH = datetime.datetime(1970, 1, 1)
+
+_footer_size = struct.Struct("<Q")
+_sequence = itertools.count()
+
+
+def _compress(data: bytes, compression: str) -> bytes:
+    if compression == "zstd":
+        return zstandard.ZstdCompressor().compress(data)
+    return zlib.compress(data, 6)
+
+
+def _decompress(data: bytes, compression: str) -> bytes:
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read this segment")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def _int64(values) -> bytes:
+    column = array("q", values)
+    if column.itemsize != 8:
+        raise RuntimeError("int64 arrays are not supported on this platform")
+    return column.tobytes()
+
+
+def _epoch_ms(date: datetime.datetime) -> int:
+    return (date - EPOCH) // datetime.timedelta(milliseconds=1)
+
+
+def write_segment(
+    directory: Path, rows: List[tuple], compression: str = "zlib"
+) -> Optional[Path]:
+    """
+    Writes messagelog rows to a new segment file in directory
+    Falls back to zlib when zstd is requested but not installed
+    """
+    if not rows:
+        return None
+    if compression == "zstd" and zstandard is None:
+        compression = "zlib"
+
+    columns = list(zip(*rows))
+    dates = [_epoch_ms(date) for date in columns[4]]
+    contents = [content or b"" for content in columns[5]]
+
+    raw_blocks = [
+        (name, _int64(value or 0 for value in column))
+        for name, column in zip(ID_COLUMNS, columns)
+    ]
+    raw_blocks.append(("date", _int64(dates)))
+    raw_blocks.append(("content_length", array(
+        "I", (len(content) for content in contents)).tobytes()))
+    raw_blocks.append(("content", b"".join(contents)))
+
+    footer = {
+        "rows": len(rows),
+        "compression": compression,
+        "min_date": min(dates),
+        "max_date": max(dates),
+        "min_messageid": min(columns[0]),
+        "max_messageid": max(columns[0]),
+        "blocks": {}
+    }
+
+    directory.mkdir(parents=True, exist_ok=True)
+    name = f"{int(time.time() * 1000)}-{os.getpid()}-{next(_sequence)}"
+    path = directory / (name + SUFFIX)
+    partial = path.with_suffix(".partial")
+
+    offset = 0
+    with partial.open("wb") as segment:
+        for block_name, raw in raw_blocks:
+            block = _compress(raw, compression)
+            segment.write(block)
+            footer["blocks"][block_name] = [offset, len(block)]
+            offset += len(block)
+
+        encoded = json.dumps(footer).encode("utf-8")
+        segment.write(encoded)
+        segment.write(_footer_size.pack(len(encoded)))
+        segment.write(MAGIC)
+        segment.flush()
+        os.fsync(segment.fileno())
+
+    # Readers never see a half written segment
+    partial.replace(path)
+    return path
+
+
+def read_footer(path: Path) -> dict:
+    """Reads the index of a segment without touching its columns"""
+    with path.open("rb") as segment:
+        segment.seek(-(len(MAGIC) + _footer_size.size), os.SEEK_END)
+        size, = _footer_size.unpack(segment.read(_footer_size.size))
+        if segment.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a message log segment")
+
+        segment.seek(-(len(MAGIC) + _footer_size.size + size), os.SEEK_END)
+        return json.loads(segment.read(size).decode("utf-8"))
+
+
+def read_segment(path: Path) -> List[tuple]:
+    """Reads a segment back into messagelog rows"""
+    footer = read_footer(path)
+    compression = footer["compression"]
+
+    with path.open("rb") as segment:
+        def block(name: str) -> bytes:
+            offset, length = footer["blocks"][name]
+            segment.seek(offset)
+            return _decompress(segment.read(length), compression)
+
+        def int64(name: str) -> array:
+            column = array("q")
+            column.frombytes(block(name))
+            return column
+
+        ids = [int64(name) for name in ID_COLUMNS]
+        dates = [
+            EPOCH + datetime.timedelta(milliseconds=date)
+            for date in int64("date")
+        ]
+        lengths = array("I")
+        lengths.frombytes(block("content_length"))
+        blob = block("content")
+
+    contents = []
+    offset = 0
+    for length in lengths:
+        contents.append(blob[offset:offset + length] or None)
+        offset += length
+
+    messageids, authorids, guildids, channelids = ids
+    return [
+        (messageid, authorid, guildid or None, channelid, date, content)
+        for messageid, authorid, guildid, channelid, date, content
+        in zip(messageids, authorids, guildids, channelids, dates, contents)
+    ]
+
+
+def segments(directory: Path) -> Iterator[Path]:
+    """All complete segments in directory, oldest first"""
+    if not directory.exists():
+        return iter(())
+    return iter(sorted(
+        directory.glob(f"*{SUFFIX}"),
+        key=lambda path: int(path.name.split("-", 1)[0])
+    ))
+
+
+def prune_segments(directory: Path, before: datetime.datetime) -> int:
+    """Deletes segments holding only messages older than before"""
+    cutoff = _epoch_ms(before)
+    removed = 0
+    for path in segments(directory):
+        if read_footer(path)["max_date"] < cutoff:
+            path.unlink()
+            removed += 1
+    return removed
@@ -0,0 +1,57 @@
+import asyncio
+from typing import Callable, Optional
+
+
+class LoopLagProbe:
+    """
+    Measures how late the event loop wakes up a sleeping coroutine
+
+    Every `interval` seconds the probe sleeps and records how much longer
+    than requested the sleep took, which is the time the loop was blocked.
+    Every sample is also passed to `observer` when one is given.
+    """
+
+    def __init__(
+        self,
+        interval: float = 0.01,
+        observer: Optional[Callable[[float], None]] = None
+    ):
+        self.interval = interval
+        self.observer = observer
+        self.last = 0.0
+        self.max = 0.0
+        self.samples = 0
+        self._task = None  # type: Optional[asyncio.Task]
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._probe())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def reset(self) -> None:
+        self.last = 0.0
+        self.max = 0.0
+        self.samples = 0
+
+    async def _probe(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.last = max(loop.time() - start - self.interval, 0.0)
+            self.max = max(self.max, self.last)
+            self.samples += 1
+            if self.observer is not None:
+                self.observer(self.last)
+
+    async def __aenter__(self) -> "LoopLagProbe":
+        self.reset()
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.stop()
@@ -0,0 +1,123 @@
+import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+DROP = "drop"
+SPILL = "spill"
+
+
+class LoggedMessage:
+    """A buffered message log entry, ordered like the messagelog columns"""
+
+    __slots__ = (
+        "messageid", "authorid", "guildid", "channelid", "date", "content"
+    )
+
+    def __init__(
+        self,
+        messageid: int,
+        authorid: int,
+        guildid: Optional[int],
+        channelid: int,
+        date: datetime.datetime,
+        content: str
+    ):
+        self.messageid = messageid
+        self.authorid = authorid
+        self.guildid = guildid
+        self.channelid = channelid
+        self.date = date
+        self.content = content
+
+    def row(self, content: Any) -> tuple:
+        """The messagelog row for this entry with the given content"""
+        return (
+            self.messageid,
+            self.authorid,
+            self.guildid,
+            self.channelid,
+            self.date,
+            content
+        )
+
+
+class MessageLogBuffer:
+    """
+    Bounded in-memory buffer for logged messages
+
+    The buffer holds at most `max_entries` entries and `max_bytes` bytes
+    of message content. Once `high_water` (a fraction of either limit)
+    is reached `on_high_water` is called, so the owner can flush early.
+
+    When the sink is slower than ingest and the buffer is full,
+    the overflow policy decides what happens:
+        drop  -- the incoming entry is discarded and counted as dropped
+        spill -- the full buffer is swapped out and handed to `on_spill`,
+                 which should persist it to disk, the incoming entry
+                 starts the new buffer
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 50000,
+        max_bytes: int = 32 * 1024 * 1024,
+        high_water: float = 0.75,
+        overflow: str = DROP,
+        on_high_water: Optional[Callable[[], Any]] = None,
+        on_spill: Optional[Callable[[List[Any]], Any]] = None
+    ):
+        if overflow not in (DROP, SPILL):
+            raise ValueError(f"Unknown overflow policy {overflow}")
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.high_entries = int(max_entries * high_water)
+        self.high_bytes = int(max_bytes * high_water)
+        self.overflow = overflow
+        self.on_high_water = on_high_water
+        self.on_spill = on_spill
+
+        self.entries = []
+        self.size = 0
+
+        self.flushed = 0
+        self.dropped = 0
+        self.spilled = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def append(self, entry: Any, size: int) -> bool:
+        """Adds an entry of `size` bytes, returns False if it was dropped"""
+        if (len(self.entries) >= self.max_entries
+                or self.size + size > self.max_bytes):
+            if self.overflow == DROP or self.on_spill is None:
+                self.dropped += 1
+                return False
+
+            spill = self.swap()
+            self.spilled += len(spill)
+            self.on_spill(spill)
+
+        self.entries.append(entry)
+        self.size += size
+
+        if (self.on_high_water is not None
+                and (len(self.entries) >= self.high_entries
+                     or self.size >= self.high_bytes)):
+            self.on_high_water()
+        return True
+
+    def swap(self) -> List[Any]:
+        """Takes all buffered entries, leaving an empty buffer behind"""
+        entries, self.entries = self.entries, []
+        self.size = 0
+        return entries
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "buffered": len(self.entries),
+            "buffered_bytes": self.size,
+            "flushed": self.flushed,
+            "dropped": self.dropped,
+            "spilled": self.spilled
+        }
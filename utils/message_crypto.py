@@ -0,0 +1,150 @@
+import os
+from typing import Iterable, List, Optional
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import (
+    AESGCM, ChaCha20Poly1305
+)
+
+GCM = "gcm"
+CHACHA20 = "chacha20"
+ECB = "ecb"
+
+# Leading byte of every AEAD ciphertext, marks the mode it was written with
+_TAGS = {GCM: b"\x01", CHACHA20: b"\x02"}
+_MODES = {tag[0]: mode for mode, tag in _TAGS.items()}
+
+NONCE_SIZE = 12
+
+
+class MessageCipher:
+    """
+    Encrypts logged message contents
+
+    gcm and chacha20 are authenticated modes using a random nonce per row,
+    stored as <mode byte><nonce><ciphertext><tag> with no padding.
+    The mode byte lets rows written under either AEAD mode be read back
+    after the configured mode changes.
+    ecb is the padded, unauthenticated format earlier versions wrote,
+    only kept so existing message logs stay readable. Rows without a
+    mode byte are only read as ecb in ecb mode or with legacy_ecb set,
+    otherwise a rewritten row could pass as one.
+    """
+
+    def __init__(self, key: bytes, mode: str = GCM, legacy_ecb: bool = False):
+        if mode not in (GCM, CHACHA20, ECB):
+            raise ValueError(f"Unknown cipher mode {mode}")
+
+        self.key = key
+        self.mode = mode
+        self.legacy_ecb = legacy_ecb or mode == ECB
+        self._aeads = {}
+        self._legacy = None
+
+    def _aead(self, mode: str):
+        """The AEAD objects hold no per message state and are thread safe"""
+        if mode not in self._aeads:
+            new = AESGCM if mode == GCM else ChaCha20Poly1305
+            self._aeads[mode] = new(self.key)
+        return self._aeads[mode]
+
+    def _ecb(self):
+        """Cryptodome is only imported when legacy logs are handled"""
+        from Cryptodome.Cipher import AES
+        from Cryptodome.Util import Padding
+        return AES.new(self.key, AES.MODE_ECB), Padding
+
+    def encrypt(self, content: str) -> bytes:
+        return self.encrypt_batch([content])[0]
+
+    def decrypt(self, blob: bytes) -> str:
+        return self.decrypt_batch([blob])[0]
+
+    def encrypt_batch(
+        self, contents: Iterable[Optional[str]]
+    ) -> List[Optional[bytes]]:
+        """Encrypts a batch of contents, empty contents are kept as None"""
+        contents = list(contents)
+        if self.mode == ECB:
+            aes, padding = self._ecb()
+            return [
+                aes.encrypt(padding.pad(content.encode("utf-8"), 16))
+                if content else None
+                for content in contents
+            ]
+
+        # One call to the random source for the whole batch
+        nonces = os.urandom(NONCE_SIZE * len(contents))
+        prefix = _TAGS[self.mode]
+        encrypt = self._aead(self.mode).encrypt
+        encrypted = []
+        for i, content in enumerate(contents):
+            if not content:
+                encrypted.append(None)
+                continue
+
+            nonce = nonces[i * NONCE_SIZE:(i + 1) * NONCE_SIZE]
+            encrypted.append(
+                prefix + nonce + encrypt(nonce, content.encode("utf-8"), None)
+            )
+        return encrypted
+
+    def _decrypt_ecb(self, blob: bytes) -> str:
+        if self._legacy is None:
+            self._legacy = self._ecb()
+        aes, padding = self._legacy
+        return padding.unpad(aes.decrypt(blob), 16).decode("utf-8")
+
+    def decrypt_batch(
+        self, blobs: Iterable[Optional[bytes]]
+    ) -> List[Optional[str]]:
+        """
+        Decrypts a batch of stored contents, each row in the mode its
+        leading byte names
+        Raises ValueError if a row was tampered with
+        """
+        decrypted = []
+        for blob in blobs:
+            if not blob:
+                decrypted.append(None)
+                continue
+
+            # Only blocks of 16 bytes can be ecb rows
+            ecb = self.legacy_ecb and not len(blob) % 16
+            mode = _MODES.get(blob[0])
+            if mode is None:
+                if not ecb:
+                    raise ValueError("Unknown cipher mode byte")
+                decrypted.append(self._decrypt_ecb(blob))
+                continue
+
+            nonce = blob[1:1 + NONCE_SIZE]
+            try:
+                content = self._aead(mode).decrypt(
+                    nonce, blob[1 + NONCE_SIZE:], None)
+            except InvalidTag:
+                # An ecb row may start with a mode byte by chance
+                if not ecb:
+                    raise ValueError("Message log row failed authentication")
+                try:
+                    decrypted.append(self._decrypt_ecb(blob))
+                except ValueError:
+                    raise ValueError(
+                        "Message log row failed authentication") from None
+                continue
+            decrypted.append(content.decode("utf-8"))
+        return decrypted
+
+
+def decrypt_rows(
+    cipher: MessageCipher, rows: Iterable[tuple], index: int = -1
+) -> List[tuple]:
+    """Decrypts the content column, at `index`, of messagelog rows"""
+    rows = list(rows)
+    contents = cipher.decrypt_batch(row[index] for row in rows)
+    if index < 0:
+        index += len(rows[0]) if rows else 0
+    return [
+        row[:index] + (content,) + row[index + 1:]
+        for row, content in zip(rows, contents)
+    ]
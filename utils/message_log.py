@@ -0,0 +1,103 @@
+# message_log.py
+#
+# Paged queries over the messagelog table, built on database_manager.
+# Pages are ordered newest first and continued with a cursor,
+# the (date, messageid) of the last row on the previous page,
+# so every page is an index range scan no matter how deep it is.
+# Messages still buffered in the Events cog show up after the next flush.
+
+import datetime
+from typing import List, Optional, Tuple
+
+from utils import database_manager as db
+
+Cursor = Tuple[datetime.datetime, int]
+
+COLUMNS = "messageid, authorid, guildid, channelid, date, content"
+
+_DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def encode_cursor(cursor: Optional[Cursor]) -> Optional[str]:
+    """Turns a cursor into a string that can be handed to a user"""
+    if cursor is None:
+        return None
+    date, messageid = cursor
+    return f"{date.strftime(_DATE_FORMAT).replace(' ', 'T')}_{messageid}"
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Cursor]:
+    """Raises ValueError for malformed cursors"""
+    if not cursor:
+        return None
+    date, messageid = cursor.split("_")
+    return (
+        datetime.datetime.strptime(date.replace("T", " "), _DATE_FORMAT),
+        int(messageid)
+    )
+
+
+async def _page(
+    where: str, args: list, limit: int, cursor: Optional[Cursor]
+) -> Tuple[List[tuple], Optional[Cursor]]:
+    if cursor is not None:
+        date, messageid = cursor
+        where += " AND date <= ? AND (date < ? OR messageid < ?)"
+        args += [date, date, messageid]
+
+    rows = await db.fetchall(f"""
+        SELECT {COLUMNS}
+            FROM messagelog
+            WHERE {where}
+            ORDER BY date DESC, messageid DESC
+            LIMIT ?;
+    """, args + [limit])
+
+    next_cursor = None
+    if len(rows) == limit:
+        next_cursor = (rows[-1][4], rows[-1][0])
+    return rows, next_cursor
+
+
+async def by_author(
+    guildid: int,
+    authorid: int,
+    limit: int = 50,
+    cursor: Optional[Cursor] = None
+) -> Tuple[List[tuple], Optional[Cursor]]:
+    """
+    Last `limit` messages by authorid in guildid, newest first
+    Returns the rows, and the cursor to the next page if there may be one
+    Uses the (guildid, authorid, date) index
+    """
+    return await _page(
+        "guildid = ? AND authorid = ?", [guildid, authorid], limit, cursor
+    )
+
+
+async def by_channel(
+    channelid: int,
+    limit: int = 50,
+    cursor: Optional[Cursor] = None
+) -> Tuple[List[tuple], Optional[Cursor]]:
+    """
+    Last `limit` messages in channelid, newest first
+    Uses the (channelid, date) index
+    """
+    return await _page("channelid = ?", [channelid], limit, cursor)
+
+
+async def since(
+    channelid: int, date: datetime.datetime, limit: int = 5000
+) -> List[tuple]:
+    """
+    Up to `limit` messages in channelid at or after date, newest first
+    Uses the (channelid, date) index
+    """
+    return await db.fetchall(f"""
+        SELECT {COLUMNS}
+            FROM messagelog
+            WHERE channelid = ? AND date >= ?
+            ORDER BY date DESC, messageid DESC
+            LIMIT ?;
+    """, [channelid, date, limit])
@@ -0,0 +1,116 @@
+# prefix_sync.py
+#
+# Keeps the prefix caches of several bot processes coherent.
+# Prefixer publishes every prefix change on an InvalidationChannel,
+# every other process sharing the channel applies the change to its own
+# cache, without rereading the prefixes table.
+
+import asyncio
+import datetime
+import logging
+import os
+import uuid
+from typing import Callable, Optional
+
+from utils import database_manager as sqlite
+
+logger = logging.getLogger("discord")
+
+ADD = "add"
+REMOVE = "remove"
+
+Listener = Callable[[int, str, str], None]
+
+
+class InvalidationChannel:
+    """
+    Base channel, used when a single process runs all shards
+    and there is nobody to tell about changes
+    """
+
+    async def start(self, listener: Listener) -> None:
+        """Starts delivering other processes' changes to listener"""
+
+    async def publish(self, guild: int, prefix: str, action: str) -> None:
+        """Tells the other processes a guild's prefix was added or removed"""
+
+    async def close(self) -> None:
+        pass
+
+
+class SQLiteChannel(InvalidationChannel):
+    """
+    Change log in the shared sqlite database
+
+    Every change is appended to the prefix_changes table with an
+    increasing version, every process polls for versions newer than
+    the last one it has seen. Changes older than `retention` are pruned.
+    """
+
+    def __init__(
+        self,
+        interval: float = 1.0,
+        retention: datetime.timedelta = datetime.timedelta(hours=1)
+    ):
+        self.interval = interval
+        self.retention = retention
+        self.origin = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.version = 0
+        self._task = None  # type: Optional[asyncio.Task]
+
+    async def start(self, listener: Listener) -> None:
+        row = await sqlite.fetchone(
+            "SELECT MAX(version) FROM prefix_changes;")
+        self.version = row[0] or 0
+        self._task = asyncio.ensure_future(self._poll(listener))
+
+    async def publish(self, guild: int, prefix: str, action: str) -> None:
+        await sqlite.execute("""
+            INSERT INTO prefix_changes(guildid, prefix, action, origin, date)
+                VALUES (?, ?, ?, ?, ?);
+        """, [guild, prefix, action, self.origin, datetime.datetime.utcnow()])
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _poll(self, listener: Listener) -> None:
+        polls = 0
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.receive(listener)
+
+                polls += 1
+                if polls % 600 == 0:
+                    await sqlite.execute(
+                        "DELETE FROM prefix_changes WHERE date < ?;",
+                        [datetime.datetime.utcnow() - self.retention])
+            except Exception:
+                logger.exception("Polling prefix changes failed")
+
+    async def receive(self, listener: Listener) -> None:
+        """Applies every change newer than the last seen version"""
+        rows = await sqlite.fetchall("""
+            SELECT version, guildid, prefix, action, origin
+                FROM prefix_changes
+                WHERE version > ?
+                ORDER BY version;
+        """, [self.version])
+
+        for version, guild, prefix, action, origin in rows:
+            self.version = version
+            if origin != self.origin:
+                listener(guild, prefix, action)
+
+
+def make_channel(
+    kind: str, interval: float = 1.0
+) -> InvalidationChannel:
+    """Builds the channel named by the prefix_sync config option"""
+    if kind == "sqlite":
+        return SQLiteChannel(interval)
+    if kind in ("", "none"):
+        return InvalidationChannel()
+    raise ValueError(f"Unknown prefix_sync channel {kind}")
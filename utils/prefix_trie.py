@@ -0,0 +1,37 @@
+from typing import Iterable, Optional
+
+# Characters are one long strings, so the empty string never clashes
+_END = ""
+
+
+class PrefixTrie:
+    """
+    Finds the longest prefix a message starts with
+    in O(length of the longest prefix), regardless of how many are stored
+    """
+
+    __slots__ = ("root",)
+
+    def __init__(self, prefixes: Iterable[str] = ()):
+        self.root = {}
+        for prefix in prefixes:
+            self.add(prefix)
+
+    def add(self, prefix: str) -> None:
+        if not prefix:
+            return
+
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[_END] = prefix
+
+    def longest_match(self, text: str) -> Optional[str]:
+        node = self.root
+        match = None
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            match = node.get(_END, match)
+        return match
@@ -0,0 +1,179 @@
+# raid_detector.py
+#
+# Raid detection on member joins.
+# Every guild gets the same fixed amount of state: join counts per
+# second over a sliding window, split into account age bins, and a ring
+# of the latest joiner ids. The state is allocated on a guild's first
+# join, a join after that only updates integers in arrays, so storms of
+# thousands of joins per second create no per-member objects.
+# Account ages come from the snowflake of the member id.
+
+import time
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import List, Optional
+
+DISCORD_EPOCH = 1420070400.0
+# Upper edges of the account age bins in seconds, the last bin is open
+AGE_BINS = (3600, 86400, 7 * 86400, 30 * 86400, 365 * 86400)
+AGE_LABELS = ("<1h", "<1d", "<1w", "<30d", "<1y", "older")
+
+RAID_START = "start"
+
+
+def account_age(user_id: int, now: float) -> float:
+    """Seconds since the account was created"""
+    return now - ((user_id >> 22) / 1000 + DISCORD_EPOCH)
+
+
+class GuildJoins:
+    __slots__ = (
+        "buckets", "bucket", "totals", "ids", "times", "next", "raid_since",
+        "last_burst", "raid_joins"
+    )
+
+    def __init__(self, window: int, capacity: int):
+        bins = len(AGE_LABELS)
+        # One row of age bin counts per second of the window
+        self.buckets = array("l", [0]) * (window * bins)
+        self.bucket = 0
+        self.totals = array("l", [0]) * bins
+        self.ids = array("q", [0]) * capacity
+        self.times = array("d", [0.0]) * capacity
+        self.next = 0
+        self.raid_since = 0.0
+        self.last_burst = 0.0
+        self.raid_joins = 0
+
+
+class RaidDetector:
+    """
+    Flags a raid in a guild once `joins` members joined within `window`
+    seconds, or `young_joins` of them had accounts younger than
+    `young_age` seconds. It ends after `quiet` seconds without either.
+
+    Remembers the `capacity` latest joiners of the `max_guilds`
+    guilds with the most recent joins
+    """
+
+    def __init__(
+        self,
+        joins: int = 10,
+        window: int = 10,
+        young_joins: int = 5,
+        young_age: float = 7 * 86400,
+        quiet: float = 120.0,
+        capacity: int = 500,
+        max_guilds: int = 2000
+    ):
+        self.joins = joins
+        self.window = window
+        self.young_joins = young_joins
+        # Bins entirely below young_age count as young
+        self.young_bins = bisect_right(AGE_BINS, young_age)
+        self.quiet = quiet
+        self.capacity = capacity
+        self.max_guilds = max_guilds
+        self.guilds = OrderedDict()  # type: OrderedDict[int, GuildJoins]
+
+    def _advance(self, state: GuildJoins, second: int) -> None:
+        """Clears the buckets of the seconds since the last join"""
+        bins = len(AGE_LABELS)
+        buckets, totals = state.buckets, state.totals
+        for elapsed in range(min(second - state.bucket, self.window)):
+            row = (state.bucket + 1 + elapsed) % self.window * bins
+            for age_bin in range(bins):
+                totals[age_bin] -= buckets[row + age_bin]
+                buckets[row + age_bin] = 0
+        state.bucket = max(state.bucket, second)
+
+    def join(
+        self, guild: int, user: int, now: float = None
+    ) -> Optional[str]:
+        """Records a join, returns RAID_START when it starts a raid"""
+        now = time.time() if now is None else now
+        state = self.guilds.get(guild)
+        if state is None:
+            state = self.guilds[guild] = GuildJoins(
+                self.window, self.capacity)
+            state.bucket = int(now)
+            if len(self.guilds) > self.max_guilds:
+                self.guilds.popitem(last=False)
+        else:
+            self.guilds.move_to_end(guild)
+
+        self._advance(state, int(now))
+        age_bin = bisect_right(AGE_BINS, account_age(user, now))
+        state.buckets[
+            state.bucket % self.window * len(AGE_LABELS) + age_bin] += 1
+        state.totals[age_bin] += 1
+
+        i = state.next
+        state.ids[i] = user
+        state.times[i] = now
+        state.next = (i + 1) % self.capacity
+
+        totals = state.totals
+        burst = (
+            sum(totals) >= self.joins
+            or sum(totals[:self.young_bins]) >= self.young_joins
+        )
+        if state.raid_since:
+            state.raid_joins += 1
+            if burst:
+                state.last_burst = now
+            return None
+        if not burst:
+            return None
+
+        # The raid is counted from the joins that revealed it
+        state.raid_since = state.last_burst = now
+        state.raid_joins = sum(totals)
+        return RAID_START
+
+    def is_young(self, user: int, now: float = None) -> bool:
+        """Whether the account falls in the young age bins"""
+        now = time.time() if now is None else now
+        return bisect_right(AGE_BINS, account_age(user, now)) < (
+            self.young_bins)
+
+    def sweep(self, now: float = None) -> List[int]:
+        """Ends the raids that went quiet, returns their guilds"""
+        now = time.time() if now is None else now
+        ended = []
+        for guild, state in self.guilds.items():
+            if state.raid_since and now - state.last_burst >= self.quiet:
+                state.raid_since = 0.0
+                ended.append(guild)
+        return ended
+
+    def end(self, guild: int) -> bool:
+        """Ends a raid early, False when there was none"""
+        state = self.guilds.get(guild)
+        if state is None or not state.raid_since:
+            return False
+        state.raid_since = 0.0
+        return True
+
+    def raid(self, guild: int) -> Optional[GuildJoins]:
+        state = self.guilds.get(guild)
+        return state if state is not None and state.raid_since else None
+
+    def histogram(self, guild: int, now: float = None) -> List[int]:
+        """Joins in the window per account age bin, see AGE_LABELS"""
+        state = self.guilds.get(guild)
+        if state is None:
+            return [0] * len(AGE_LABELS)
+        self._advance(state, int(time.time() if now is None else now))
+        return list(state.totals)
+
+    def joiners(self, guild: int, since: float) -> List[int]:
+        """Ids of the remembered members that joined at or after since"""
+        state = self.guilds.get(guild)
+        if state is None:
+            return []
+        return [
+            user for user, joined in zip(state.ids, state.times)
+            if joined >= since and user
+        ]
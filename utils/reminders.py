@@ -0,0 +1,219 @@
+# reminders.py
+#
+# Reminders are rows in the reminders table, not sleeping coroutines.
+# A single dispatcher keeps the reminders due within the next `horizon`
+# seconds in a heap, sleeps until the earliest one and hands everything
+# due at that point to `deliver` in one batch. Reminders further out
+# are read from the database as the horizon moves, using the index on
+# the due time, so they survive restarts without being held in memory.
+# In a cluster every process only loads the reminders of the shards it
+# serves, reminders made in DMs belong to the process given `dms`.
+
+import asyncio
+import datetime
+import heapq
+import logging
+from typing import Awaitable, Callable, Iterable, List, Optional, Set
+
+from utils import database_manager as db
+
+logger = logging.getLogger("discord")
+
+COLUMNS = "id, userid, channelid, guildid, created, due, message"
+
+
+class Reminder:
+    __slots__ = (
+        "id", "userid", "channelid", "guildid", "created", "due", "message"
+    )
+
+    def __init__(
+        self,
+        id: int,
+        userid: int,
+        channelid: Optional[int],
+        guildid: Optional[int],
+        created: datetime.datetime,
+        due: datetime.datetime,
+        message: str
+    ):
+        self.id = id
+        self.userid = userid
+        self.channelid = channelid
+        self.guildid = guildid
+        self.created = created
+        self.due = due
+        self.message = message
+
+
+# Returns the reminders that are done with, delivered or undeliverable
+Deliver = Callable[[List[Reminder]], Awaitable[List[Reminder]]]
+
+
+class ReminderDispatcher:
+    """
+    Delivers reminders when they are due, in batches
+
+    `deliver` gets every reminder due at the same time at once,
+    the reminders it returns are deleted afterwards. The others
+    are tried again `retry` seconds later.
+
+    With shard_count set only the reminders of guilds on `shards`
+    are handled, and those made in DMs when `dms` is True.
+    """
+
+    def __init__(
+        self,
+        deliver: Deliver,
+        horizon: float = 3600.0,
+        retry: float = 60.0,
+        shard_count: int = None,
+        shards: Iterable[int] = None,
+        dms: bool = True
+    ):
+        self.deliver = deliver
+        self.horizon = datetime.timedelta(seconds=horizon)
+        self.retry = datetime.timedelta(seconds=retry)
+        self.shard_count = shard_count
+        self.shards = None if shards is None else set(shards)
+        self.dms = dms
+        # Every reminder due before loaded_until is in the heap
+        self.loaded_until = None  # type: Optional[datetime.datetime]
+        self._heap = []  # type: List[tuple]
+        self._ids = set()  # type: Set[int]
+        self._wakeup = asyncio.Event()
+        self._task = None  # type: Optional[asyncio.Task]
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def owns(self, guildid: Optional[int]) -> bool:
+        if guildid is None:
+            return self.dms
+        if self.shard_count is None or self.shards is None:
+            return True
+        return (guildid >> 22) % self.shard_count in self.shards
+
+    def _scope(self) -> str:
+        """SQL condition matching the reminders owns accepts"""
+        dms = "guildid IS NULL" if self.dms else "0"
+        if self.shard_count is None or self.shards is None:
+            return f"({dms} OR guildid IS NOT NULL)"
+        shards = ", ".join(str(int(shard)) for shard in self.shards)
+        return (f"({dms} OR (guildid >> 22) % {int(self.shard_count)} "
+                f"IN ({shards}))")
+
+    async def start(self) -> None:
+        """Loads the reminders due soon, overdue ones included"""
+        await self.refill()
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def add(
+        self,
+        userid: int,
+        channelid: Optional[int],
+        guildid: Optional[int],
+        due: datetime.datetime,
+        message: str
+    ) -> Reminder:
+        created = datetime.datetime.utcnow()
+        id = await db.insert(f"""
+            INSERT INTO reminders({COLUMNS})
+                VALUES (NULL, ?, ?, ?, ?, ?, ?);
+        """, [userid, channelid, guildid, created, due, message])
+
+        reminder = Reminder(
+            id, userid, channelid, guildid, created, due, message)
+        if (self.loaded_until is not None and due < self.loaded_until
+                and self.owns(guildid)):
+            self._push(reminder)
+        return reminder
+
+    async def refill(self) -> None:
+        """Moves the horizon forward, loading the reminders it passes"""
+        start = self.loaded_until
+        # Moved first, reminders added meanwhile go straight to the heap
+        self.loaded_until = datetime.datetime.utcnow() + self.horizon
+
+        if start is None:
+            rows = await db.fetchall(f"""
+                SELECT {COLUMNS} FROM reminders
+                    WHERE due < ? AND {self._scope()};
+            """, [self.loaded_until])
+        else:
+            rows = await db.fetchall(f"""
+                SELECT {COLUMNS} FROM reminders
+                    WHERE due >= ? AND due < ? AND {self._scope()};
+            """, [start, self.loaded_until])
+
+        for row in rows:
+            self._push(Reminder(*row))
+
+    def _push(self, reminder: Reminder) -> None:
+        if reminder.id in self._ids:
+            return
+        self._ids.add(reminder.id)
+        self._queue(reminder.due, reminder)
+
+    def _queue(self, when: datetime.datetime, reminder: Reminder) -> None:
+        was_first = not self._heap or when < self._heap[0][0]
+        heapq.heappush(self._heap, (when, reminder.id, reminder))
+        if was_first:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                now = datetime.datetime.utcnow()
+                batch = []
+                while self._heap and self._heap[0][0] <= now:
+                    reminder = heapq.heappop(self._heap)[2]
+                    self._ids.discard(reminder.id)
+                    batch.append(reminder)
+                if batch:
+                    await self._deliver(batch)
+
+                if now >= self.loaded_until:
+                    await self.refill()
+
+                wake = self.loaded_until
+                if self._heap and self._heap[0][0] < wake:
+                    wake = self._heap[0][0]
+                timeout = max(
+                    (wake - datetime.datetime.utcnow()).total_seconds(), 0)
+
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Reminder dispatcher failed")
+                await asyncio.sleep(5)
+
+    async def _deliver(self, batch: List[Reminder]) -> None:
+        try:
+            done = await self.deliver(batch)
+        except Exception:
+            logger.exception(f"Failed to deliver {len(batch)} reminders")
+            done = []
+
+        done_ids = {reminder.id for reminder in done}
+        if done_ids:
+            await db.executemany(
+                "DELETE FROM reminders WHERE id = ?;",
+                [(id,) for id in done_ids])
+
+        # Kept in the table, and in the heap to be tried again
+        retry_at = datetime.datetime.utcnow() + self.retry
+        for reminder in batch:
+            if reminder.id not in done_ids:
+                self._ids.add(reminder.id)
+                self._queue(retry_at, reminder)
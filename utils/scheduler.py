@@ -0,0 +1,188 @@
+# scheduler.py
+#
+# Periodic jobs for the bot, all driven by a single timer task.
+# Due times live in a heap, the timer sleeps until the earliest one,
+# starts every job that is due as its own task and goes back to sleep.
+# Runs are scheduled from the ideal start time, not from when the last
+# run happened, so intervals don't drift with loop lag or run time.
+
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+from typing import Any, Callable, Dict, List, Optional, Set
+
+logger = logging.getLogger("discord")
+
+
+class Job:
+    """Handle of a scheduled job, returned by Scheduler.every"""
+
+    __slots__ = (
+        "name", "interval", "jitter", "method", "args", "kwargs",
+        "scheduler", "base", "next_run", "last_run", "last_duration",
+        "runs", "skipped", "failures", "running", "cancelled"
+    )
+
+    def __init__(
+        self,
+        scheduler: "Scheduler",
+        name: str,
+        interval: float,
+        jitter: float,
+        method: Callable,
+        args: tuple,
+        kwargs: dict
+    ):
+        self.scheduler = scheduler
+        self.name = name
+        self.interval = interval
+        self.jitter = jitter
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        # Ideal start of the next run, next_run adds the jitter
+        self.base = 0.0
+        self.next_run = 0.0
+        self.last_run = None  # type: Optional[float]
+        self.last_duration = None  # type: Optional[float]
+        self.runs = 0
+        self.skipped = 0
+        self.failures = 0
+        self.running = False
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        """Stops future runs, a run in progress is left to finish"""
+        self.scheduler.cancel(self)
+
+
+class Scheduler:
+    """
+    Runs jobs every `interval` seconds, sub-second intervals included
+
+    A job still running when it is due again is skipped for that run
+    instead of running twice at once. Runs missed because the loop was
+    blocked are skipped too, not run back to back.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.jobs = {}  # type: Dict[str, Job]
+        self._heap = []  # type: List[tuple]
+        self._order = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._running = set()  # type: Set[asyncio.Task]
+        self._task = None  # type: Optional[asyncio.Task]
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = self.loop.create_task(self._timer())
+
+    async def close(self) -> None:
+        """Stops the timer and cancels every job still running"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for task in list(self._running):
+            task.cancel()
+        if self._running:
+            await asyncio.wait(self._running)
+
+    def every(
+        self,
+        interval: float,
+        method: Callable,
+        *args: Any,
+        name: str = None,
+        jitter: float = 0.0,
+        delay: float = None,
+        **kwargs: Any
+    ) -> Job:
+        """
+        Runs method(*args, **kwargs) every interval seconds, the first
+        time after `delay` seconds, one interval when not given.
+        method can be a coroutine function or a plain function.
+        Every run starts up to `jitter` seconds late, spreading jobs
+        with the same interval.
+        Raises ValueError when a job with the same name exists.
+        """
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        name = name or getattr(method, "__qualname__", repr(method))
+        if name in self.jobs:
+            raise ValueError(f"A job named {name} is already scheduled")
+
+        job = Job(self, name, interval, jitter, method, args, kwargs)
+        job.base = self.loop.time() + (interval if delay is None else delay)
+        self.jobs[name] = job
+        self._push(job)
+        return job
+
+    def cancel(self, job: Job) -> None:
+        # The heap entry is discarded once it comes up
+        job.cancelled = True
+        if self.jobs.get(job.name) is job:
+            del self.jobs[job.name]
+
+    def _push(self, job: Job) -> None:
+        job.next_run = job.base
+        if job.jitter:
+            job.next_run += random.uniform(0, job.jitter)
+        was_first = not self._heap or job.next_run < self._heap[0][0]
+        heapq.heappush(self._heap, (job.next_run, next(self._order), job))
+        if was_first:
+            self._wakeup.set()
+
+    async def _timer(self) -> None:
+        while True:
+            now = self.loop.time()
+            while self._heap and self._heap[0][0] <= now:
+                when, _, job = heapq.heappop(self._heap)
+                if job.cancelled or when != job.next_run:
+                    continue
+                self._due(job, now)
+
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _due(self, job: Job, now: float) -> None:
+        if job.running:
+            job.skipped += 1
+        else:
+            task = self.loop.create_task(self._run(job))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+        # Keeps to the original grid, dropping runs that were missed
+        job.base += job.interval
+        if job.base <= now:
+            missed = int((now - job.base) // job.interval) + 1
+            job.skipped += missed
+            job.base += missed * job.interval
+        self._push(job)
+
+    async def _run(self, job: Job) -> None:
+        job.running = True
+        job.last_run = time.time()
+        start = time.perf_counter()
+        try:
+            result = job.method(*job.args, **job.kwargs)
+            if asyncio.iscoroutine(result):
+                await result
+            job.runs += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            job.failures += 1
+            logger.exception(f"Scheduled job {job.name} raised an exception "
+                             f"with args {job.args}, kwargs {job.kwargs}")
+        finally:
+            job.last_duration = time.perf_counter() - start
+            job.running = False
@@ -0,0 +1,189 @@
+# spam_filter.py
+#
+# Spam detection for on_message.
+# Every member gets a fixed size ring of their last messages: when each
+# was sent, a hash of its normalized content and how many mentions and
+# links it had. Adding a message overwrites the oldest slot and adjusts
+# running totals, so every check is O(1) and memory is bounded by the
+# ring size times the number of members remembered.
+
+import re
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from utils import database_manager as db
+# Digits, punctuation and whitespace are dropped before hashing,
+# so "buy now!!1" and "BUY NOW 22" count as duplicates
+_NOISE = str.maketrans("", "", "0123456789 \t\n\r.,!?:;-_*~`'\"|()[]{}<>")
+_LINK = re.compile(r"https?://")
+
+
+class SpamPreset:
+    __slots__ = (
+        "name", "window", "period", "rate", "duplicates", "mentions", "links"
+    )
+
+    def __init__(
+        self,
+        name: str,
+        window: int,
+        period: float,
+        rate: int,
+        duplicates: int,
+        mentions: int,
+        links: int
+    ):
+        self.name = name
+        # Messages remembered per member, and how long they are relevant
+        self.window = window
+        self.period = period
+        # Limits within the remembered messages, 0 disables a check
+        self.rate = min(rate, window)
+        self.duplicates = duplicates
+        self.mentions = mentions
+        self.links = links
+
+
+PRESETS = {
+    preset.name: preset for preset in (
+        SpamPreset("relaxed", window=10, period=10.0, rate=10,
+                   duplicates=6, mentions=15, links=8),
+        SpamPreset("normal", window=8, period=8.0, rate=7,
+                   duplicates=4, mentions=10, links=5),
+        SpamPreset("strict", window=6, period=6.0, rate=5,
+                   duplicates=3, mentions=6, links=3),
+    )
+}
+OFF = "off"
+
+
+class UserRing:
+    __slots__ = (
+        "times", "hashes", "mentions", "links", "index", "last",
+        "hash_counts", "mention_sum", "link_sum"
+    )
+
+    def __init__(self, size: int):
+        self.times = [float("-inf")] * size
+        self.hashes = [None] * size
+        self.mentions = [0] * size
+        self.links = [0] * size
+        self.index = 0
+        self.last = float("-inf")
+        self.hash_counts = {}  # type: Dict[int, int]
+        self.mention_sum = 0
+        self.link_sum = 0
+
+    def add(
+        self, now: float, content_hash: int, mentions: int, links: int
+    ) -> int:
+        """Overwrites the oldest message, returns how often the hash is held
+        """
+        i = self.index
+        old = self.hashes[i]
+        if old is not None:
+            left = self.hash_counts[old] - 1
+            if left:
+                self.hash_counts[old] = left
+            else:
+                del self.hash_counts[old]
+        self.mention_sum += mentions - self.mentions[i]
+        self.link_sum += links - self.links[i]
+
+        self.times[i] = now
+        self.hashes[i] = content_hash
+        self.mentions[i] = mentions
+        self.links[i] = links
+        self.index = (i + 1) % len(self.times)
+        self.last = now
+
+        count = self.hash_counts.get(content_hash, 0) + 1
+        self.hash_counts[content_hash] = count
+        return count
+
+    def sent_at(self, back: int) -> float:
+        """When the message `back` messages ago was sent, 1 being the last
+        """
+        return self.times[(self.index - back) % len(self.times)]
+
+
+class SpamFilter:
+    """
+    Checks messages against the preset of their guild, `default` for
+    guilds without one. Remembers at most `max_users` members
+    """
+
+    def __init__(self, default: str = OFF, max_users: int = 50000):
+        if default != OFF and default not in PRESETS:
+            raise ValueError(f"Unknown spam preset {default}")
+        self.default = default
+        self.max_users = max_users
+        self.guild_presets = {}  # type: Dict[int, str]
+        self.rings = OrderedDict()  # type: OrderedDict[tuple, UserRing]
+
+    def preset(self, guild: int) -> Optional[SpamPreset]:
+        return PRESETS.get(self.guild_presets.get(guild, self.default))
+
+    async def load(self) -> None:
+        """Loads the preset every guild has chosen"""
+        rows = await db.fetchall("SELECT guildid, preset FROM spam_settings;")
+        self.guild_presets = {
+            guild: preset for guild, preset in rows
+            if preset == OFF or preset in PRESETS
+        }
+
+    async def set_preset(self, guild: int, name: str) -> None:
+        """Raises ValueError for unknown presets"""
+        if name != OFF and name not in PRESETS:
+            raise ValueError(f"Unknown spam preset {name}")
+        await db.execute("""
+            INSERT OR REPLACE INTO spam_settings(guildid, preset)
+                VALUES (?, ?);
+        """, [guild, name])
+        self.guild_presets[guild] = name
+        # Rings are sized for the old preset
+        for key in [key for key in self.rings if key[0] == guild]:
+            del self.rings[key]
+
+    def check(
+        self,
+        guild: int,
+        user: int,
+        now: float,
+        content: str,
+        mentions: int
+    ) -> Optional[str]:
+        """
+        Records a message, returns why it is spam or None
+        now is a monotonic time in seconds
+        """
+        preset = self.preset(guild)
+        if preset is None:
+            return None
+
+        key = (guild, user)
+        ring = self.rings.get(key)
+        if ring is None or now - ring.last > preset.period:
+            # Nothing remembered is recent enough to matter, start over
+            ring = self.rings[key] = UserRing(preset.window)
+            if len(self.rings) > self.max_users:
+                self.rings.popitem(last=False)
+        else:
+            self.rings.move_to_end(key)
+
+        links = len(_LINK.findall(content)) if "://" in content else 0
+        normalized = content.lower().translate(_NOISE)
+        duplicates = ring.add(
+            now, hash(normalized) if normalized else 0, mentions, links)
+
+        if preset.rate and now - ring.sent_at(preset.rate) < preset.period:
+            return "rate"
+        if preset.duplicates and normalized and (
+            duplicates >= preset.duplicates
+        ):
+            return "duplicates"
+        if preset.mentions and ring.mention_sum > preset.mentions:
+            return "mentions"
+        if preset.links and ring.link_sum > preset.links:
+            return "links"
+        return None
@@ -0,0 +1,226 @@
+# strikes.py
+#
+# Automatic punishments for warnings.
+# A guild sets rules like "3 warnings within 1 hour -> mute", the engine
+# keeps the times of every member's recent warnings in a small ring
+# and checks the guild's rules whenever one is added, without touching
+# the warnings table beyond the INSERT. Old warnings are not tracked
+# per member, a periodic bulk query deletes everything past a guild's
+# decay time, using the (guildid, date) index.
+
+import datetime
+import re
+import sqlite3 as sql
+from collections import OrderedDict, deque
+from typing import List, Optional, Set, Tuple
+
+from utils import database_manager as db
+from utils.warning_counts import WarningCounter
+
+MUTE = "mute"
+KICK = "kick"
+BAN = "ban"
+# Worst last, when several rules match the worst one is applied
+ACTIONS = (MUTE, KICK, BAN)
+
+DURATION = re.compile(
+    r"((?P<days>\d+)d)?((?P<hours>\d+)h)?"
+    r"((?P<minutes>\d+)m)?((?P<seconds>\d+)s)?"
+)
+
+
+def parse_duration(text: str) -> datetime.timedelta:
+    """Parses 1d12h, 30m, 45s and so on, raises ValueError otherwise"""
+    match = DURATION.fullmatch(text)
+    if not text or not match:
+        raise ValueError(f"Invalid duration {text}")
+    return datetime.timedelta(**{
+        unit: int(value) for unit, value in match.groupdict().items()
+        if value is not None
+    })
+
+
+class StrikeRule:
+    __slots__ = ("warnings", "window", "action")
+
+    def __init__(self, warnings: int, window: int, action: str):
+        if action not in ACTIONS:
+            raise ValueError(f"Unknown action {action}")
+        if warnings < 1 or window < 1:
+            raise ValueError("Rules need at least 1 warning and 1 second")
+        self.warnings = warnings
+        self.window = window
+        self.action = action
+
+
+class GuildStrikes:
+    __slots__ = ("rules", "decay", "depth")
+
+    def __init__(self, rules: List[StrikeRule], decay: int):
+        self.rules = rules
+        # Seconds until warnings expire, 0 keeps them forever
+        self.decay = decay
+        # Warnings remembered per member, one more than the largest rule
+        # needs so a full window can be told from one just reaching it
+        self.depth = max((rule.warnings for rule in rules), default=0) + 1
+
+
+def _expire(conn: sql.Connection, now: datetime.datetime) -> Set[int]:
+    """Deletes expired warnings, returns the guilds that had any"""
+    guilds = set()
+    try:
+        settings = conn.execute("""
+            SELECT guildid, decay FROM strike_settings
+                WHERE decay > 0;
+        """).fetchall()
+        for guild, decay in settings:
+            # A range scan on the (guildid, date) index per guild
+            cursor = conn.execute("""
+                DELETE FROM warnings
+                    WHERE guildid = ? AND date < ?;
+            """, [guild, now - datetime.timedelta(seconds=decay)])
+            if cursor.rowcount:
+                guilds.add(guild)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return guilds
+
+
+class StrikeEngine:
+    """
+    Stores warnings through a WarningCounter and decides the punishment
+    a new warning earns. Keeps the rules of `max_guilds` guilds and
+    the recent warning times of `max_members` members in memory
+    """
+
+    def __init__(
+        self,
+        counter: WarningCounter,
+        max_guilds: int = 10000,
+        max_members: int = 100000
+    ):
+        self.counter = counter
+        self.max_guilds = max_guilds
+        self.max_members = max_members
+        self.guilds = OrderedDict()  # type: OrderedDict[int, GuildStrikes]
+        # Dates of the latest warnings per (guild, user)
+        self.recent = OrderedDict()  # type: OrderedDict[tuple, deque]
+
+    async def settings(self, guild: int) -> GuildStrikes:
+        settings = self.guilds.get(guild)
+        if settings is not None:
+            self.guilds.move_to_end(guild)
+            return settings
+
+        rules = await db.fetchall("""
+            SELECT warnings, window, action FROM strike_rules
+                WHERE guildid = ?;
+        """, [guild])
+        row = await db.fetchone("""
+            SELECT decay FROM strike_settings
+                WHERE guildid = ?;
+        """, [guild])
+        settings = GuildStrikes(
+            [StrikeRule(*rule) for rule in rules], row[0] if row else 0)
+
+        self.guilds[guild] = settings
+        if len(self.guilds) > self.max_guilds:
+            self.guilds.popitem(last=False)
+        return settings
+
+    async def _recent(
+        self, guild: int, user: int, settings: GuildStrikes
+    ) -> deque:
+        key = (guild, user)
+        recent = self.recent.get(key)
+        if recent is not None and recent.maxlen == settings.depth:
+            self.recent.move_to_end(key)
+            return recent
+
+        rows = await db.fetchall("""
+            SELECT date FROM warnings
+                WHERE guildid = ? AND userid = ? AND date IS NOT NULL
+                ORDER BY date DESC
+                LIMIT ?;
+        """, [guild, user, settings.depth])
+        loaded = deque(
+            reversed([row[0] for row in rows]), maxlen=settings.depth)
+
+        # Another warning may have loaded them meanwhile
+        recent = self.recent.get(key)
+        if recent is None or recent.maxlen != settings.depth:
+            recent = self.recent[key] = loaded
+            if len(self.recent) > self.max_members:
+                self.recent.popitem(last=False)
+        return recent
+
+    async def warn(self, guild: int, user: int) -> Tuple[int, Optional[str]]:
+        """
+        Stores a warning, returns the member's warning count and
+        the action to take, None when no rule matched
+        """
+        now = datetime.datetime.utcnow()
+        settings = await self.settings(guild)
+        if not settings.rules:
+            return await self.counter.warn(guild, user, now), None
+
+        recent = await self._recent(guild, user, settings)
+        count = await self.counter.warn(guild, user, now)
+        recent.append(now)
+
+        action = None
+        for rule in settings.rules:
+            since = now - datetime.timedelta(seconds=rule.window)
+            # Fires once, when the warning that reaches the limit arrives
+            in_window = sum(1 for date in recent if date >= since)
+            if in_window == rule.warnings and (
+                action is None
+                or ACTIONS.index(rule.action) > ACTIONS.index(action)
+            ):
+                action = rule.action
+        return count, action
+
+    async def add_rule(self, guild: int, rule: StrikeRule) -> None:
+        await db.execute("""
+            INSERT OR REPLACE INTO strike_rules(
+                guildid, warnings, window, action)
+                VALUES (?, ?, ?, ?);
+        """, [guild, rule.warnings, rule.window, rule.action])
+        self.forget(guild)
+
+    async def remove_rule(self, guild: int, warnings: int, window: int):
+        await db.execute("""
+            DELETE FROM strike_rules
+                WHERE guildid = ? AND warnings = ? AND window = ?;
+        """, [guild, warnings, window])
+        self.forget(guild)
+
+    async def set_decay(self, guild: int, decay: int) -> None:
+        await db.execute("""
+            INSERT OR REPLACE INTO strike_settings(guildid, decay)
+                VALUES (?, ?);
+        """, [guild, decay])
+        self.forget(guild)
+
+    async def expire(self) -> None:
+        """Deletes every warning older than its guild's decay time"""
+        pool = await db.get_pool()
+        guilds = await pool.write(_expire, datetime.datetime.utcnow())
+        for guild in guilds:
+            self.counter.forget(guild)
+        if guilds:
+            self.forget_members(guilds)
+
+    def forget(self, guild: int) -> None:
+        """Drops the cached rules of guild"""
+        self.guilds.pop(guild, None)
+
+    def forget_members(self, guilds: Set[int] = None) -> None:
+        """Drops the remembered warnings in guilds, or in every guild"""
+        if guilds is None:
+            self.recent.clear()
+            return
+        for key in [key for key in self.recent if key[0] in guilds]:
+            del self.recent[key]
@@ -0,0 +1,105 @@
+# warning_counts.py
+#
+# Warning counts per member, cached per guild.
+# Warning someone whose count is cached is a single INSERT, otherwise
+# the INSERT and a COUNT over the (guildid, userid) index run together
+# on the writer connection, one trip to the database thread.
+# Every write to the warnings table should go through WarningCounter,
+# or be followed by forget, to keep the cache coherent.
+
+import datetime
+import sqlite3 as sql
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from utils import database_manager as db
+
+
+def _insert_and_count(
+    conn: sql.Connection, guild: int, user: int, date: datetime.datetime
+) -> int:
+    try:
+        conn.execute("""
+            INSERT INTO warnings(guildid, userid, date)
+                VALUES (?, ?, ?);
+        """, [guild, user, date])
+        count = conn.execute("""
+            SELECT COUNT(*) FROM warnings
+                WHERE guildid = ? AND userid = ?;
+        """, [guild, user]).fetchone()[0]
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return count
+
+
+class WarningCounter:
+    """Counts cached for the `max_guilds` most recently used guilds"""
+
+    def __init__(self, max_guilds: int = 10000):
+        self.max_guilds = max_guilds
+        self.counts = OrderedDict()  # type: OrderedDict[int, Dict[int, int]]
+        # Members with an uncached warning being counted by the database
+        self.counting = {}  # type: Dict[Tuple[int, int], int]
+
+    def _guild(self, guild: int) -> Dict[int, int]:
+        counts = self.counts.get(guild)
+        if counts is None:
+            counts = self.counts[guild] = {}
+            if len(self.counts) > self.max_guilds:
+                self.counts.popitem(last=False)
+        else:
+            self.counts.move_to_end(guild)
+        return counts
+
+    def cached(self, guild: int, user: int) -> Optional[int]:
+        counts = self.counts.get(guild)
+        return counts.get(user) if counts is not None else None
+
+    async def warn(
+        self, guild: int, user: int, date: datetime.datetime = None
+    ) -> int:
+        """Stores a warning, returns how many user now has in guild"""
+        date = date or datetime.datetime.utcnow()
+        counts = self._guild(guild)
+        count = counts.get(user)
+        key = (guild, user)
+        if count is None or key in self.counting:
+            # Until every database count is in, the cache may be behind
+            self.counting[key] = self.counting.get(key, 0) + 1
+            try:
+                pool = await db.get_pool()
+                count = await pool.write(
+                    _insert_and_count, guild, user, date)
+            finally:
+                self.counting[key] -= 1
+                if not self.counting[key]:
+                    del self.counting[key]
+            counts[user] = max(counts.get(user, 0), count)
+            return count
+
+        # Counted before the write, so concurrent warnings add up
+        count = counts[user] = count + 1
+        try:
+            await db.execute("""
+                INSERT INTO warnings(guildid, userid, date)
+                    VALUES (?, ?, ?);
+            """, [guild, user, date])
+        except Exception:
+            counts.pop(user, None)
+            raise
+        return count
+
+    async def clear(self, guild: int) -> None:
+        """Deletes every warning in guild"""
+        await db.execute(
+            "DELETE FROM warnings WHERE guildid = ?;", [guild])
+        self.forget(guild)
+
+    def forget(self, guild: int = None) -> None:
+        """Drops the cached counts of guild, or of every guild"""
+        if guild is None:
+            self.counts.clear()
+        else:
+            self.counts.pop(guild, None)